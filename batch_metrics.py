@@ -0,0 +1,501 @@
+import numpy as np
+import pandas as pd
+
+# Batched gerrymetrics: every metric is computed for all (Year, State) elections in
+# a results file at once. District voteshares are kept as one ragged array sorted
+# by (Year, State) with an offsets array marking where each election starts, so
+# the metrics are reductions over segments of that array rather than one
+# gerrymetrics call per election. scipy and gerrymetrics are only imported by the
+# methods using them, importing gerrymetrics takes seconds.
+
+# Packing methods
+
+
+def read_results(elections_df_fp, start_year=1948):
+    """
+    return a df with one row per district, sorted by Year and State
+
+    Reads a csv with the gerrymetrics columns:
+    'State,Year,District,Dem Votes,GOP Votes,D Voteshare,Incumbent,Party'
+    and applies the same filters as gerrymetrics.parse_results: races before
+    start_year and races won by independents are dropped.
+    """
+    df = pd.read_csv(elections_df_fp)
+    df = df[df["Year"] >= start_year]
+    df = df[df["Party"] != "I"]
+    for col in ["Dem Votes", "GOP Votes"]:
+        if col in df.columns and df[col].dtype == object:
+            df[col] = pd.to_numeric(df[col].str.replace(",", ""))
+    return df.sort_values(["Year", "State"], kind="mergesort").reset_index(drop=True)
+
+
+def pack_voteshares(df):
+    """
+    return (elections_df, offsets, voteshares) for a df of district results
+
+    elections_df has one row per (Year, State) with the columns Year, State and
+    Weighted Voteshare, offsets[i]:offsets[i + 1] is the slice of voteshares holding
+    the districts of election i. Expects df to be sorted like read_results returns,
+    or a district table (see district_table.py).
+    """
+    if isinstance(df, dict):
+        return _pack_table(df)
+    keys = df[["Year", "State"]]
+    starts = np.flatnonzero(
+        np.r_[True, (keys.iloc[1:].values != keys.iloc[:-1].values).any(axis=1)]
+    )
+    offsets = np.r_[starts, len(df)]
+    elections_df = keys.iloc[starts].reset_index(drop=True)
+
+    voteshares = df["D Voteshare"].to_numpy(dtype=np.float64)
+    if "Dem Votes" in df.columns:
+        dem_votes = np.add.reduceat(df["Dem Votes"].to_numpy(np.float64), starts)
+        gop_votes = np.add.reduceat(df["GOP Votes"].to_numpy(np.float64), starts)
+        elections_df["Weighted Voteshare"] = dem_votes / (dem_votes + gop_votes)
+    else:
+        elections_df["Weighted Voteshare"] = group_mean(voteshares, offsets)
+    return elections_df, offsets, voteshares
+
+
+def _pack_table(table):
+    offsets = table["offsets"]
+    starts = offsets[:-1]
+    elections_df = pd.DataFrame(
+        {
+            "Year": table["year"][starts].astype(np.int64),
+            "State": table["states"][table["state"][starts]].astype(object),
+        }
+    )
+    voteshares = np.asarray(table["voteshare"], dtype=np.float64)
+    if "dem_votes" in table:
+        dem_votes = np.add.reduceat(table["dem_votes"], starts)
+        gop_votes = np.add.reduceat(table["gop_votes"], starts)
+        elections_df["Weighted Voteshare"] = dem_votes / (dem_votes + gop_votes)
+    else:
+        elections_df["Weighted Voteshare"] = group_mean(voteshares, offsets)
+    return elections_df, offsets, voteshares
+
+
+def group_results(df):
+    """
+    return df in the format gerrymetrics.parse_results returns: one row per
+    (Year, State) with lists of the D Voteshare and District of every district and
+    the Weighted Voteshare. Expects df to be sorted like read_results returns.
+    """
+    grouped = df.groupby(["Year", "State"])
+    results = pd.DataFrame(grouped["D Voteshare"].apply(list))
+    results["District Numbers"] = grouped["District"].apply(list)
+    results["Weighted Voteshare"] = pack_voteshares(df)[0]["Weighted Voteshare"].values
+    return results
+
+
+def impute(voteshares, impute_val=1):
+    """
+    replace uncontested voteshares (0 and 1) with 1 - impute_val and impute_val
+    """
+    imputed = voteshares.copy()
+    imputed[voteshares == 1] = impute_val
+    imputed[voteshares == 0] = 1 - impute_val
+    return imputed
+
+
+def impute_grid(voteshares, impute_vals):
+    """
+    return a (len(impute_vals), len(voteshares)) array of voteshares imputed with
+    every value of impute_vals, see impute
+    """
+    impute_vals = np.asarray(impute_vals, dtype=np.float64)[:, None]
+    return np.where(
+        voteshares == 1,
+        impute_vals,
+        np.where(voteshares == 0, 1 - impute_vals, voteshares),
+    )
+
+
+def tile_offsets(offsets, n_copies):
+    """
+    return the offsets of n_copies of the ragged array of offsets laid end to end
+    """
+    n_values = offsets[-1]
+    return np.r_[
+        (offsets[:-1] + n_values * np.arange(n_copies)[:, None]).ravel(),
+        n_copies * n_values,
+    ]
+
+
+# Grouped reductions
+
+
+def group_ids(offsets):
+    """
+    return the index of the election each position of the ragged array belongs to
+    """
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def group_sum(values, offsets, mask=None):
+    """
+    sum values (optionally only where mask is True) within each election
+    """
+    if mask is not None:
+        values = np.where(mask, values, 0)
+    return np.add.reduceat(values, offsets[:-1])
+
+
+def group_mean(values, offsets):
+    """
+    mean of each election, matching np.mean
+
+    np.mean sums pairwise, np.add.reduceat in order, and the last bits of the two
+    differ: the mean of eight districts at 0.8 would round below 0.8. The elections
+    with the same number of districts are summed as the rows of one array instead,
+    which np.sum sums like np.mean does.
+    """
+    counts = np.diff(offsets)
+    order = np.argsort(counts, kind="stable")
+    sorted_counts = counts[order]
+    starts = np.flatnonzero(np.r_[True, sorted_counts[1:] != sorted_counts[:-1]])
+    sums = np.empty(len(counts))
+    for start, stop in zip(starts, np.r_[starts[1:], len(counts)]):
+        elections = order[start:stop]
+        rows = offsets[elections][:, None] + np.arange(sorted_counts[start])
+        sums[elections] = values[rows].sum(axis=1)
+    return sums / counts
+
+
+def group_median(values, offsets):
+    """
+    median of each election, matching np.median
+    """
+    ids = group_ids(offsets)
+    # skip the sort when the values of every election are already in order, e.g.
+    # bootstrap resamples (see resampling.py)
+    in_order = (values[1:] >= values[:-1]) | (ids[1:] != ids[:-1])
+    ordered = values if in_order.all() else values[np.lexsort((values, ids))]
+    counts = np.diff(offsets)
+    lower = ordered[offsets[:-1] + (counts - 1) // 2]
+    upper = ordered[offsets[:-1] + counts // 2]
+    return (lower + upper) / 2
+
+
+def group_average_ranks(values, ids):
+    """
+    return the rank of each value among the values with the same id, with tied
+    values given the average of their ranks (like scipy.stats.rankdata), and the
+    tie correction sum(t**3 - t) over the runs of tied values for each id
+    """
+    order = np.lexsort((values, ids))
+    sorted_values = values[order]
+    sorted_ids = ids[order]
+    new_run = np.r_[
+        True,
+        (sorted_values[1:] != sorted_values[:-1]) | (sorted_ids[1:] != sorted_ids[:-1]),
+    ]
+    run_starts = np.flatnonzero(new_run)
+    run_lengths = np.diff(np.r_[run_starts, len(values)])
+    group_starts = np.searchsorted(sorted_ids, sorted_ids[run_starts])
+    run_ranks = run_starts - group_starts + (run_lengths + 1) / 2
+
+    ranks = np.empty(len(values))
+    ranks[order] = np.repeat(run_ranks, run_lengths)
+    n_groups = ids.max() + 1 if len(ids) else 0
+    ties = np.bincount(
+        sorted_ids[run_starts],
+        weights=run_lengths.astype(np.float64) ** 3 - run_lengths,
+        minlength=n_groups,
+    )
+    return ranks, ties
+
+
+def _win_split(voteshares, offsets):
+    """
+    return the D-won mask, the number of D and R wins and the winning voteshares
+    (D voteshare in D wins, R voteshare in R wins) for each election
+    """
+    d_won = voteshares > 0.5
+    n_d = group_sum(d_won.astype(np.int64), offsets)
+    n_r = np.diff(offsets) - n_d
+    win_voteshares = np.where(d_won, voteshares, 1 - voteshares)
+    return d_won, n_d, n_r, win_voteshares
+
+
+# Metrics, each the batched equivalent of the gerrymetrics metric of the same name
+
+
+def mean_median(voteshares, offsets):
+    return group_mean(voteshares, offsets) - group_median(voteshares, offsets)
+
+
+def efficiency_gap(voteshares, offsets):
+    d_won = voteshares > 0.5
+    dem_loss = group_sum(voteshares, offsets, ~d_won)
+    rep_loss = group_sum(1 - voteshares, offsets, d_won)
+    dem_surp = group_sum(voteshares - 0.5, offsets, d_won)
+    rep_surp = group_sum(1 - voteshares - 0.5, offsets, ~d_won)
+    return ((dem_surp + dem_loss) - (rep_surp + rep_loss)) / np.diff(offsets)
+
+
+def partisan_bias(voteshares, offsets):
+    means = group_mean(voteshares, offsets)
+    above_mean = voteshares > np.repeat(means, np.diff(offsets))
+    return 0.5 - group_sum(above_mean.astype(np.int64), offsets) / np.diff(offsets)
+
+
+def t_test_p(voteshares, offsets, onetailed=True):
+    """
+    p-value of the two-sample t-test comparing the winning voteshares in D- and
+    R-won districts, -1 where gerrymetrics would return NaN
+    """
+    from scipy import special
+
+    d_won, n_d, n_r, win_voteshares = _win_split(voteshares, offsets)
+    with np.errstate(all="ignore"):
+        dmean = group_sum(win_voteshares, offsets, d_won) / n_d
+        rmean = group_sum(win_voteshares, offsets, ~d_won) / n_r
+        ids = group_ids(offsets)
+        deviations = win_voteshares - np.where(d_won, dmean[ids], rmean[ids])
+        d_ss = group_sum(deviations**2, offsets, d_won)
+        r_ss = group_sum(deviations**2, offsets, ~d_won)
+        d_ss[n_d < 2] = np.nan
+        r_ss[n_r < 2] = np.nan
+
+        df = n_d + n_r - 2.0
+        pooled_var = (d_ss + r_ss) / df
+        t = (dmean - rmean) / np.sqrt(pooled_var * (1.0 / n_d + 1.0 / n_r))
+        p = 2 * special.stdtr(df, -np.abs(t))
+
+        if onetailed:
+            party_with_lower_margin = np.sign(rmean - dmean)
+            party_with_more_seats = np.sign(n_d - n_r)
+            p = np.where(
+                party_with_more_seats == party_with_lower_margin, p / 2, 1 - p / 2
+            )
+    return np.where(np.isnan(p), -1.0, p)
+
+
+def mann_whitney_u_p(voteshares, offsets):
+    """
+    p-value of the Mann-Whitney U test comparing the winning voteshares in D- and
+    R-won districts, computed like scipy.stats.mannwhitneyu with the default
+    (alternative=None) arguments of the scipy releases gerrymetrics was written
+    against. NaN where either party won fewer than 2 districts, -1 where all the
+    winning voteshares are identical.
+    """
+    from scipy import special
+
+    d_won, n_d, n_r, win_voteshares = _win_split(voteshares, offsets)
+    ranks, ties = group_average_ranks(win_voteshares, group_ids(offsets))
+    n = (n_d + n_r).astype(np.float64)
+    with np.errstate(all="ignore"):
+        u1 = n_d * n_r + n_d * (n_d + 1) / 2.0 - group_sum(ranks, offsets, d_won)
+        u2 = n_d * n_r - u1
+        tie_correction = 1 - ties / (n**3 - n)
+        sd = np.sqrt(tie_correction * n_d * n_r * (n + 1) / 12.0)
+        z = (np.maximum(u1, u2) - (n_d * n_r / 2.0 + 0.5)) / sd
+        # the normal survival function, like scipy.stats.norm.sf
+        p = special.ndtr(-np.abs(z))
+    p = np.where((tie_correction == 0) | np.isnan(p), -1.0, p)
+    return np.where((n_d < 2) | (n_r < 2), np.nan, p)
+
+
+# gerrymetrics metric name -> batched equivalent
+BATCHED_METRICS = {
+    "t_test_p": t_test_p,
+    "mean_median": mean_median,
+    "EG": efficiency_gap,
+    "partisan_bias": partisan_bias,
+    "mann_whitney_u_p": mann_whitney_u_p,
+}
+
+
+def unbatched(metric):
+    """
+    return the gerrymetrics metric a batched metric is the equivalent of,
+    gerrymetrics metrics are returned as they are
+    """
+    for name, batched_metric in BATCHED_METRICS.items():
+        if metric is batched_metric:
+            import gerrymetrics
+
+            return getattr(gerrymetrics, name)
+    return metric
+
+
+def batched(metric):
+    """
+    return the batched equivalent of a gerrymetrics metric, batched metrics are
+    returned as they are
+    """
+    if metric in BATCHED_METRICS.values():
+        return metric
+    if metric.__name__ not in BATCHED_METRICS:
+        raise ValueError(
+            "No batched equivalent of gerrymetrics.{}".format(metric.__name__)
+        )
+    return BATCHED_METRICS[metric.__name__]
+
+
+# Batched gerrymetrics.run_all_tests
+
+
+def run_all_tests(df, impute_val=1, metrics=None):
+    """
+    batched equivalent of gerrymetrics.tests_df(gerrymetrics.run_all_tests(...))
+
+    returns a df indexed by (Year, State) with the columns voteshare, dseats, seats,
+    ndists, state, year, weighted_voteshare and one column per entry of metrics.
+    metrics maps column names to gerrymetrics metrics or batched metrics (e.g.
+    run_gerrymetrics.metric_dict), see batched. Expects df to be sorted like read_results returns.
+    """
+    if metrics is None:
+        metrics = BATCHED_METRICS
+    assert (
+        impute_val > 0.5 and impute_val <= 1.0
+    ), "Imputed voteshare in uncontested races must be between .5 and 1"
+
+    elections_df, offsets, voteshares = pack_voteshares(df)
+    if impute_val != 1:
+        voteshares = impute(voteshares, impute_val)
+    index = pd.MultiIndex.from_frame(elections_df[["Year", "State"]])
+    return _tests_df(elections_df, offsets, voteshares, metrics, index)
+
+
+def run_all_tests_grid(df, impute_vals, metrics=None):
+    """
+    return run_all_tests of df for every value of impute_vals, as one df indexed by
+    (impute_val, Year, State)
+
+    The voteshares are imputed with every value at once and the metrics are
+    computed for every imputed copy of every election in one call per metric.
+    """
+    if metrics is None:
+        metrics = BATCHED_METRICS
+    impute_vals = list(impute_vals)
+    for impute_val in impute_vals:
+        assert (
+            impute_val > 0.5 and impute_val <= 1.0
+        ), "Imputed voteshare in uncontested races must be between .5 and 1"
+
+    elections_df, offsets, voteshares = pack_voteshares(df)
+    n_copies = len(impute_vals)
+    elections_df = pd.concat([elections_df] * n_copies, ignore_index=True)
+    elections_df.insert(0, "impute_val", np.repeat(impute_vals, len(offsets) - 1))
+    index = pd.MultiIndex.from_frame(elections_df[["impute_val", "Year", "State"]])
+    return _tests_df(
+        elections_df,
+        tile_offsets(offsets, n_copies),
+        impute_grid(voteshares, impute_vals).ravel(),
+        metrics,
+        index,
+    )
+
+
+def _tests_df(elections_df, offsets, voteshares, metrics, index):
+    ndists = np.diff(offsets)
+    dseats = group_sum((voteshares > 0.5).astype(np.int64), offsets)
+
+    tests_df = pd.DataFrame(
+        {
+            "voteshare": group_mean(voteshares, offsets),
+            "dseats": dseats.astype(np.float64),
+            "seats": dseats.astype(np.float64),
+            "ndists": ndists.astype(np.float64),
+            "state": elections_df["State"].values,
+            "year": elections_df["Year"].values.astype(np.float64),
+            "weighted_voteshare": elections_df["Weighted Voteshare"].values,
+        },
+        index=index,
+    )
+    with np.errstate(all="ignore"):
+        for name, metric in metrics.items():
+            tests_df[name] = batched(metric)(voteshares, offsets)
+    return tests_df
+
+
+def percentile_of_scores(values):
+    """
+    return scipy.stats.percentileofscore(np.abs(values), np.abs(value)) for every
+    value of values, as computed by the scipy releases gerrymetrics was written
+    against: NaNs are counted in the number of values but never ranked below or tied
+    with another value, and NaN values get a percentile of 0
+    """
+    values = np.abs(np.asarray(values, dtype=np.float64))
+    is_nan = np.isnan(values)
+    ordered = np.sort(values[~is_nan])
+    left = np.searchsorted(ordered, values, side="left")
+    right = np.searchsorted(ordered, values, side="right")
+    percentiles = (left + right + (right > left)) * 50.0 / len(values)
+    return np.where(is_nan, 0.0, percentiles)
+
+
+def generate_percentiles(
+    tests_df,
+    metric_cols,
+    competitiveness_threshold=0.55,
+    min_districts=7,
+    min_year=1972,
+):
+    """
+    batched equivalent of gerrymetrics.generate_percentiles
+
+    returns the rows of tests_df (from run_all_tests) with a weighted_voteshare
+    strictly within competitiveness_threshold of 0 and 1, at least min_districts
+    districts and a year of at least min_year, with the metric_cols replaced by the
+    percentile of their absolute value among these rows, see percentile_of_scores.
+    """
+    comp = tests_df[
+        (tests_df["weighted_voteshare"] < competitiveness_threshold)
+        & (tests_df["weighted_voteshare"] > 1 - competitiveness_threshold)
+    ]
+    comp = comp[comp["year"] >= min_year]
+    comp = comp[comp["ndists"] >= min_districts]
+
+    pctile = comp.copy()
+    for col in metric_cols:
+        pctile[col] = percentile_of_scores(comp[col].values)
+    return pctile
+
+
+def win_stats(df):
+    """
+    return a df indexed by (Year, State) with the columns avg_win_d, n_uncontested_d,
+    avg_win_r and n_uncontested_r
+
+    avg_win is the average voteshare of the party in the districts it won, "N/A"
+    where it won none, and n_uncontested counts the districts it won with all of the
+    two party vote. Voteshares are used as they are (not imputed). Expects df to be
+    sorted like read_results returns.
+    """
+    elections_df, offsets, voteshares = pack_voteshares(df)
+    d_won, n_d, n_r, win_voteshares = _win_split(voteshares, offsets)
+    uncontested = win_voteshares == 1
+    with np.errstate(all="ignore"):
+        avg_win_d = group_sum(win_voteshares, offsets, d_won) / n_d
+        avg_win_r = group_sum(win_voteshares, offsets, ~d_won) / n_r
+    win_df = pd.DataFrame(
+        {
+            "avg_win_d": pd.Series(avg_win_d, dtype=object).where(n_d > 0, "N/A"),
+            "n_uncontested_d": group_sum(
+                (uncontested & d_won).astype(np.int64), offsets
+            ),
+            "avg_win_r": pd.Series(avg_win_r, dtype=object).where(n_r > 0, "N/A"),
+            "n_uncontested_r": group_sum(
+                (uncontested & ~d_won).astype(np.int64), offsets
+            ),
+        }
+    )
+    win_df.index = pd.MultiIndex.from_frame(elections_df[["Year", "State"]])
+    return win_df
+
+
+def max_differences(tests_df, expected_tests_df):
+    """
+    return the largest absolute difference in each numeric column between a df from
+    run_all_tests and the gerrymetrics.tests_df for the same file, NaNs are treated
+    as equal to each other and as infinitely far from any number
+    """
+    columns = [col for col in tests_df.columns if col != "state"]
+    expected = expected_tests_df.loc[tests_df.index, columns].astype(np.float64)
+    differences = (tests_df[columns] - expected).abs()
+    both_nan = tests_df[columns].isnull() & expected.isnull()
+    return differences.mask(both_nan, 0).fillna(np.inf).max()
@@ -0,0 +1,111 @@
+"""
+Benchmark ccm.aggregate_votes against the previous idxmax/.loc implementation.
+
+Times both implementations on the MEDSL state office files for 2016 and 2018 and
+on synthetic files made by replicating the 2018 file with relabeled districts, and
+checks that both implementations return the same frame.
+
+Run from the root of the repository:
+    python -m benchmarks.aggregate_votes
+"""
+import time
+
+import pandas as pd
+
+import ccm
+
+MEDSL_FILE_PATHS = [
+    "election_data/MEDSL_data/stateoffices2016.csv",
+    "election_data/MEDSL_data/state_overall_2018.csv",
+]
+SCALES = [1, 2, 5, 10]
+REPEATS = 3
+
+
+def aggregate_votes_loop(df):
+    """
+    previous implementation of ccm.aggregate_votes, which resolves each candidate's
+    party with one .loc lookup per candidate
+    """
+    df = df.groupby(["State", "District", "candidate", "Party"])["candidatevotes"]
+    df = df.sum().reset_index()
+    party_map = df.groupby(["candidate", "State", "District"]).candidatevotes.idxmax()
+    party_map = party_map.reset_index()
+    many_party_df = df
+    df = df.groupby(["candidate", "State", "District"]).candidatevotes.sum()
+    df = df.reset_index()
+    df["party_index"] = party_map["candidatevotes"]
+    df["Party"] = df["party_index"].apply(
+        lambda party_idx: many_party_df.loc[party_idx].Party
+    )
+    df = df.drop(columns=["party_index"])
+    return df
+
+
+def load_medsl(file_path):
+    """
+    read a MEDSL file and rename the columns like ccm.conform_to_gerrymetrics does
+    """
+    df = pd.read_csv(file_path, encoding="utf-8-sig", low_memory=False)
+    df = df.rename(
+        columns={
+            "year": "Year",
+            "state_po": "State",
+            "district": "District",
+            "party": "Party",
+        }
+    )
+    df = df.fillna(value={"candidatevotes": 0})
+    df["District"] = df["District"].astype(str)
+    return df[["State", "District", "candidate", "Party", "mode", "candidatevotes"]]
+
+
+def scale_up(df, scale):
+    """
+    replicate df scale times, giving every copy its own set of districts
+    """
+    copies = []
+    for i in range(scale):
+        copy = df.copy()
+        copy["District"] = copy["District"] + "-{}".format(i)
+        copies.append(copy)
+    return pd.concat(copies, ignore_index=True)
+
+
+def best_time(method, df):
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = method(df)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def run():
+    cases = [(file_path, load_medsl(file_path)) for file_path in MEDSL_FILE_PATHS]
+    base_df = cases[-1][1]
+    cases += [
+        ("synthetic {}x 2018".format(scale), scale_up(base_df, scale))
+        for scale in SCALES[1:]
+    ]
+
+    print(
+        "{:<50} {:>9} {:>10} {:>12} {:>8}".format(
+            "input", "rows", "loop (s)", "vector (s)", "speedup"
+        )
+    )
+    for name, df in cases:
+        loop_time, expected = best_time(aggregate_votes_loop, df)
+        vector_time, result = best_time(ccm.aggregate_votes, df)
+        pd.testing.assert_frame_equal(
+            result.reset_index(drop=True), expected, check_dtype=False
+        )
+        print(
+            "{:<50} {:>9} {:>10.3f} {:>12.3f} {:>7.1f}x".format(
+                name, len(df), loop_time, vector_time, loop_time / vector_time
+            )
+        )
+
+
+if __name__ == "__main__":
+    run()
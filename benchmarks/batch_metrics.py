@@ -0,0 +1,73 @@
+"""
+Check batch_metrics.run_all_tests against gerrymetrics and time both.
+
+For every file in election_data/gerrymetrics_format/ and the post-1948
+congressional results, computes the run_gerrymetrics metrics with gerrymetrics
+and with batch_metrics, and reports the time taken by each, the largest absolute
+difference between them and the columns that differ by more than TOLERANCE.
+
+batch_metrics follows the scipy releases gerrymetrics was written against
+(scipy<1.7), newer releases changed the defaults of scipy.stats.mannwhitneyu and
+the small sample handling of scipy.stats.ttest_ind, so with a newer scipy expect
+non_parametric_p and t_test_p to be reported for some files.
+
+Run from the root of the repository:
+    python -m benchmarks.batch_metrics
+"""
+
+import time
+from os import listdir
+
+import gerrymetrics as g
+import numpy as np
+
+import batch_metrics as bm
+
+# same metrics as run_gerrymetrics.metric_dict
+METRICS = {
+    "t_test_p": g.t_test_p,
+    "mean_median_diff": g.mean_median,
+    "efficiency_gap": g.EG,
+    "partisan_bias": g.partisan_bias,
+    "non_parametric_p": g.mann_whitney_u_p,
+}
+ELECTIONS_DF_FPS = sorted(
+    "election_data/gerrymetrics_format/" + file_name
+    for file_name in listdir("election_data/gerrymetrics_format/")
+) + ["election_data/PGP_data/congressional_election_results_post1948.csv"]
+TOLERANCE = 1e-9
+
+
+def run():
+    np.seterr(all="ignore")
+    print(
+        "{:<75} {:>10} {:>9} {:>8} {:>10}  {}".format(
+            "input", "gm (s)", "batch (s)", "speedup", "max diff", "differing columns"
+        )
+    )
+    for elections_df_fp in ELECTIONS_DF_FPS:
+        start = time.perf_counter()
+        expected = g.tests_df(
+            g.run_all_tests(g.parse_results(elections_df_fp), metrics=METRICS)
+        )
+        gm_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        result = bm.run_all_tests(bm.read_results(elections_df_fp), metrics=METRICS)
+        batch_time = time.perf_counter() - start
+
+        differences = bm.max_differences(result, expected)
+        print(
+            "{:<75} {:>10.3f} {:>9.3f} {:>7.1f}x {:>10.1e}  {}".format(
+                elections_df_fp,
+                gm_time,
+                batch_time,
+                gm_time / batch_time,
+                differences.max(),
+                ", ".join(differences[differences > TOLERANCE].index),
+            )
+        )
+
+
+if __name__ == "__main__":
+    run()
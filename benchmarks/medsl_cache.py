@@ -0,0 +1,75 @@
+"""
+Compare reading the MEDSL csvs with pd.read_csv and through medsl_cache.
+
+For each MEDSL file reports the time and peak traced memory of pd.read_csv, of the
+first read through the cache (which parses the csv and writes the cache entry) and
+of later reads with object strings, with categoricals and memory-mapped.
+
+Run from the root of the repository:
+    python -m benchmarks.medsl_cache
+"""
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+import medsl_cache
+
+MEDSL_FILE_PATHS = [
+    "election_data/MEDSL_data/stateoffices2016.csv",
+    "election_data/MEDSL_data/state_overall_2018.csv",
+]
+
+
+def measure(method):
+    """
+    return the wall time in seconds and the peak traced memory in MB of method()
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    method()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak / 1e6
+
+
+def run():
+    print("{:<50} {:<28} {:>9} {:>10}".format("input", "read", "time (s)", "peak (MB)"))
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for file_path in MEDSL_FILE_PATHS:
+            reads = [
+                ("pd.read_csv", lambda: pd.read_csv(file_path, low_memory=False)),
+                (
+                    "cache (first read)",
+                    lambda: medsl_cache.read_medsl(file_path, cache_dir=cache_dir),
+                ),
+                (
+                    "cache (object strings)",
+                    lambda: medsl_cache.read_medsl(
+                        file_path, categorical=False, cache_dir=cache_dir
+                    ),
+                ),
+                (
+                    "cache (categoricals)",
+                    lambda: medsl_cache.read_medsl(file_path, cache_dir=cache_dir),
+                ),
+                (
+                    "cache (categoricals, mmap)",
+                    lambda: medsl_cache.read_medsl(
+                        file_path, mmap=True, cache_dir=cache_dir
+                    ),
+                ),
+            ]
+            for name, method in reads:
+                elapsed, peak = measure(method)
+                print(
+                    "{:<50} {:<28} {:>9.3f} {:>10.1f}".format(
+                        file_path, name, elapsed, peak
+                    )
+                )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,303 @@
+"""
+Time every stage of the clean -> conform -> metrics pipeline and save the timings.
+
+For every chamber of the cleaning scripts times the csv load, fix_method, clean_df,
+aggregate_votes, create_columns_for_party_votes and
+remove_states_with_third_party_wins, and for every file in
+election_data/gerrymetrics_format/ and the post-1948 congressional results times
+batch_metrics.read_results and the metric computation of
+run_gerrymetrics.get_gerry_data. Besides the bundled data, every input is run
+scaled up SCALES times: the MEDSL files with the state legislature rows copied into
+new districts, the gerrymetrics format files once with more districts per election
+and once with more years.
+
+The timings are written as JSON to --output, one record per stage and input with
+the best time of REPEATS runs and the rows going in and out of the stage, together
+with the versions of the libraries and the git commit they were measured on. Pass
+the file of an earlier run as --compare to print the stages which got slower.
+
+Run from the root of the repository:
+    python -m benchmarks.pipeline --output pipeline.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import batch_metrics as bm
+import ccm
+import cleanStateLeg2016
+import cleanStateLeg2018
+import run_gerrymetrics as rg
+
+CLEANING_SCRIPTS = [cleanStateLeg2016, cleanStateLeg2018]
+ELECTIONS_DF_FPS = sorted(
+    "election_data/gerrymetrics_format/" + file_name
+    for file_name in os.listdir("election_data/gerrymetrics_format/")
+) + ["election_data/PGP_data/congressional_election_results_post1948.csv"]
+SCALES = [1, 10, 100]
+REPEATS = 3
+
+# --compare reports stages at least this much slower than in the earlier run
+SLOWDOWN = 1.2
+
+
+def best_time(method, *args, repeats=REPEATS):
+    """
+    return the best wall time in seconds of repeats calls of method(*args) and the
+    result of the last call
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = method(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def scale_districts(df, scale, district_column):
+    """
+    replicate df scale times, giving every copy its own set of districts
+    """
+    if scale == 1:
+        return df
+    copies = []
+    for i in range(scale):
+        copy = df.copy()
+        copy[district_column] = copy[district_column].astype(str) + "-{}".format(i)
+        copies.append(copy)
+    return pd.concat(copies, ignore_index=True)
+
+
+def scale_years(df, scale):
+    """
+    replicate df scale times, moving every copy to its own set of years
+    """
+    if scale == 1:
+        return df
+    last_year = df.Year.max()
+    copies = []
+    for i in range(scale):
+        copy = df.copy()
+        copy["Year"] = copy["Year"] + i * (last_year + 1)
+        copies.append(copy)
+    return pd.concat(copies, ignore_index=True)
+
+
+def record(stage, name, scale, seconds, rows_in, rows_out):
+    return {
+        "stage": stage,
+        "input": name,
+        "scale": scale,
+        "seconds": seconds,
+        "rows_in": rows_in,
+        "rows_out": rows_out,
+    }
+
+
+def bench_cleaning(script, scale, tmp_dir, repeats):
+    """
+    return the records of the cleaning stages of every chamber of script, with the
+    state legislature rows of its MEDSL file scaled up scale times
+    """
+    offices = set().union(*[chamber["offices"] for chamber in script.chambers])
+    medsl_df = script.read_medsl()
+    medsl_df = scale_districts(
+        medsl_df[medsl_df.office.isin(offices)], scale, "district"
+    )
+    file_path = os.path.join(tmp_dir, "medsl.csv")
+    medsl_df.to_csv(file_path, index=False)
+    name = os.path.basename(script.MEDSL_FILE_PATH)
+
+    seconds, df = best_time(pd.read_csv, file_path, repeats=repeats)
+    records = [record("csv load", name, scale, seconds, len(df), len(df))]
+
+    for chamber in script.chambers:
+        excluded = set().union(*chamber["exclusion_dict"].values())
+        df = medsl_df[
+            medsl_df.office.isin(chamber["offices"]) & ~medsl_df.state_po.isin(excluded)
+        ].reset_index(drop=True)
+        # the sequence of ccm.run and ccm.conform_to_gerrymetrics
+        stages = [
+            ("fix_method", ccm.chamber_fix_method(chamber)),
+            ("clean_df", ccm.clean_df),
+            (
+                "rename",
+                lambda df: df.rename(
+                    columns={
+                        "year": "Year",
+                        "state_po": "State",
+                        "district": "District",
+                        "party": "Party",
+                    }
+                ),
+            ),
+            ("aggregate_votes", ccm.aggregate_votes),
+            ("create_columns_for_party_votes", ccm.create_columns_for_party_votes),
+            (
+                "remove_states_with_third_party_wins",
+                ccm.remove_states_with_third_party_wins,
+            ),
+        ]
+        for stage, method in stages:
+            seconds, result = best_time(method, df, repeats=repeats)
+            if stage != "rename":
+                records.append(
+                    record(stage, chamber["name"], scale, seconds, len(df), len(result))
+                )
+            df = result
+    return records
+
+
+def bench_metrics(name, districts_df, scale, tmp_dir, repeats):
+    """
+    return the records of reading and computing the metrics of districts_df, a df
+    in the gerrymetrics format
+    """
+    file_path = os.path.join(tmp_dir, "districts.csv")
+    districts_df.to_csv(file_path, index=False)
+    seconds, df = best_time(bm.read_results, file_path, repeats=repeats)
+    records = [record("read_results", name, scale, seconds, len(districts_df), len(df))]
+    seconds, result = best_time(
+        rg.compute_gerry_data,
+        df,
+        rg.impute_val,
+        rg.engine,
+        rg.n_resamples,
+        repeats=repeats,
+    )
+    records.append(record("metrics", name, scale, seconds, len(df), len(result)))
+    return records
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "engine": rg.engine,
+    }
+
+
+def compare(records, previous_records):
+    """
+    print the stages of records at least SLOWDOWN times slower than in
+    previous_records
+    """
+    previous = {
+        (r["stage"], r["input"], r["scale"]): r["seconds"] for r in previous_records
+    }
+    slower = [
+        (r, r["seconds"] / previous[(r["stage"], r["input"], r["scale"])])
+        for r in records
+        if (r["stage"], r["input"], r["scale"]) in previous
+    ]
+    slower = [(r, ratio) for r, ratio in slower if ratio >= SLOWDOWN]
+    print()
+    print(
+        "Stages at least {}x slower than the earlier run ({}):".format(
+            SLOWDOWN, len(slower)
+        )
+    )
+    for r, ratio in slower:
+        print(
+            "{:<36} {:<60} {:>5}x {:>6.2f}x".format(
+                r["stage"], r["input"], r["scale"], ratio
+            )
+        )
+
+
+def print_record(r):
+    print(
+        "{:<36} {:<60} {:>5}x {:>10} {:>10} {:>9.3f}".format(
+            r["stage"],
+            r["input"],
+            r["scale"],
+            r["rows_in"],
+            r["rows_out"],
+            r["seconds"],
+        )
+    )
+
+
+def run(scales=SCALES, repeats=REPEATS, output=None, previous=None):
+    np.seterr(all="ignore")
+    elections_dfs = {
+        os.path.basename(elections_df_fp): pd.read_csv(elections_df_fp)
+        for elections_df_fp in ELECTIONS_DF_FPS
+    }
+    print(
+        "{:<36} {:<60} {:>6} {:>10} {:>10} {:>9}".format(
+            "stage", "input", "scale", "rows in", "rows out", "time (s)"
+        )
+    )
+    records = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for scale in scales:
+            scale_records = []
+            for script in CLEANING_SCRIPTS:
+                scale_records += bench_cleaning(script, scale, tmp_dir, repeats)
+            for name, districts_df in elections_dfs.items():
+                scale_records += bench_metrics(
+                    name,
+                    scale_districts(districts_df, scale, "District"),
+                    scale,
+                    tmp_dir,
+                    repeats,
+                )
+                if scale > 1:
+                    scale_records += bench_metrics(
+                        name + " (years)",
+                        scale_years(districts_df, scale),
+                        scale,
+                        tmp_dir,
+                        repeats,
+                    )
+            for r in scale_records:
+                print_record(r)
+            records += scale_records
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(
+                {"environment": environment(), "repeats": repeats, "records": records},
+                f,
+                indent=2,
+            )
+    if previous is not None:
+        with open(previous) as f:
+            compare(records, json.load(f)["records"])
+    return records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="time every stage of the pipeline on the bundled data and on "
+        "scaled up synthetic data"
+    )
+    parser.add_argument(
+        "--scales", type=int, nargs="+", default=SCALES, help="input scales to run"
+    )
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument("--output", help="json file to write the timings to")
+    parser.add_argument("--compare", help="json file of an earlier run")
+    args = parser.parse_args()
+    run(args.scales, args.repeats, args.output, args.compare)
@@ -0,0 +1,420 @@
+import argparse
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+import batch_metrics as bm
+import ccm
+import cleanStateLeg2016
+import cleanStateLeg2018
+import cleanUSHORpost1948
+import medsl_cache
+import results_store
+import run_gerrymetrics as rg
+
+# Incremental rebuild of the pipeline:
+#   MEDSL csvs + fix rules -> election_data/gerrymetrics_format/ (cleaning scripts)
+#   PGP csv -> election_data/gerrymetrics_format/ (cleanUSHORpost1948.py)
+#   election_data/gerrymetrics_format/ + PGP csv -> exports/ (run_gerrymetrics.py)
+#
+# Every output file is made of groups of rows: the rows of one state for the
+# cleaning scripts, the row of one (State, Year) election for run_gerrymetrics. The
+# sha256 of the inputs of every group (its source rows, its fix rules, the code and
+# the parameters it was computed with) is saved in BUILD_STATE together with the
+# number of rows it produced. A build recomputes only the groups whose hash changed
+# and copies the lines of the other groups from the previous output file, so one
+# corrected candidate only rebuilds the rows of their state and the metrics of that
+# state. Files whose source files, code and parameters are unchanged are skipped
+# without reading them.
+
+BUILD_STATE = ".build_state.json"
+
+CLEANING_SCRIPTS = [cleanStateLeg2016, cleanStateLeg2018]
+CLEANING_CODE = ["ccm.py", "fix_rules.py"]
+METRICS_CODE = ["batch_metrics.py", "resampling.py", "run_gerrymetrics.py"]
+
+GERRYMETRICS_FORMAT_DIR = "election_data/gerrymetrics_format/"
+GERRYMETRICS_FORMAT_COLUMNS = [
+    "State",
+    "Year",
+    "District",
+    "Dem Votes",
+    "GOP Votes",
+    "D Voteshare",
+    "Incumbent",
+    "Party",
+]
+
+
+# Hashing methods
+
+
+def sha256(*parts):
+    """
+    return the sha256 hex digest of the str of every part
+    """
+    sha = hashlib.sha256()
+    for part in parts:
+        sha.update(str(part).encode())
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+
+def files_hash(file_paths):
+    """
+    return one sha256 hex digest of the contents of the files at file_paths
+    """
+    return sha256(*[medsl_cache.file_hash(file_path) for file_path in file_paths])
+
+
+def row_hashes(df):
+    """
+    return a uint64 hash of every row of df, independent of its index
+    """
+    return pd.util.hash_pandas_object(df, index=False).values
+
+
+def group_hash(hashes, *parts):
+    """
+    return the sha256 hex digest of the row hashes of a group and parts
+    """
+    return sha256(hashlib.sha256(hashes.tobytes()).hexdigest(), *parts)
+
+
+def metrics_parameters():
+    """
+    return the run_gerrymetrics parameters the exports are computed with
+    """
+    return {
+        "impute_val": rg.impute_val,
+        "min_year": rg.min_year,
+        "competitiveness_threshold": rg.competitiveness_threshold,
+        "min_districts": rg.min_districts,
+        "metrics": sorted(
+            (name, metric.__name__) for name, metric in rg.metric_dict.items()
+        ),
+        "engine": rg.engine,
+        "n_resamples": rg.n_resamples,
+        "ci_level": rg.ci_level,
+        "resampling_seed": rg.resampling_seed,
+        "resampled_metrics": sorted(
+            (name, metric.__name__) for name, metric in rg.resampled_metrics.items()
+        ),
+    }
+
+
+# Build state methods
+
+
+def read_build_state(build_state_path=BUILD_STATE):
+    if not os.path.exists(build_state_path):
+        return {}
+    with open(build_state_path) as f:
+        return json.load(f)
+
+
+def write_build_state(build_state, build_state_path=BUILD_STATE):
+    with open(build_state_path + ".tmp", "w") as f:
+        json.dump(build_state, f, indent=2, sort_keys=True)
+    os.replace(build_state_path + ".tmp", build_state_path)
+
+
+def is_up_to_date(build_state, output_path, inputs):
+    """
+    return True if output_path was built from inputs and was not modified since
+    """
+    entry = build_state.get(output_path)
+    return (
+        entry is not None
+        and entry["inputs"] == inputs
+        and os.path.exists(output_path)
+        and medsl_cache.file_hash(output_path) == entry["output"]
+    )
+
+
+def previous_lines(build_state, output_path):
+    """
+    return a dict of the group key to the csv lines of that group in the previous
+    build of output_path, empty if output_path was modified since
+    """
+    entry = build_state.get(output_path)
+    if (
+        entry is None
+        or not os.path.exists(output_path)
+        or medsl_cache.file_hash(output_path) != entry["output"]
+    ):
+        return {}
+    with open(output_path, newline="") as f:
+        lines = f.read().splitlines(keepends=True)[1:]
+    groups = {}
+    start = 0
+    for key, hash_, n_rows in entry["groups"]:
+        groups[tuple(key)] = (hash_, lines[start : start + n_rows])
+        start += n_rows
+    return groups
+
+
+def csv_lines(df):
+    return df.to_csv(index=False, header=False).splitlines(keepends=True)
+
+
+def write_groups(build_state, output_path, inputs, columns, groups):
+    """
+    write the csv lines of groups, a list of (key, hash, lines), to output_path
+    under a header of columns and record them in build_state
+    """
+    with open(output_path, "w", newline="") as f:
+        f.write(",".join(columns) + os.linesep)
+        for _, _, lines in groups:
+            f.writelines(lines)
+    build_state[output_path] = {
+        "inputs": inputs,
+        "output": medsl_cache.file_hash(output_path),
+        "groups": [[list(key), hash_, len(lines)] for key, hash_, lines in groups],
+    }
+
+
+def rebuild_groups(build_state, output_path, hashes, compute):
+    """
+    return a list of (key, hash, lines) for the groups in hashes, a dict of group key
+    to hash in output order, reusing the lines of unchanged groups and computing the
+    lines of the other groups with compute(keys), which returns a dict of key to lines
+    """
+    previous = previous_lines(build_state, output_path)
+    changed = [
+        key
+        for key, hash_ in hashes.items()
+        if key not in previous or previous[key][0] != hash_
+    ]
+    computed = compute(changed) if changed else {}
+    print(
+        "{}: rebuilt {} of {} groups {}".format(
+            output_path, len(changed), len(hashes), changed if changed else ""
+        )
+    )
+    return [
+        (key, hash_, computed[key] if key in computed else previous[key][1])
+        for key, hash_ in hashes.items()
+    ]
+
+
+# Stage methods
+
+
+def state_config(chamber, state):
+    """
+    return the JSON of the settings of chamber which the cleaned rows of state
+    depend on: its offices, its multi-member method and the exclusions listing it
+    """
+    return json.dumps(
+        {
+            "offices": sorted(chamber["offices"]),
+            "multi_member": (chamber.get("multi_member") or {}).get(state),
+            "exclusions": sorted(
+                reason
+                for reason, states in chamber["exclusion_dict"].items()
+                if state in states
+            ),
+        }
+    )
+
+
+def build_chamber(build_state, df, chamber, code_hash):
+    """
+    rebuild the states of chamber whose MEDSL rows or fix rules changed, see
+    ccm.run_chamber
+    """
+    output_path = GERRYMETRICS_FORMAT_DIR + chamber["name"] + ".csv"
+    df = df[df.office.isin(chamber["offices"])]
+    excluded = set().union(*chamber["exclusion_dict"].values())
+    df = df[~df.state_po.isin(excluded)]
+    rules = None
+    if chamber["fix_rules"] is not None:
+        rules = pd.read_csv(chamber["fix_rules"], dtype=str)
+
+    hashes = {}
+    for state, state_df in df.groupby("state_po", sort=True, observed=True):
+        state_rules = ""
+        if rules is not None:
+            state_rules = rules[
+                rules.state_po.isnull() | (rules.state_po == state)
+            ].to_csv(index=False)
+        hashes[(state,)] = group_hash(
+            row_hashes(state_df), state_rules, state_config(chamber, state), code_hash
+        )
+
+    def compute(keys):
+        computed = {}
+        for (state,) in keys:
+            fix_method = ccm.chamber_fix_method(chamber, [state])
+            state_df = ccm.clean_and_conform(
+                df[df.state_po == state],
+                fix_method,
+                multi_member=chamber.get("multi_member"),
+            )
+            computed[(state,)] = csv_lines(state_df)
+        return computed
+
+    return rebuild_groups(build_state, output_path, hashes, compute)
+
+
+def build_cleaning_script(build_state, script, force=False):
+    """
+    rebuild the chambers of a cleaning script whose inputs changed
+    """
+    code_hash = files_hash(CLEANING_CODE)
+    df = None
+    for chamber in script.chambers:
+        output_path = GERRYMETRICS_FORMAT_DIR + chamber["name"] + ".csv"
+        source_paths = [script.MEDSL_FILE_PATH, script.__file__]
+        if chamber["fix_rules"] is not None:
+            source_paths.append(chamber["fix_rules"])
+        inputs = sha256(files_hash(source_paths), code_hash)
+        if not force and is_up_to_date(build_state, output_path, inputs):
+            print("{}: up to date".format(output_path))
+            continue
+
+        if df is None:
+            df = script.read_medsl()
+        groups = build_chamber({} if force else build_state, df, chamber, code_hash)
+        write_groups(
+            build_state, output_path, inputs, GERRYMETRICS_FORMAT_COLUMNS, groups
+        )
+
+
+def build_us_house(build_state, force=False):
+    """
+    rebuild the US House files of cleanUSHORpost1948 if the PGP csv changed
+    """
+    inputs = files_hash([cleanUSHORpost1948.PGP_FILE_PATH, cleanUSHORpost1948.__file__])
+    df = None
+    for election_year in cleanUSHORpost1948.election_years:
+        output_path = cleanUSHORpost1948.output_file_path(election_year)
+        if not force and is_up_to_date(build_state, output_path, inputs):
+            print("{}: up to date".format(output_path))
+            continue
+
+        if df is None:
+            df = pd.read_csv(cleanUSHORpost1948.PGP_FILE_PATH)
+        election_year_df = cleanUSHORpost1948.clean_election_year(df, election_year)
+        print("{}: rebuilt".format(output_path))
+        write_groups(
+            build_state,
+            output_path,
+            inputs,
+            election_year_df.columns,
+            [(("all",), inputs, csv_lines(election_year_df))],
+        )
+
+
+def build_exports(build_state, elections_df_fp, force=False):
+    """
+    recompute the exported metrics of the (State, Year) elections of elections_df_fp
+    whose district results changed, see run_gerrymetrics.get_gerry_data
+    """
+    output_path = "exports/" + os.path.basename(elections_df_fp)
+    code_hash = sha256(files_hash(METRICS_CODE), json.dumps(metrics_parameters()))
+    inputs = sha256(files_hash([elections_df_fp]), code_hash)
+    if not force and is_up_to_date(build_state, output_path, inputs):
+        print("{}: up to date".format(output_path))
+        return
+
+    districts_df = bm.read_results(elections_df_fp)
+    elections_df, offsets, _ = bm.pack_voteshares(districts_df)
+    hashes = row_hashes(districts_df)
+    bounds = offsets.tolist() + [len(districts_df)]
+    elections = sorted(
+        (
+            (state, int(year)),
+            group_hash(hashes[start:stop], code_hash),
+            start,
+            stop,
+        )
+        for (year, state), start, stop in zip(
+            elections_df[["Year", "State"]].itertuples(index=False),
+            bounds[:-1],
+            bounds[1:],
+        )
+    )
+    rows = {key: (start, stop) for key, _, start, stop in elections}
+    columns = rg.gerry_data_columns(rg.n_resamples)
+
+    def compute(keys):
+        mask = pd.Series(False, index=districts_df.index)
+        for key in keys:
+            start, stop = rows[key]
+            mask.iloc[start:stop] = True
+        df = rg.compute_gerry_data(
+            districts_df[mask.values], rg.impute_val, rg.engine, rg.n_resamples
+        )
+        assert len(df) == len(keys)
+        return {
+            (state, int(year)): csv_lines(row_df[columns])
+            for (state, year), row_df in df.groupby(["State", "Year"], sort=False)
+        }
+
+    groups = rebuild_groups(
+        {} if force else build_state,
+        output_path,
+        {key: hash_ for key, hash_, _, _ in elections},
+        compute,
+    )
+    write_groups(build_state, output_path, inputs, columns, groups)
+
+
+def build_store(build_state, conn, elections_df_fp):
+    """
+    write the exported metrics and the district results of elections_df_fp to the
+    results store if its export changed since it was written, see results_store.py
+    """
+    output_path = "exports/" + os.path.basename(elections_df_fp)
+    chamber = results_store.chamber_name(elections_df_fp)
+    version = build_state[output_path]["output"]
+    if results_store.chamber_version(conn, chamber) == version:
+        print("{}: up to date in {}".format(chamber, results_store.STORE_PATH))
+        return
+
+    metrics_df = pd.read_csv(output_path)
+    results_store.write_chamber(
+        conn, chamber, metrics_df, bm.read_results(elections_df_fp), version
+    )
+    print("{}: written to {}".format(chamber, results_store.STORE_PATH))
+
+
+def build(force=False, build_state_path=BUILD_STATE):
+    """
+    rebuild every output of the pipeline whose inputs changed since the last build,
+    everything if force
+    """
+    build_state = read_build_state(build_state_path)
+    try:
+        for script in CLEANING_SCRIPTS:
+            build_cleaning_script(build_state, script, force)
+        build_us_house(build_state, force)
+        elections_df_fps = [
+            GERRYMETRICS_FORMAT_DIR + file_name
+            for file_name in sorted(os.listdir(GERRYMETRICS_FORMAT_DIR))
+        ] + [cleanUSHORpost1948.PGP_FILE_PATH]
+        for elections_df_fp in elections_df_fps:
+            build_exports(build_state, elections_df_fp, force)
+        conn = results_store.connect()
+        try:
+            for elections_df_fp in elections_df_fps:
+                build_store(build_state, conn, elections_df_fp)
+        finally:
+            conn.close()
+    finally:
+        write_build_state(build_state, build_state_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="rebuild the outputs of the pipeline whose inputs changed"
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="rebuild every output from scratch"
+    )
+    args = parser.parse_args()
+    build(force=args.force)
@@ -1,4 +1,17 @@
+import contextlib
+import difflib
+import multiprocessing
+import os
+import re
+import sys
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+import pandas as pd
+
+import fix_rules
+import instrumentation
 
 state_po_set = {
     "AK",
@@ -55,6 +68,84 @@ state_po_set = {
 
 # CCM: Clean and Confrom MEDSL (to the data schema expected by gerrymetrics)
 
+# Data reading methods
+
+# columns identifying the rows of a MEDSL df whose votes can be summed without
+# changing the output of run, see read_medsl_chunked
+MEDSL_KEY_COLUMNS = [
+    "year",
+    "state_po",
+    "office",
+    "district",
+    "candidate",
+    "party",
+    "mode",
+]
+
+# placeholder for missing labels while grouping, groupby drops missing labels
+MISSING_LABEL = "<missing>"
+
+
+def sum_votes(df, keys, aggregations={"candidatevotes": "sum"}):
+    """
+    return a df with one row for every combination of the keys columns in df and
+    the columns of df in aggregations aggregated over those rows
+
+    Unlike groupby, keeps the rows of missing labels, which are left missing.
+    """
+    df = df[keys + list(aggregations)].copy()
+    for col in keys:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].cat.add_categories([MISSING_LABEL])
+    df = (
+        df.fillna({col: MISSING_LABEL for col in keys})
+        .groupby(keys, sort=False, observed=True)
+        .agg(aggregations)
+        .reset_index()
+    )
+    for col in keys:
+        if not pd.api.types.is_numeric_dtype(df[col]):
+            df[col] = df[col].astype(object).replace(MISSING_LABEL, np.nan)
+    return df
+
+
+def read_medsl_chunked(
+    file_path, offices=None, states=None, transform=lambda x: x, chunksize=500000
+):
+    """
+    return the MEDSL csv at file_path with one row per MEDSL_KEY_COLUMNS combination,
+    summing candidatevotes, reading chunksize rows at a time
+
+    Only the rows of offices and states (all when None) are kept, transform is
+    applied to every chunk after filtering and must act row by row, e.g. renaming
+    parties. Memory is bounded by the number of candidates of every district instead
+    of the number of rows, so precinct level files can be read. The df has the
+    MEDSL_KEY_COLUMNS, candidatevotes and totalvotes (the largest of the rows)
+    columns, and gives the same result as the full csv with run or
+    clean_and_conform.
+    """
+    aggregations = {"candidatevotes": "sum", "totalvotes": "max"}
+    chunks = pd.read_csv(
+        file_path,
+        usecols=MEDSL_KEY_COLUMNS + list(aggregations),
+        dtype={col: str for col in MEDSL_KEY_COLUMNS if col != "year"},
+        chunksize=chunksize,
+    )
+    df = None
+    for chunk in chunks:
+        if offices is not None:
+            chunk = chunk[chunk.office.isin(offices)]
+        if states is not None:
+            chunk = chunk[chunk.state_po.isin(states)]
+        chunk = sum_votes(transform(chunk), MEDSL_KEY_COLUMNS, aggregations)
+        # fold the sums of the chunk into the running sums
+        if df is not None:
+            chunk = pd.concat([df, chunk], ignore_index=True)
+            chunk = sum_votes(chunk, MEDSL_KEY_COLUMNS, aggregations)
+        df = chunk
+    return df
+
+
 # Data exploration methods
 
 
@@ -78,7 +169,7 @@ def get_multi_district_candidates(df):
     Expects df to follow MEDSL schema.
     """
     candidate_df = (
-        df.groupby(["state", "candidate"])
+        df.groupby(["state", "candidate"], observed=True)
         .district.nunique()
         .reset_index()
         .rename(columns={"district": "n_districts"})
@@ -93,7 +184,9 @@ def get_no_party_winners(df):
 
     Expects df to follow MEDSL schema.
     """
-    winners_indices = df.groupby(["state", "district"]).candidatevotes.idxmax(axis=1)
+    winners_indices = df.groupby(
+        ["state", "district"], observed=True
+    ).candidatevotes.idxmax(axis=1)
     return df[df.index.isin(winners_indices) & df.party.isnull()]
 
 
@@ -107,9 +200,9 @@ def explore_third_parties(
     Expects df to follow MEDSL schema. Most useful when used on a dataframe
     containing one chamber at a time e.g. just state senate
     """
-    for state, group in df.groupby("state"):
+    for state, group in df.groupby("state", observed=True):
         total_votes = group.candidatevotes.sum()
-        party_votes = group.groupby("party").sum().reset_index()
+        party_votes = group.groupby("party", observed=True).sum().reset_index()
         for _, row in party_votes.iterrows():
             party = row.party
             vote_share = row.candidatevotes / total_votes
@@ -124,35 +217,252 @@ def get_n_district_by_state(df):
     Expects df to follow MEDSL schema. Most useful when used on a dataframe
     containing one chamber at a time e.g. just state senate
     """
-    return df.groupby("state").district.nunique().reset_index()
+    return df.groupby("state", observed=True).district.nunique().reset_index()
+
+
+def scan_anomalies(df, threshold=0.01, excluded_parties={"democrat", "republican"}):
+    """
+    return a df of data quality findings with the columns finding, year, state_po,
+    office, district, candidate, party, candidatevotes and value
+
+    Reports in one pass what the exploration methods above report separately, for
+    every year and office of df:
+    missing_party: candidate without a party label
+    multi_district_candidate: candidate in more than one district of an office,
+        one row per district, value is the number of districts
+    no_party_winner: candidate without a party label who recieved the most votes
+        in their district
+    third_party: party not in excluded_parties with a voteshare greater than
+        threshold in an office, value is the voteshare
+    n_districts: number of districts of an office, value is the number of districts
+
+    candidatevotes are summed across modes. The year, state_po, office, district,
+    candidate and party columns are the match columns of fix_rules, so findings can
+    be turned into fix rules (see fix_rules.draft_fix_rules).
+    Expects df to follow MEDSL schema.
+    """
+    keys = ["year", "state_po", "office", "district", "candidate", "party"]
+    election = ["year", "state_po", "office"]
+    contest = election + ["district"]
+
+    # aggregate votes cast by different modes
+    candidates = sum_votes(df, keys)
+    has_candidate = candidates.candidate.notnull()
+    findings = []
+
+    missing_party = (
+        candidates.party.isnull()
+        & has_candidate
+        & (candidates.candidate != "All Others")
+    )
+    findings.append(candidates[missing_party].assign(finding="missing_party"))
+
+    named = candidates[has_candidate]
+    n_districts = named.groupby(election + ["candidate"]).district.transform("nunique")
+    findings.append(
+        named[n_districts > 1].assign(
+            finding="multi_district_candidate", value=n_districts[n_districts > 1]
+        )
+    )
+
+    winners = candidates.sort_values(
+        "candidatevotes", ascending=False, kind="mergesort"
+    )
+    winners = winners.drop_duplicates(contest).sort_index()
+    # districts in which no candidate recieved votes have no winner
+    no_party_winners = winners.party.isnull() & (winners.candidatevotes > 0)
+    findings.append(winners[no_party_winners].assign(finding="no_party_winner"))
+
+    party_votes = candidates.groupby(election + ["party"]).candidatevotes.sum()
+    party_votes = party_votes.reset_index()
+    total_votes = candidates.groupby(election).candidatevotes.sum().rename("total")
+    party_votes = party_votes.join(total_votes, on=election)
+    party_votes["value"] = party_votes.candidatevotes / party_votes.total
+    third_parties = party_votes[
+        ~party_votes.party.isin(excluded_parties) & (party_votes.value > threshold)
+    ]
+    findings.append(third_parties.drop(columns="total").assign(finding="third_party"))
+
+    district_counts = candidates.groupby(election).district.nunique()
+    findings.append(
+        district_counts.rename("value").reset_index().assign(finding="n_districts")
+    )
+
+    return pd.concat(findings, ignore_index=True, sort=False)[
+        ["finding"] + keys + ["candidatevotes", "value"]
+    ]
+
+
+# blocks of match_candidates holding more candidates than this, i.e. very common
+# name tokens like "john", are not compared
+MAX_BLOCK_SIZE = 50
+
+# names found in more districts of an election than this are not people but
+# placeholders like "Under Votes" or "Write-ins", match_candidates ignores them
+MAX_CANDIDATE_DISTRICTS = 3
+
+
+def normalize_name(name):
+    """
+    return the lowercase letters of a candidate name as space separated tokens,
+    without accents, punctuation, nicknames in quotes or line breaks, e.g.
+    'Patricia "Pat" Little' -> 'patricia little'
+    """
+    name = re.sub(r'\s"[^"]*"', " ", name)
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+    return " ".join(re.findall(r"[a-z]+", name.lower()))
+
+
+def name_similarity(name_a, name_b):
+    """
+    return the similarity from 0 to 1 of two normalized names: the
+    difflib.SequenceMatcher ratio of the names or of their sorted tokens, whichever
+    is higher, so "capps michael" matches "michael capps"
+    """
+    return max(
+        difflib.SequenceMatcher(None, name_a, name_b).ratio(),
+        difflib.SequenceMatcher(
+            None, " ".join(sorted(name_a.split())), " ".join(sorted(name_b.split()))
+        ).ratio(),
+    )
+
+
+def match_candidates(
+    df,
+    threshold=0.9,
+    max_block_size=MAX_BLOCK_SIZE,
+    max_districts=MAX_CANDIDATE_DISTRICTS,
+):
+    """
+    return a df of pairs of candidates of the same election (year, state_po and
+    office) who may be the same person, with the columns year, state_po, office,
+    the district, candidate, party and candidatevotes of both candidates (suffixed
+    _a and _b, a received more votes) and score, ordered by score
+
+    Candidates are the (district, candidate) rows of every election with votes
+    summed across modes and parties and the party of their most votes, like
+    aggregate_votes combines them, so a pair is either a spelling variant in one
+    district or a candidate whose votes are split across districts. Names in more
+    than max_districts districts of an election are dropped. Only candidates
+    sharing a token of their normalize_name in the same election (a block) are
+    compared, blocks larger than max_block_size are skipped, and pairs with a
+    name_similarity of at least threshold are kept. See
+    fix_rules.draft_merge_rules to turn the pairs into fix rules.
+    Expects df to follow MEDSL schema.
+    """
+    election = ["year", "state_po", "office"]
+    keys = election + ["district", "candidate"]
+
+    candidates = sum_votes(df, keys + ["party"])
+    candidates = candidates[
+        candidates.candidate.notnull() & (candidates.candidate != "All Others")
+    ]
+    candidates = candidates.sort_values(
+        "candidatevotes", ascending=False, kind="mergesort"
+    )
+    totals = sum_votes(candidates, keys).candidatevotes
+    candidates = candidates.drop_duplicates(keys).assign(candidatevotes=totals.values)
+    candidates = candidates.sort_values(
+        "candidatevotes", ascending=False, kind="mergesort"
+    ).reset_index(drop=True)
+
+    names = candidates.candidate.unique()
+    normalized = dict(zip(names, map(normalize_name, names)))
+    candidates["name"] = candidates.candidate.map(normalized)
+    n_districts = candidates.groupby(election + ["name"]).district.transform("size")
+    candidates = candidates[n_districts <= max_districts].reset_index(drop=True)
+
+    # blocking index: one row per candidate and token of their name, initials are
+    # too common to block on
+    tokens = candidates.name.str.split().rename("token")
+    blocks = candidates[election].join(tokens.explode())
+    blocks = blocks[blocks.token.str.len() > 1].rename_axis("id").reset_index()
+    block_keys = election + ["token"]
+    sizes = blocks.groupby(block_keys).id.transform("size")
+    blocks = blocks[(sizes > 1) & (sizes <= max_block_size)]
+
+    pairs = blocks.merge(blocks, on=block_keys, suffixes=("_a", "_b"))
+    pairs = pairs[pairs.id_a < pairs.id_b].drop_duplicates(["id_a", "id_b"])
+    name_pairs = zip(
+        candidates.name.values[pairs.id_a.values],
+        candidates.name.values[pairs.id_b.values],
+    )
+    scores = np.array([name_similarity(a, b) for a, b in name_pairs])
+    pairs = pairs[scores >= threshold].assign(score=scores[scores >= threshold])
+
+    # order every pair so a has the most votes (candidates are sorted by votes)
+    columns = ["district", "candidate", "party", "candidatevotes"]
+    a = candidates.loc[pairs.id_a.values, election + columns].reset_index(drop=True)
+    b = candidates.loc[pairs.id_b.values, columns].reset_index(drop=True)
+    matches = pd.concat(
+        [a[election], a[columns].add_suffix("_a"), b.add_suffix("_b")], axis=1
+    )
+    matches["score"] = pairs.score.values
+    return matches.sort_values(
+        ["score"] + election, ascending=[False, True, True, True], kind="mergesort"
+    ).reset_index(drop=True)
 
 
 # Data cleaning methods
 
 
-def remove_invalid_states(df):
+def remap(values, mapping):
+    """
+    return the series values with the values in mapping replaced by what they map
+    to, as a remap of the categories when values is categorical
+
+    The categories of the result are sorted, see sort_categories.
+    """
+    if not isinstance(values.dtype, pd.CategoricalDtype):
+        return values.map(lambda x: mapping.get(x, x))
+    remapped = pd.Index([mapping.get(c, c) for c in values.cat.categories])
+    categories = remapped.unique().sort_values()
+    codes = values.cat.codes.to_numpy()
+    codes = np.where(codes >= 0, categories.get_indexer(remapped)[codes], -1)
+    return pd.Series(
+        pd.Categorical.from_codes(codes, categories),
+        index=values.index,
+        name=values.name,
+    )
+
+
+def sort_categories(df):
+    """
+    return df with the categories of its categorical columns sorted, so sorting by
+    their codes orders the rows like sorting the labels would
+
+    Grouping by categoricals with observed=True can leave the categories of the
+    result in order of appearance.
     """
-    remove states with any district in which no candidates recieved votes
+    df = df.copy()
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].cat.reorder_categories(
+                df[col].cat.categories.sort_values()
+            )
+    return df
+
+
+def remove_invalid_states(df, sink=instrumentation.print_event):
+    """
+    remove states with any district in which no candidates recieved votes, reporting
+    them to sink (see instrumentation)
 
     Expects df to follow MEDSL schema. Most useful when used on a dataframe
     containing one chamber at a time e.g. just state senate
     """
-    valid_states = {
-        state
-        for state, state_groups in df.groupby("state_po")
-        if state_groups.groupby("district")["candidatevotes"].sum().min() > 0
-    }
-    invalid_states = set(df.state_po.unique()).difference(valid_states)
+    district_votes = df.groupby(["state_po", "district"], observed=True)[
+        "candidatevotes"
+    ].sum()
+    min_votes = district_votes.groupby(level="state_po", observed=True).min()
+    valid_states = set(min_votes.index[min_votes > 0])
+    invalid_states = set(df.state_po.dropna().unique()).difference(valid_states)
     if invalid_states:
-        print(
-            "Invalid/incomplete data ({}): {}".format(
-                len(invalid_states), invalid_states
-            )
-        )
+        sink({"event": "invalid_states", "states": sorted(invalid_states)})
     return df[df.state_po.isin(valid_states)]
 
 
-def clean_df(df):
+def clean_df(df, sink=instrumentation.print_event):
     """
     remove special elections, remove provisional votes, cast votes as ints.
 
@@ -164,18 +474,23 @@ def clean_df(df):
     # remove provisional ballots
     df = df[df["mode"] != "provisional"]
     # democratic farmer labor party is the name of the democrat in Minnesota
-    df.party = df.party.apply(
-        lambda x: "democrat"
-        if x
-        in {
-            "democratic farmer labor",
-            "democratic-farmer-labor",
-            "democratic-npl",
-            "democrat&republican",
-        }
-        else x
+    df = df.assign(
+        party=remap(
+            df.party,
+            {
+                "democratic farmer labor": "democrat",
+                "democratic-farmer-labor": "democrat",
+                "democratic-npl": "democrat",
+                "democrat&republican": "democrat",
+            },
+        )
+    )
+    df = instrumentation.run_stage(
+        "remove_invalid_states",
+        lambda df: remove_invalid_states(df, sink),
+        df,
+        sink,
     )
-    df = remove_invalid_states(df)
     return df
 
 
@@ -192,56 +507,244 @@ def aggregate_votes(df):
     {'year':'Year', 'state_po':'State', 'district':'District', 'party':'Party'}
     """
     # aggregate votes cast by different modes
-    df = df.groupby(["State", "District", "candidate", "Party"]).sum().reset_index()
-    df = df[["State", "District", "Party", "candidate", "candidatevotes"]]
-
-    # Get the index of the party under which candidates recieved the most votes
-    party_map = df.groupby(["candidate", "State", "District"]).idxmax()
-    party_map = party_map.reset_index()
-    many_party_df = df
-
-    # combine votes for the same candidate which were cast under different party labels
-    df = df.groupby(["candidate", "State", "District"]).sum().reset_index()
-    df["party_index"] = party_map["candidatevotes"]
-    df["Party"] = df["party_index"].apply(
-        lambda party_idx: many_party_df.loc[party_idx].Party
+    df = (
+        df.groupby(["State", "District", "candidate", "Party"], observed=True)[
+            "candidatevotes"
+        ]
+        .sum()
+        .reset_index()
     )
-    df = df.drop(columns=["party_index"])
+
+    # order each candidate's rows so the party under which they recieved the most
+    # votes comes first, ties go to the first party label alphabetically
+    df = sort_categories(df).sort_values(
+        ["candidate", "State", "District", "candidatevotes", "Party"],
+        ascending=[True, True, True, False, True],
+    )
+
+    # combine votes for the same candidate which were cast under different party
+    # labels, keeping the dominant party label: the label of the first row (groupby
+    # "first" would take the labels of a categorical Party one group at a time). The
+    # rows of a candidate are consecutive, so their totals are sums of runs of rows
+    keys = ["candidate", "State", "District"]
+    first = ~df.duplicated(keys).values
+    votes = df["candidatevotes"].values
+    totals = np.add.reduceat(votes, np.flatnonzero(first)) if len(df) else votes
+    df = df[first][keys + ["Party"]].reset_index(drop=True)
+    df.insert(3, "candidatevotes", totals.astype(votes.dtype))
     return df
 
 
 def create_columns_for_party_votes(df):
-    return df.pivot_table(
-        index=["State", "District"],
-        columns="Party",
-        values="candidatevotes",
-        fill_value=0,
-        aggfunc="max",
-    ).reset_index()
+    # the most votes of a candidate of every party in every district
+    df = (
+        df.groupby(["State", "District", "Party"], observed=True)["candidatevotes"]
+        .max()
+        .unstack(fill_value=0)
+        .astype(np.int64)
+    )
+    # observed categoricals may come out in order of appearance, sort the columns
+    # and rows like their labels, with plain column labels so columns can be added
+    df.columns = list(df.columns)
+    df = sort_categories(df[sorted(df.columns)].reset_index())
+    df = df.sort_values(["State", "District"]).reset_index(drop=True)
+    # a df of a single state may have no votes for one of the major parties
+    for party in ["democrat", "republican"]:
+        if party not in df.columns:
+            df[party] = 0
+    return df
+
 
+# Multi-member districts
+#
+# The multi_member dict of a chamber maps the states electing several members per
+# district to how the number of seats of a district is found:
+#
+#   n         every district elects n members, but districts split into single
+#             member subdistricts labelled with a letter (e.g. District 26A)
+#   "label"   the number of seats ends the district label, e.g. Belknap District 2 (4)
+#   "slate"   the largest number of candidates the democrats or republicans ran
+#   "office"  every office of a district is a seat of its own, e.g. the positions 1
+#             and 2 of Washington, the office is appended to the district label
+#
+# The k members of a district are the k candidates with the most votes. Seat i of
+# the district (from 0) pairs the i-th democrat with the (k - 1 - i)-th republican,
+# both ranked by votes, so the democrats win seat i when they won more than i of
+# the k seats: every seat is a two candidate contest and the metrics of single
+# member districts apply to seats unchanged.
 
-def remove_states_with_third_party_wins(df):
+SEATS_LABEL_PATTERN = r"\((\d+)\)\s*$"
+SUBDISTRICT_PATTERN = r"\d+[A-Za-z]$"
+
+
+def label_offices(df, multi_member):
+    """
+    return df with the office appended to the District of the rows of the "office"
+    states of multi_member, see Multi-member districts
+    """
+    office_states = [s for s, method in multi_member.items() if method == "office"]
+    in_states = df.State.isin(office_states).values
+    if not in_states.any():
+        return df
+    districts = df.District.astype(object).values.copy()
+    districts[in_states] = (
+        df.District[in_states].astype(str) + ", " + df.office[in_states].astype(str)
+    ).values
+    return df.assign(District=pd.Categorical(districts))
+
+
+def district_seats(df, multi_member):
+    """
+    return the number of seats of the district of every row of df, an
+    aggregate_votes df of states of multi_member, see Multi-member districts
+    """
+    seats = np.ones(len(df), dtype=np.int64)
+    states = df.State.astype(str).values
+    districts = df.District.astype(str)
+    for state, method in multi_member.items():
+        in_state = states == state
+        if not in_state.any():
+            continue
+        state_districts = districts[in_state]
+        if method == "label":
+            labelled = state_districts.str.extract(SEATS_LABEL_PATTERN, expand=False)
+            seats[in_state] = labelled.astype(float).fillna(1).values
+        elif method == "slate":
+            major = in_state & df.Party.isin(["democrat", "republican"]).values
+            slates = pd.DataFrame(
+                {"District": districts[major], "Party": df.Party[major].astype(str)}
+            ).value_counts()
+            largest = slates.groupby(level="District").max()
+            seats[in_state] = state_districts.map(largest).fillna(1).values
+        elif isinstance(method, int):
+            single = state_districts.str.contains(SUBDISTRICT_PATTERN).values
+            seats[in_state] = np.where(single, 1, method)
+        elif method != "office":
+            raise ValueError(
+                "Unknown multi-member method {!r} of {}".format(method, state)
+            )
+    return seats
+
+
+def group_ranks(groups, values):
+    """
+    return the rank of every value among the values of its group, 0 for the
+    largest, ties ranked in order of position
+    """
+    order = np.lexsort((-values, groups))
+    sorted_groups = groups[order]
+    ranks = np.empty(len(groups), dtype=np.int64)
+    ranks[order] = np.arange(len(groups)) - np.searchsorted(
+        sorted_groups, sorted_groups
+    )
+    return ranks
+
+
+def seat_contests(df, seats):
+    """
+    return (seats_df, third_party_states, empty_seats): the State, District,
+    democrat and republican votes of every seat of the districts of df, an
+    aggregate_votes df, the states in which a third party candidate won a seat and
+    the (State, District) of the seats without a democrat or republican candidate
+
+    seats are the number of seats of the district of every row of df, see
+    district_seats. The seats of a district with k > 1 seats are labelled
+    "{District}, seat {1 to k}". The winners of all districts are found at once by
+    ranking the candidates of every district, and of every party in it, by votes.
+    Seats without a candidate of either party, where a district has fewer
+    candidates than seats, have no voteshare and are left out of seats_df.
+    """
+    states = df.State.astype(str).values
+    contest, contests = pd.MultiIndex.from_arrays(
+        [states, df.District.astype(str).values]
+    ).factorize(sort=True)
+    is_dem = (df.Party == "democrat").values
+    is_major = is_dem | (df.Party == "republican").values
+    votes = df.candidatevotes.to_numpy(np.int64)
+    rank = group_ranks(contest, votes)
+    party_rank = group_ranks(contest * 3 + np.where(is_major, ~is_dem, 2), votes)
+    third_party_states = set(states[(rank < seats) & ~is_major])
+
+    # one row per seat of every contest, in order of contest and seat
+    contest_seats = np.zeros(len(contests), dtype=np.int64)
+    contest_seats[contest] = seats
+    starts = np.cumsum(contest_seats) - contest_seats
+    seat_contest = np.repeat(np.arange(len(contests)), contest_seats)
+    seat = np.arange(len(seat_contest)) - starts[seat_contest]
+
+    kept = is_major & (party_rank < seats)
+    seat_of_row = np.where(is_dem, party_rank, seats - 1 - party_rank)
+    positions = starts[contest[kept]] + seat_of_row[kept]
+    party_votes = {}
+    for party, in_party in [("democrat", is_dem[kept]), ("republican", ~is_dem[kept])]:
+        party_votes[party] = np.zeros(len(seat), np.int64)
+        party_votes[party][positions[in_party]] = votes[kept][in_party]
+    contested = np.zeros(len(seat), dtype=bool)
+    contested[positions] = True
+
+    districts = pd.Series(contests.get_level_values(1)[seat_contest])
+    labels = districts + ", seat " + pd.Series(seat + 1).astype(str)
+    seats_df = pd.DataFrame(
+        {
+            "State": contests.get_level_values(0)[seat_contest],
+            "District": np.where(contest_seats[seat_contest] > 1, labels, districts),
+            "democrat": party_votes["democrat"],
+            "republican": party_votes["republican"],
+        }
+    )
+    empty_seats = list(
+        seats_df[~contested][["State", "District"]].itertuples(index=False, name=None)
+    )
+    return seats_df[contested].reset_index(drop=True), third_party_states, empty_seats
+
+
+def remove_states_with_third_party_wins(
+    df, sink=instrumentation.print_event, third_party_states=()
+):
+    """
+    remove the states in which a third party won a district of df, or which are in
+    third_party_states (e.g. found by seat_contests), reporting them to sink
+    """
     index_to_winning_party = (
         df.select_dtypes(include=np.number).idxmax(axis=1).reset_index()
     )
     removals = df[~index_to_winning_party[0].isin(["democrat", "republican"])]
-    states_to_remove = set(removals["State"].unique())
+    states_to_remove = set(removals["State"].unique()).union(third_party_states)
     if states_to_remove:
-        print(
-            "Third party wins ({}): {}".format(len(states_to_remove), states_to_remove)
-        )
+        sink({"event": "third_party_wins", "states": sorted(states_to_remove)})
     df = df[~df["State"].isin(states_to_remove)]
     return df
 
 
-def conform_to_gerrymetrics(df):
+def election_years(df):
     """
-    Transforms the MEDSL data format to the format that gerrymetrics expects: 
+    return a series of the year of the election of every State of df, with columns
+    renamed like aggregate_votes expects
+
+    The votes of a state are aggregated across its rows, so every state must have
+    the rows of one election year.
+    """
+    years = df.groupby(df["State"].astype(str), observed=True)["Year"].agg(
+        ["min", "max"]
+    )
+    mixed = years.index[years["min"] != years["max"]]
+    if len(mixed):
+        raise ValueError(
+            "States with the rows of several years: {}".format(list(mixed))
+        )
+    return years["max"].astype(np.int64)
+
+
+def conform_to_gerrymetrics(df, sink=instrumentation.print_event, multi_member=None):
+    """
+    Transforms the MEDSL data format to the format that gerrymetrics expects:
     State,Year,District,Dem Votes,GOP Votes,D Voteshare
 
     Expects a df with election results from one legislative chamber
-    e.g. State Senate in MEDSL schema format
+    e.g. State Senate in MEDSL schema format. The districts of the states of
+    multi_member become one row per seat, see Multi-member districts.
     """
+    multi_member = multi_member or {}
     # introduces the convention of the target format that gerrymetrics expects
     df = df.rename(
         columns={
@@ -251,58 +754,310 @@ def conform_to_gerrymetrics(df):
             "party": "Party",
         }
     )
-    df = aggregate_votes(df)
-    df = create_columns_for_party_votes(df)
-    df = remove_states_with_third_party_wins(df)
-    df["Year"] = 2016
+    state_years = election_years(df)
+    df = aggregate_votes(label_offices(df, multi_member))
+    seat_states = [s for s, method in multi_member.items() if method != "office"]
+    in_seat_states = df.State.isin(seat_states).values
+    third_party_states = set()
+    if in_seat_states.any():
+        multi_member_df = df[in_seat_states]
+        seats_df, third_party_states, empty_seats = seat_contests(
+            multi_member_df, district_seats(multi_member_df, multi_member)
+        )
+        if empty_seats:
+            sink(
+                {
+                    "event": "empty_seats",
+                    "seats": ["{} {}".format(*seat) for seat in empty_seats],
+                }
+            )
+        df = df[~in_seat_states]
+        frames = [] if df.empty else [create_columns_for_party_votes(df)]
+        df = pd.concat(frames + [seats_df], ignore_index=True, sort=False)
+        # both frames are sorted by District within each state
+        df = df.sort_values("State", kind="mergesort").reset_index(drop=True)
+    else:
+        df = create_columns_for_party_votes(df)
+    df = remove_states_with_third_party_wins(df, sink, third_party_states)
+    df["Year"] = state_years.reindex(df["State"].astype(str)).values
     df = df.rename(columns={"democrat": "Dem Votes", "republican": "GOP Votes"})
     df["D Voteshare"] = df["Dem Votes"] / (df["Dem Votes"] + df["GOP Votes"])
     df = df[["State", "Year", "District", "Dem Votes", "GOP Votes", "D Voteshare"]]
     df = df.astype({"Dem Votes": "int32", "GOP Votes": "int32"})
-    df['Incumbent'] = 0
-    df['Party'] = (df['Dem Votes'].gt(df['GOP Votes'])).apply(lambda is_dem: 'D' if is_dem else 'R')
+    df["Incumbent"] = 0
+    df["Party"] = np.where(df["Dem Votes"].gt(df["GOP Votes"]), "D", "R")
     return df
 
 
 # main method
 
 
-def run(df, name, fix_method=lambda x: x, exclusion_dict={}):
+def clean_and_conform(
+    df,
+    fix_method=lambda x: x,
+    sink=instrumentation.print_event,
+    profile_dir=None,
+    name=None,
+    multi_member=None,
+):
+    """
+    fix, clean and conform MEDSL election data to the gerrymetrics format
+
+    Expects df with MEDSL data schema. Every step treats the states of df
+    independently, so a df with the rows of one state gives the rows of that state.
+    Every step is reported to sink as a stage of name, see run. See
+    conform_to_gerrymetrics for multi_member.
+    """
+    stages = [
+        ("fix_method", fix_method),
+        ("clean_df", lambda df: clean_df(df, sink)),
+        (
+            "conform_to_gerrymetrics",
+            lambda df: conform_to_gerrymetrics(df, sink, multi_member),
+        ),
+    ]
+    for stage, method in stages:
+        df = instrumentation.run_stage(
+            stage, method, df, sink, profile_path(profile_dir, name, stage), name=name
+        )
+    return df
+
+
+def profile_path(profile_dir, name, stage):
+    """
+    return the path of the cProfile stats of stage of the run name in profile_dir,
+    None without profile_dir
+    """
+    if profile_dir is None:
+        return None
+    os.makedirs(profile_dir, exist_ok=True)
+    return os.path.join(profile_dir, "{}-{}.prof".format(name, stage))
+
+
+def chamber_fix_method(chamber, states=None, sink=instrumentation.print_event):
+    """
+    return a fix_method applying the fix rules of chamber, or only its rules for
+    states when given, reporting the rules matching no rows to sink, see run_chamber
+    """
+    if chamber["fix_rules"] is None:
+        return lambda x: x
+    rules = fix_rules.read_fix_rules(chamber["fix_rules"])
+    if states is not None:
+        rules = rules[rules.state_po.isnull() | rules.state_po.isin(states)]
+    return lambda df: fix_rules.apply_fix_rules(df, rules, sink)
+
+
+def run(
+    df,
+    name,
+    fix_method=lambda x: x,
+    exclusion_dict={},
+    sink=instrumentation.print_event,
+    profile_dir=None,
+    multi_member=None,
+):
     """
     clean and conform MEDSL election data to the gerrymetrics format
 
-    expects df with MEDSL data schema, fix_method should correct any known issues in 
+    expects df with MEDSL data schema, fix_method should correct any known issues in
+
+    Progress is reported as events to sink, by default printed for humans. Pass
+    instrumentation.null_sink to silence the run or instrumentation.json_lines_sink
+    to record the wall time, peak RSS delta and row counts of every stage as JSON.
+    With profile_dir every stage is also profiled with cProfile, and the stats are
+    saved as profile_dir/{name}-{stage}.prof. The districts of the states of
+    multi_member become one row per seat, see Multi-member districts.
     """
-    print()
-    print("Name: ", name)
-    print("Reasons for ommision: ")
-    print()
+    sink({"event": "run", "name": name})
 
     states_to_remove = set()
     for reason, states in exclusion_dict.items():
-        print("{} ({}): {}".format(reason, len(states), states))
+        sink(
+            {
+                "event": "exclusion",
+                "name": name,
+                "reason": reason,
+                "states": sorted(states),
+            }
+        )
         states_to_remove = states_to_remove.union(states)
-    if states_to_remove:
-        df = df[~df.state_po.isin(states_to_remove)]
+    df = instrumentation.run_stage(
+        "exclusion_filtering",
+        lambda df: df[~df.state_po.isin(states_to_remove)],
+        df,
+        sink,
+        profile_path(profile_dir, name, "exclusion_filtering"),
+        name=name,
+    )
 
     missing_states = state_po_set.difference(df.state_po.unique())
     missing_states = missing_states.difference(states_to_remove)
     if missing_states:
-        print(
-            "Not in MEDSL Dataset ({}): {}".format(len(missing_states), missing_states)
+        sink(
+            {"event": "missing_states", "name": name, "states": sorted(missing_states)}
         )
 
-    df = fix_method(df)
-    df = clean_df(df)
-    df = conform_to_gerrymetrics(df)
-    print()
+    df = clean_and_conform(df, fix_method, sink, profile_dir, name, multi_member)
 
-    print(df.head())
     states_included = set(df.State.unique())
-    print("States included ({}): {}".format(len(states_included), states_included))
-    print()
-    states_ommitted = state_po_set.difference(states_included)
-    print("States ommitted ({}): {}".format(len(states_ommitted), states_ommitted))
     file_path = "election_data/gerrymetrics_format/{}.csv".format(name)
-    print("Saving df to : ", file_path)
-    df.to_csv(file_path, index=False)
+    sink(
+        {
+            "event": "result",
+            "name": name,
+            "head": str(df.head()),
+            "states_included": sorted(states_included),
+            "states_ommitted": sorted(state_po_set.difference(states_included)),
+            "file_path": file_path,
+        }
+    )
+
+    def write(df):
+        df.to_csv(file_path, index=False)
+        return df
+
+    instrumentation.run_stage(
+        "csv_write",
+        write,
+        df,
+        sink,
+        profile_path(profile_dir, name, "csv_write"),
+        name=name,
+    )
+
+
+def run_chamber(
+    df, chamber, sink=instrumentation.print_event, profile_dir=None, rows=None
+):
+    """
+    run the rows of df for one legislative chamber
+
+    chamber is a dict with the keys name (of the output file), offices (the MEDSL
+    offices of the chamber), fix_rules (path of its fix rules csv or None) and
+    exclusion_dict, and optionally multi_member (see Multi-member districts), see
+    cleanStateLeg2018.py. rows are the positions of the rows of the chamber in df
+    (see partition_chambers), found from its offices when None.
+    Expects df with MEDSL data schema. See run for sink and profile_dir.
+    """
+    run(
+        df[df.office.isin(chamber["offices"])] if rows is None else df.iloc[rows],
+        chamber["name"],
+        chamber_fix_method(chamber, sink=sink),
+        chamber["exclusion_dict"],
+        sink,
+        profile_dir,
+        chamber.get("multi_member"),
+    )
+
+
+# Parallel methods
+
+# the MEDSL dfs of run_chambers, set before the worker processes are forked so the
+# workers read them from the memory of the parent instead of receiving a copy
+_sources = []
+
+
+def partition_chambers(df, chambers):
+    """
+    return the positions of the rows of df of every chamber of chambers (see
+    run_chamber) in ascending order, in one pass over the office column of df
+
+    Every office belongs to at most one chamber.
+    """
+    offices = df.office
+    if not isinstance(offices.dtype, pd.CategoricalDtype):
+        offices = offices.astype("category")
+    chamber_ids = {
+        office: i for i, chamber in enumerate(chambers) for office in chamber["offices"]
+    }
+    category_ids = [chamber_ids.get(office, -1) for office in offices.cat.categories]
+    # code -1 (missing office) indexes the appended -1
+    ids = np.array(category_ids + [-1], dtype=np.int64)[offices.cat.codes.values]
+    order = np.argsort(ids, kind="mergesort")
+    bounds = np.searchsorted(ids[order], np.arange(len(chambers) + 1))
+    return [order[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+class _Recorder:
+    """
+    sink and stdout of a worker of run_chambers, recording the events and printed
+    text of a job in order so the parent can replay them
+    """
+
+    def __init__(self):
+        self.log = []
+
+    def __call__(self, event):
+        self.log.append(("event", event))
+
+    def write(self, text):
+        self.log.append(("text", text))
+
+    def flush(self):
+        pass
+
+
+def _run_chamber_job(job):
+    source, chamber, rows, profile_dir = job
+    df = _sources[source] if isinstance(source, int) else source
+    recorder = _Recorder()
+    with contextlib.redirect_stdout(recorder):
+        run_chamber(df, chamber, recorder, profile_dir, rows)
+    return recorder.log
+
+
+def run_chambers(
+    sources, workers=1, sink=instrumentation.print_event, profile_dir=None
+):
+    """
+    run_chamber every chamber of sources, a list of (df, chambers) pairs, e.g. the
+    MEDSL df of a year and the chambers to clean from it
+
+    Every df is partitioned by chamber once, see partition_chambers, and every
+    chamber reports a chamber event to sink before its run. With workers > 1 the
+    chambers run in a pool of worker processes, forked after the dfs are loaded so
+    the workers share them with the parent (where processes can't be forked, every
+    worker receives the rows of its chamber instead). The events and printed output
+    of every chamber are replayed in order, so the output files and what is
+    reported are the same whatever the number of workers.
+    """
+    jobs = [
+        (source, chamber, rows)
+        for source, (df, chambers) in enumerate(sources)
+        for chamber, rows in zip(chambers, partition_chambers(df, chambers))
+    ]
+
+    def report(chamber):
+        sink({"event": "chamber", "name": chamber["name"], "title": chamber["title"]})
+
+    if workers <= 1:
+        for source, chamber, rows in jobs:
+            report(chamber)
+            run_chamber(sources[source][0], chamber, sink, profile_dir, rows)
+        return
+
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+        _sources[:] = [df for df, _ in sources]
+        worker_jobs = [
+            (source, chamber, rows, profile_dir) for source, chamber, rows in jobs
+        ]
+    else:
+        context = None
+        worker_jobs = [
+            (sources[source][0].iloc[rows], chamber, None, profile_dir)
+            for source, chamber, rows in jobs
+        ]
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            for (_, chamber, _), log in zip(
+                jobs, executor.map(_run_chamber_job, worker_jobs)
+            ):
+                report(chamber)
+                for kind, item in log:
+                    if kind == "event":
+                        sink(item)
+                    else:
+                        sys.stdout.write(item)
+    finally:
+        _sources.clear()
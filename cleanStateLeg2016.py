@@ -1,54 +1,14 @@
 #%%
-import pandas as pd
 import warnings
 
 import ccm
+import medsl_cache
 
 warnings.filterwarnings("ignore")
 
+MEDSL_FILE_PATH = "election_data/MEDSL_data/stateoffices2016.csv"
 
-def fix_upper_chamber(df):
-    """
-    fix the issues from the MEDSL data set pertaining to the 2016 election results
-    for upper chambers of state legislatures. Expects 2016 MEDSL results column names.
-    """
-
-    df["party"][
-        (df.state_po == "NV")
-        & (df.candidate.isin(['Patricia "Pat" Spearman', "Joyce Woodhouse"]))
-    ] = "democrat"
-    df["party"][
-        (df.state_po == "NV")
-        & (df.candidate.isin(['Arsen "Arsen T" Ter-Petrosyan', "Carrie Buck"]))
-    ] = "republican"
-
-    return df
-
-
-def fix_lower_chamber(df):
-    """
-    fix the issues from the MEDSL data set pertaining to the 2016 election results
-    for lower chambers of state legislatures. Expects 2016 MEDSL results column names.
-    """
-    return df
-
-
-df = pd.read_csv("election_data/MEDSL_data/stateoffices2016.csv")
-
-#### Data processing ####
 UPPER_OFFICES = ["State Senator", "State Senate"]
-upper_df = df[df["office"].isin(UPPER_OFFICES)]
-upper_name = "upper-chammber-state-legislature-elections-2016"
-upper_exclusion_dict = {
-    "No general election": {"VA", "NJ", "MS", "LA", "MI"},
-    "Multi-member districts": {"VT"},
-    "Dataset missing districts": {"AR"},
-    "Unicameral exclusion": {"NE"},
-}
-ccm.run(upper_df, upper_name, fix_upper_chamber, upper_exclusion_dict)
-
-print()
-print("Lower Chamber State Legislature Elections")
 LOWER_OFFICES = [
     "State Representative",
     "State Legislature",
@@ -64,11 +24,72 @@ LOWER_OFFICES = [
     "State Representative A",
     "State Representative B",
 ]
-lower_df = df[df["office"].isin(LOWER_OFFICES)]
-lower_name = "lower-chammber-state-legislature-elections-2016"
-lower_exclusion_dict = {
-    "No general election": {"VA", "MS", "LA", "NJ",},
-    "Multi-member districts": {"AZ", "ND", "NH", "SD", "VT", "WA", "WV"},
-    "Unicameral exclusion": {"NE"},
-}
-ccm.run(lower_df, lower_name, fix_lower_chamber, lower_exclusion_dict)
+
+# the legislative chambers cleaned by this script, see ccm.run_chamber
+chambers = [
+    {
+        "title": "Upper Chammber State Legislature Elections",
+        "name": "upper-chammber-state-legislature-elections-2016",
+        "offices": UPPER_OFFICES,
+        "fix_rules": "election_data/fix_rules/upper-chammber-state-legislature-elections-2016.csv",
+        "exclusion_dict": {
+            "No general election": {"VA", "NJ", "MS", "LA", "MI"},
+            "Multi-member districts": {"VT"},
+            "Dataset missing districts": {"AR"},
+            "Unicameral exclusion": {"NE"},
+        },
+    },
+    {
+        "title": "Lower Chamber State Legislature Elections",
+        "name": "lower-chammber-state-legislature-elections-2016",
+        "offices": LOWER_OFFICES,
+        "fix_rules": None,
+        "exclusion_dict": {
+            "No general election": {"VA", "MS", "LA", "NJ",},
+            "Multi-member districts": {"VT"},
+            "Unicameral exclusion": {"NE"},
+        },
+        # seats of the multi-member districts, see ccm.district_seats
+        "multi_member": {
+            "AZ": 2,
+            "ND": 2,
+            "NH": "label",
+            "SD": 2,
+            "WA": "office",
+            "WV": "slate",
+        },
+    },
+]
+
+
+def read_medsl():
+    """
+    return the 2016 MEDSL df
+    """
+    return medsl_cache.read_medsl(MEDSL_FILE_PATH)
+
+
+def selected_chambers(chamber_names=None):
+    """
+    return the chambers named in chamber_names (default: every chamber)
+    """
+    return [
+        chamber
+        for chamber in chambers
+        if chamber_names is None or chamber["name"] in chamber_names
+    ]
+
+
+def main(chamber_names=None, workers=1):
+    """
+    clean the chambers named in chamber_names (default: every chamber), in workers
+    processes
+    """
+    df = read_medsl()
+
+    #### Data processing ####
+    ccm.run_chambers([(df, selected_chambers(chamber_names))], workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,20 @@
 import pandas as pd
 
-df = pd.read_csv("election_data/PGP_data/congressional_election_results_post1948.csv")
+PGP_FILE_PATH = "election_data/PGP_data/congressional_election_results_post1948.csv"
 
 election_years = [2016, 2018]
 
-for election_year in election_years:
-    file_path = "election_data/gerrymetrics_format/us-house-of-representatives-{}.csv".format(
+
+def output_file_path(election_year):
+    return "election_data/gerrymetrics_format/us-house-of-representatives-{}.csv".format(
         election_year
     )
+
+
+def clean_election_year(df, election_year):
+    """
+    return the rows of the PGP df for election_year, with the known gaps filled in
+    """
     election_year_df = df[df.Year == election_year]
     if election_year == 2018:
         nc9_df = pd.DataFrame(
@@ -25,4 +32,20 @@ for election_year in election_years:
         )
         election_year_df = pd.concat([election_year_df, nc9_df], ignore_index=True)
     assert election_year_df.shape[0] == 435
-    election_year_df.to_csv(file_path, index=False)
+    return election_year_df
+
+
+def main(years=None):
+    """
+    write the cleaned PGP results of years (default: election_years)
+    """
+    df = pd.read_csv(PGP_FILE_PATH)
+
+    for election_year in election_years if years is None else years:
+        clean_election_year(df, election_year).to_csv(
+            output_file_path(election_year), index=False
+        )
+
+
+if __name__ == "__main__":
+    main()
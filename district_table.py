@@ -0,0 +1,207 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import batch_metrics as bm
+
+# Array-backed table of district results.
+#
+# A district table holds a results file in the gerrymetrics format as a dict of
+# contiguous typed numpy arrays, one value per district, sorted by (Year, State)
+# like batch_metrics.read_results:
+#
+#   year        int16
+#   state       int16 codes into states, a fixed width unicode array of the labels
+#   district    int32 codes into districts
+#   dem_votes   float64 (only when the file has the Dem Votes and GOP Votes
+#   gop_votes   float64  columns)
+#   voteshare   float64 D Voteshare
+#   offsets     int64, offsets[i]:offsets[i + 1] are the districts of the i-th
+#               (Year, State) election, see batch_metrics.pack_voteshares
+#
+# batch_metrics.pack_voteshares, and so run_all_tests, win_stats, the resampling
+# and seats-votes methods and run_gerrymetrics.compute_gerry_data, take a table
+# wherever they take a df. Slicing a table by election (slice_elections) gives
+# views, not copies, taking elections by index (take_elections) gives copies.
+#
+# Every value of a table is a numpy array, so a table can be saved as .npy files
+# and memory-mapped (save_table, load_table) or copied into one shared memory
+# block (share_table) which other processes attach to from a small picklable
+# descriptor (attach_table), without reading the csv or unpickling the districts.
+
+# byte alignment of the arrays of a shared memory block
+ALIGNMENT = 64
+
+
+def from_results(df):
+    """
+    return the district table of a df of district results sorted like
+    batch_metrics.read_results returns
+    """
+    _, offsets, voteshares = bm.pack_voteshares(df)
+    state_codes, states = pd.factorize(df["State"], sort=True)
+    district_codes, districts = pd.factorize(df["District"].astype(str), sort=True)
+    table = {
+        "year": df["Year"].to_numpy(np.int16),
+        "state": state_codes.astype(np.int16),
+        "states": np.asarray(states, dtype=str),
+        "district": district_codes.astype(np.int32),
+        "districts": np.asarray(districts, dtype=str),
+        "voteshare": voteshares,
+        "offsets": offsets.astype(np.int64),
+    }
+    if "Dem Votes" in df.columns:
+        table["dem_votes"] = df["Dem Votes"].to_numpy(np.float64)
+        table["gop_votes"] = df["GOP Votes"].to_numpy(np.float64)
+    return table
+
+
+def read_table(elections_df_fp, start_year=1948):
+    """
+    return the district table of a results file, see batch_metrics.read_results
+    """
+    return from_results(bm.read_results(elections_df_fp, start_year))
+
+
+def n_elections(table):
+    return len(table["offsets"]) - 1
+
+
+def slice_elections(table, start, stop):
+    """
+    return the table of the elections start to stop (exclusive) of table, as views
+    of its arrays
+    """
+    offsets = table["offsets"]
+    first, last = offsets[start], offsets[stop]
+    sliced = {
+        key: values[first:last]
+        for key, values in table.items()
+        if key not in {"states", "districts", "offsets"}
+    }
+    sliced["states"] = table["states"]
+    sliced["districts"] = table["districts"]
+    sliced["offsets"] = offsets[start : stop + 1] - first
+    return sliced
+
+
+def take_elections(table, elections):
+    """
+    return the table of the elections of table at the indices elections (in
+    increasing order), as copies of its arrays
+    """
+    offsets = table["offsets"]
+    elections = np.asarray(elections, dtype=np.int64)
+    starts = offsets[elections]
+    lengths = offsets[elections + 1] - starts
+    ends = np.cumsum(lengths)
+    rows = np.repeat(starts - (ends - lengths), lengths) + np.arange(
+        ends[-1] if len(ends) else 0
+    )
+    taken = {
+        key: values[rows]
+        for key, values in table.items()
+        if key not in {"states", "districts", "offsets"}
+    }
+    taken["states"] = table["states"]
+    taken["districts"] = table["districts"]
+    taken["offsets"] = np.r_[0, ends].astype(np.int64)
+    return taken
+
+
+def to_df(table):
+    """
+    return the districts of table as a df with the gerrymetrics columns State, Year,
+    District, Dem Votes, GOP Votes (when in table) and D Voteshare
+    """
+    df = pd.DataFrame(
+        {
+            "State": table["states"][table["state"]].astype(object),
+            "Year": table["year"].astype(np.int64),
+            "District": table["districts"][table["district"]].astype(object),
+        }
+    )
+    if "dem_votes" in table:
+        df["Dem Votes"] = table["dem_votes"]
+        df["GOP Votes"] = table["gop_votes"]
+    df["D Voteshare"] = table["voteshare"]
+    return df
+
+
+# Memory-mapped files
+
+
+def save_table(table, table_dir):
+    """
+    save table to table_dir as one .npy file per array
+    """
+    tmp_dir = table_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for key, values in table.items():
+        np.save(os.path.join(tmp_dir, key + ".npy"), values)
+    with open(os.path.join(tmp_dir, "table.json"), "w") as f:
+        json.dump(sorted(table), f)
+    shutil.rmtree(table_dir, ignore_errors=True)
+    os.rename(tmp_dir, table_dir)
+
+
+def load_table(table_dir, mmap=True):
+    """
+    load a table saved by save_table, with mmap as read-only views of the
+    memory-mapped files, which processes loading the same table share
+    """
+    with open(os.path.join(table_dir, "table.json")) as f:
+        keys = json.load(f)
+    return {
+        key: np.load(
+            os.path.join(table_dir, key + ".npy"), mmap_mode="r" if mmap else None
+        )
+        for key in keys
+    }
+
+
+# Shared memory
+
+
+def share_table(table):
+    """
+    return (block, descriptor): a multiprocessing.shared_memory.SharedMemory block
+    holding a copy of the arrays of table, and the picklable descriptor of the
+    arrays to pass to attach_table in other processes
+
+    The caller owns the block: keep it open while other processes use it, then
+    close and unlink it.
+    """
+    from multiprocessing import shared_memory
+
+    layout, size = [], 0
+    for key, values in table.items():
+        size = -(-size // ALIGNMENT) * ALIGNMENT
+        layout.append((key, values.dtype.str, values.shape, size))
+        size += values.nbytes
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for key, dtype, shape, offset in layout:
+        np.ndarray(shape, dtype, buffer=block.buf, offset=offset)[...] = table[key]
+    return block, {"name": block.name, "layout": layout}
+
+
+def attach_table(descriptor):
+    """
+    return (block, table): the shared memory block of a descriptor from share_table
+    and the table of read-only arrays backed by it, without copying
+
+    Keep the block open while using the table, then close it (don't unlink it).
+    """
+    from multiprocessing import shared_memory
+
+    block = shared_memory.SharedMemory(name=descriptor["name"])
+    table = {}
+    for key, dtype, shape, offset in descriptor["layout"]:
+        values = np.ndarray(shape, dtype, buffer=block.buf, offset=offset)
+        values.flags.writeable = False
+        table[key] = values
+    return block, table
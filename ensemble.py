@@ -0,0 +1,195 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import batch_metrics as bm
+import run_gerrymetrics as rg
+
+# Metrics of ensembles of simulated districting plans.
+#
+# An ensemble is a plans x districts matrix of Democratic votes and one of
+# Republican votes, every row holding the district vote totals of one plan. The
+# matrices can be in memory or memory mapped .npy files (np.load(fp,
+# mmap_mode="r")), they are read in chunks of plans holding at most MAX_ELEMENTS
+# districts. Every plan has the same number of districts, so a chunk is a ragged
+# array with evenly spaced offsets (see batch_metrics) and every metric of a chunk
+# is one batched call. The districts of every plan are sorted first, so medians
+# need no sort (the metrics don't depend on the order of the districts).
+#
+# compare_plan ranks the metrics of an enacted plan among those of the ensemble.
+
+MAX_ELEMENTS = 1 << 20
+
+
+def plan_voteshares(dem_votes, gop_votes=None):
+    """
+    return the D voteshares of a (n_plans, n_districts) chunk of an ensemble as
+    float64, dem_votes are taken as voteshares when gop_votes is None
+    """
+    dem_votes = np.asarray(dem_votes, dtype=np.float64)
+    if gop_votes is None:
+        return dem_votes
+    return dem_votes / (dem_votes + np.asarray(gop_votes, dtype=np.float64))
+
+
+def ensemble_metrics(
+    dem_votes,
+    gop_votes=None,
+    metrics=None,
+    impute_val=1,
+    max_elements=MAX_ELEMENTS,
+):
+    """
+    return a df with one row per plan of the ensemble and one column per metric of
+    metrics (default: run_gerrymetrics.metric_dict)
+
+    dem_votes and gop_votes are (n_plans, n_districts) arrays of the Democratic and
+    Republican votes of every district of every plan, e.g. memory mapped .npy
+    files. When gop_votes is None, dem_votes holds the D voteshares instead.
+    Voteshares are imputed like batch_metrics.run_all_tests does. Raises a
+    ValueError for plans with a district without votes (or a NaN voteshare), whose
+    metrics would be meaningless.
+    """
+    if metrics is None:
+        metrics = rg.metric_dict
+    n_plans, n_districts = dem_votes.shape
+    chunk_size = max(1, max_elements // max(n_districts, 1))
+    columns = {name: np.empty(n_plans) for name in metrics}
+    for start in range(0, n_plans, chunk_size):
+        stop = min(start + chunk_size, n_plans)
+        with np.errstate(all="ignore"):
+            voteshares = plan_voteshares(
+                dem_votes[start:stop],
+                None if gop_votes is None else gop_votes[start:stop],
+            )
+        invalid = np.isnan(voteshares).any(axis=1)
+        if invalid.any():
+            raise ValueError(
+                "Plans with districts without votes: {}".format(
+                    (start + np.flatnonzero(invalid)).tolist()
+                )
+            )
+        voteshares = np.sort(voteshares, axis=1).ravel()
+        if impute_val != 1:
+            voteshares = bm.impute(voteshares, impute_val)
+        offsets = np.arange(stop - start + 1) * n_districts
+        with np.errstate(all="ignore"):
+            for name, metric in metrics.items():
+                columns[name][start:stop] = bm.batched(metric)(voteshares, offsets)
+    return pd.DataFrame(columns, index=pd.RangeIndex(n_plans, name="plan"))
+
+
+def percentile_ranks(values, scores):
+    """
+    return the percentile rank of every score among the non NaN values: the
+    percentage of values below the score, counting ties as half below, like
+    scipy.stats.percentileofscore(kind="mean"), NaN for NaN scores
+    """
+    values = np.sort(np.asarray(values, dtype=np.float64))
+    values = values[~np.isnan(values)]
+    scores = np.asarray(scores, dtype=np.float64)
+    below = np.searchsorted(values, scores, side="left")
+    not_above = np.searchsorted(values, scores, side="right")
+    with np.errstate(all="ignore"):
+        ranks = (below + not_above) * 50.0 / len(values)
+    return np.where(np.isnan(scores), np.nan, ranks)
+
+
+def compare_plan(
+    enacted_dem_votes,
+    enacted_gop_votes,
+    dem_votes,
+    gop_votes=None,
+    metrics=None,
+    impute_val=1,
+    max_elements=MAX_ELEMENTS,
+):
+    """
+    return a df indexed by metric with the value of every metric of metrics for the
+    enacted plan (enacted), the mean, 2.5th and 97.5th percentiles of the metric
+    across the ensemble (ensemble_mean, ensemble_low and ensemble_high) and the
+    percentile rank of the enacted value in the ensemble (percentile)
+
+    enacted_dem_votes and enacted_gop_votes are the district votes of the enacted
+    plan, see ensemble_metrics for the rest. The ensemble's plans need not have the
+    same number of districts as the enacted plan.
+    """
+    enacted_gop_votes = (
+        None if enacted_gop_votes is None else np.asarray(enacted_gop_votes)[None]
+    )
+    enacted = ensemble_metrics(
+        np.asarray(enacted_dem_votes)[None], enacted_gop_votes, metrics, impute_val
+    ).iloc[0]
+    ensemble_df = ensemble_metrics(
+        dem_votes, gop_votes, metrics, impute_val, max_elements
+    )
+    with np.errstate(all="ignore"):
+        low, high = np.nanquantile(ensemble_df.values, [0.025, 0.975], axis=0)
+    return pd.DataFrame(
+        {
+            "enacted": enacted.values,
+            "ensemble_mean": ensemble_df.mean().values,
+            "ensemble_low": low,
+            "ensemble_high": high,
+            "percentile": np.array(
+                [
+                    float(percentile_ranks(ensemble_df[name].values, enacted[name]))
+                    for name in ensemble_df.columns
+                ]
+            ),
+        },
+        index=pd.Index(ensemble_df.columns, name="metric"),
+    )
+
+
+def enacted_votes(elections_df_fp, year, state):
+    """
+    return the Dem Votes and GOP Votes arrays of the districts of state in year of
+    a results file in the gerrymetrics format
+    """
+    df = bm.read_results(elections_df_fp)
+    df = df[(df["Year"] == year) & (df["State"] == state)]
+    if df.empty:
+        raise ValueError(
+            "No districts of {} in {} in {}".format(state, year, elections_df_fp)
+        )
+    return df["Dem Votes"].to_numpy(np.float64), df["GOP Votes"].to_numpy(np.float64)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="rank the metrics of an enacted plan among an ensemble of "
+        "districting plans"
+    )
+    parser.add_argument(
+        "dem_votes", help=".npy file of the plans x districts Democratic votes"
+    )
+    parser.add_argument(
+        "gop_votes", help=".npy file of the plans x districts Republican votes"
+    )
+    parser.add_argument(
+        "--results",
+        required=True,
+        help="results file in the gerrymetrics format holding the enacted plan",
+    )
+    parser.add_argument("--year", type=int, required=True)
+    parser.add_argument("--state", required=True)
+    parser.add_argument(
+        "--impute-val",
+        type=float,
+        default=1,
+        help="voteshare of uncontested races (default: 1, don't impute)",
+    )
+    parser.add_argument("--output", help="csv to write the comparison to")
+    args = parser.parse_args()
+
+    comparison_df = compare_plan(
+        *enacted_votes(args.results, args.year, args.state),
+        np.load(args.dem_votes, mmap_mode="r"),
+        np.load(args.gop_votes, mmap_mode="r"),
+        impute_val=args.impute_val,
+    )
+    print(comparison_df)
+    if args.output:
+        comparison_df.to_csv(args.output)
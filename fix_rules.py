@@ -0,0 +1,215 @@
+import numpy as np
+import pandas as pd
+
+import instrumentation
+
+# Corrections to the MEDSL data expressed as rules. Each rule matches the rows of a
+# MEDSL df whose year, state_po, office, district, candidate and party equal the
+# rule's (blank columns match anything) and applies one action:
+#   set     assign value to field
+#   append  append value to field, e.g. a seat letter to the district
+#   merge   sum the candidatevotes of all matched rows into the matched rows whose
+#           field equals value, and drop the other matched rows
+# Rules are matched against the uncorrected df, so a rule never sees the changes
+# made by another rule. Rules sharing the same set of match columns are matched
+# together with one join, when several set rules change the same field of the same
+# row the last rule wins.
+
+MATCH_COLUMNS = ["year", "state_po", "office", "district", "candidate", "party"]
+RULE_COLUMNS = MATCH_COLUMNS + ["action", "field", "value", "note"]
+ACTIONS = {"set", "append", "merge"}
+
+# the match column used to narrow down the rows of df before joining, most
+# selective first
+_PREFILTER_ORDER = ["candidate", "district", "office", "party", "state_po", "year"]
+
+
+def read_fix_rules(file_path):
+    """
+    read a csv of fix rules with the columns in RULE_COLUMNS, blank cells match anything
+    """
+    rules = pd.read_csv(file_path, dtype=str, keep_default_na=False, na_values=[""])
+    missing = set(RULE_COLUMNS).difference(rules.columns)
+    if missing:
+        raise ValueError("{} is missing the columns {}".format(file_path, missing))
+    unknown = set(rules.action).difference(ACTIONS)
+    if unknown:
+        raise ValueError(
+            "Unknown fix rule actions in {}: {}".format(file_path, unknown)
+        )
+    if rules[MATCH_COLUMNS].isnull().all(axis=1).any():
+        raise ValueError("Every fix rule in {} needs a match column".format(file_path))
+    return rules
+
+
+def _isin_str(values, labels):
+    """
+    return a boolean array of whether values, as strings, are in labels, looking up
+    the categories rather than every value of a categorical
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        is_label = values.cat.categories.astype(str).isin(labels)
+        # code -1 (missing) indexes the last element, which str(np.nan) decides
+        return np.append(is_label, str(np.nan) in labels)[values.cat.codes.values]
+    return values.astype(str).isin(labels).values
+
+
+def match_fix_rules(df, rules):
+    """
+    return a df with the columns row and rule, one row per (index of df, index of
+    rules) pair where the rule matches the row of df
+    """
+    matches = [pd.DataFrame({"row": [], "rule": []}, dtype=np.int64)]
+    used = rules[MATCH_COLUMNS].notnull()
+    for pattern, pattern_rules in rules.groupby([used[col] for col in MATCH_COLUMNS]):
+        columns = [col for col, is_used in zip(MATCH_COLUMNS, pattern) if is_used]
+        keys = pattern_rules[columns].rename_axis("rule").reset_index()
+
+        prefilter = next(col for col in _PREFILTER_ORDER if col in columns)
+        rows = df[columns][_isin_str(df[prefilter], set(keys[prefilter]))]
+        rows = rows.astype(str).rename_axis("row").reset_index()
+        matches.append(rows.merge(keys, on=columns)[["row", "rule"]])
+    return pd.concat(matches, ignore_index=True).sort_values(
+        ["rule", "row"], kind="mergesort"
+    )
+
+
+def unmatched_fix_rules(df, rules):
+    """
+    return the rules which match no rows of df
+    """
+    return rules[~rules.index.isin(match_fix_rules(df, rules).rule)]
+
+
+def _assign(df, rows, field, values):
+    """
+    assign values to field in the rows of df, adding the new labels of a
+    categorical field to its categories
+    """
+    if isinstance(df[field].dtype, pd.CategoricalDtype):
+        labels = pd.Index(values).dropna().unique()
+        new_labels = labels.difference(df[field].cat.categories)
+        if len(new_labels):
+            df[field] = df[field].cat.add_categories(new_labels)
+    df.loc[rows, field] = values
+
+
+def apply_fix_rules(df, rules, sink=instrumentation.print_event):
+    """
+    return a copy of df with the fix rules applied, reporting the rules which matched
+    no rows of df to sink as an unmatched_fix_rules event (see instrumentation)
+
+    Expects df to follow MEDSL schema, with a unique index. The columns of df can be
+    categoricals, new labels are added to their categories.
+    """
+    df = df.copy()
+    matches = match_fix_rules(df, rules)
+    unmatched = rules[~rules.index.isin(matches.rule)]
+    if len(unmatched):
+        unmatched = unmatched[MATCH_COLUMNS + ["action", "field", "value"]]
+        sink(
+            {
+                "event": "unmatched_fix_rules",
+                "rules": unmatched.astype(object)
+                .where(unmatched.notnull(), None)
+                .rename_axis("rule")
+                .reset_index()
+                .to_dict("records"),
+                "table": unmatched.to_string(),
+            }
+        )
+    matches = matches.join(rules[["action", "field", "value"]], on="rule")
+
+    merge_matches = matches[matches.action == "merge"]
+    votes = df.loc[merge_matches.row.values, "candidatevotes"].values
+    totals = pd.Series(votes).groupby(merge_matches.rule.values).sum()
+    keep = np.zeros(len(merge_matches), dtype=bool)
+    for field in merge_matches.field.unique():
+        in_field = (merge_matches.field == field).values
+        current = df.loc[merge_matches.row.values[in_field], field].astype(str)
+        keep[in_field] = current.values == merge_matches.value.values[in_field]
+    kept = merge_matches[keep]
+    df.loc[kept.row.values, "candidatevotes"] = totals[kept.rule.values].values
+
+    set_matches = matches[matches.action == "set"]
+    for field, group in set_matches.groupby("field"):
+        group = group.drop_duplicates("row", keep="last")
+        values = group.value
+        if pd.api.types.is_numeric_dtype(df[field]):
+            values = pd.to_numeric(values)
+        _assign(df, group.row.values, field, values.values)
+
+    append_matches = matches[matches.action == "append"]
+    for field, group in append_matches.groupby("field"):
+        current = df.loc[group.row.values, field].astype(str)
+        _assign(df, group.row.values, field, current.values + group.value.values)
+
+    # drop merged rows last so that every rule is applied to the rows it matched
+    df = df.drop(np.unique(merge_matches.row.values[~keep]))
+    return df
+
+
+def draft_fix_rules(report):
+    """
+    return a df of fix rule skeletons with the columns in RULE_COLUMNS for the
+    findings of ccm.scan_anomalies which can be corrected by a fix rule
+
+    missing_party and no_party_winner findings become set rules on party with a blank
+    value, multi_district_candidate findings become set rules on district with the
+    district the candidate was found in as value. Review and fill in the value of
+    every rule before saving it with to_csv(index=False).
+    """
+    party_findings = report.finding.isin(["missing_party", "no_party_winner"])
+    district_findings = report.finding == "multi_district_candidate"
+    rules = report[party_findings | district_findings].drop_duplicates(MATCH_COLUMNS)
+    rules = rules[MATCH_COLUMNS].assign(
+        action="set",
+        field=np.where(
+            rules.finding == "multi_district_candidate", "district", "party"
+        ),
+        value=np.where(rules.finding == "multi_district_candidate", rules.district, ""),
+        note=rules.finding,
+    )
+    return rules[RULE_COLUMNS].reset_index(drop=True)
+
+
+def draft_merge_rules(matches):
+    """
+    return a df of fix rules with the columns in RULE_COLUMNS combining the
+    candidate pairs of ccm.match_candidates
+
+    The row of candidate b gets a set rule on candidate to the name of candidate a
+    when the names differ, and a set rule on district to the district of candidate a
+    when the districts differ, so aggregate_votes sums the votes of the pair. Review
+    the pairs before saving the rules with to_csv(index=False): namesakes in
+    different districts are matched as well.
+    """
+    notes = [
+        "same candidate as {} in {}, score {:.2f}".format(candidate, district, score)
+        for candidate, district, score in zip(
+            matches.candidate_a, matches.district_a, matches.score
+        )
+    ]
+    rules = []
+    for field in ["candidate", "district"]:
+        differ = (matches[field + "_a"] != matches[field + "_b"]).values
+        pairs = matches[differ]
+        rules.append(
+            pd.DataFrame(
+                {
+                    "year": pairs.year.astype(str).values,
+                    "state_po": pairs.state_po.values,
+                    "office": pairs.office.values,
+                    "district": pairs.district_b.values,
+                    "candidate": pairs.candidate_b.values,
+                    "party": np.nan,
+                    "action": "set",
+                    "field": field,
+                    "value": pairs[field + "_a"].values,
+                    "note": np.array(notes, dtype=object)[differ],
+                },
+                index=pairs.index,
+            )
+        )
+    rules = pd.concat(rules).sort_index(kind="mergesort")
+    return rules[RULE_COLUMNS].reset_index(drop=True)
@@ -0,0 +1,210 @@
+import argparse
+import sys
+
+# Command line entry point of the pipeline:
+#
+#   python gerrygrade.py clean [--chamber NAME ...] [--workers N]
+#       MEDSL csvs + fix rules and the PGP csv -> election_data/gerrymetrics_format/
+#   python gerrygrade.py conform FILE --name NAME --office OFFICE [...]
+#       any MEDSL csv (e.g. a new precinct level release) without fix rules ->
+#       election_data/gerrymetrics_format/NAME.csv
+#   python gerrygrade.py metrics [FILE ...] [run_gerrymetrics.py options]
+#       election_data/gerrymetrics_format/ -> exports/, see run_gerrymetrics.py
+#   python gerrygrade.py build [--force] [--changelog PATH]
+#       all of the above, only recomputing what changed, see build.py, with the
+#       changelog of the outputs written to PATH, see output_diff.py
+#   python gerrygrade.py diff OLD NEW [--output PATH]
+#       the changelog of two versions of an output csv or directory of csvs
+#   python gerrygrade.py all
+#       clean, then metrics on every file
+#
+# The pipeline modules are imported by the commands using them, so --help and the
+# commands not needing pandas, scipy or gerrymetrics start quickly.
+
+US_HOUSE_CHAMBERS = {
+    "us-house-of-representatives-2016": 2016,
+    "us-house-of-representatives-2018": 2018,
+}
+
+
+def clean(chamber_names=None, workers=1):
+    """
+    run the cleaning scripts for the chambers named in chamber_names (default: every
+    chamber), running the state legislature chambers of every year in one pool of
+    workers processes, see ccm.run_chambers
+    """
+    import ccm
+    import cleanStateLeg2016
+    import cleanStateLeg2018
+    import cleanUSHORpost1948
+
+    sources = []
+    for script in [cleanStateLeg2016, cleanStateLeg2018]:
+        chambers = script.selected_chambers(chamber_names)
+        if chambers:
+            sources.append((script.read_medsl(), chambers))
+    ccm.run_chambers(sources, workers)
+    years = [
+        year
+        for name, year in US_HOUSE_CHAMBERS.items()
+        if chamber_names is None or name in chamber_names
+    ]
+    if years:
+        cleanUSHORpost1948.main(years)
+
+
+def chamber_names():
+    """
+    return the names of the chambers clean can run
+    """
+    import cleanStateLeg2016
+    import cleanStateLeg2018
+
+    return [
+        chamber["name"]
+        for script in [cleanStateLeg2016, cleanStateLeg2018]
+        for chamber in script.chambers
+    ] + list(US_HOUSE_CHAMBERS)
+
+
+def conform(file_path, name, offices, states=None):
+    """
+    conform the rows of offices (and states) of the MEDSL csv at file_path to the
+    gerrymetrics format as the chamber name, without fix rules or exclusions
+    """
+    import ccm
+
+    ccm.run(ccm.read_medsl_chunked(file_path, offices, states), name)
+
+
+def rebuild(force=False, changelog_path=None):
+    """
+    rebuild the outputs whose inputs changed, see build.py, writing the changelog of
+    the outputs to changelog_path when given
+    """
+    import build
+
+    if changelog_path is None:
+        build.build(force=force)
+        return
+
+    import tempfile
+
+    import output_diff
+
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        output_diff.snapshot_outputs(snapshot_dir)
+        build.build(force=force)
+        changelog = output_diff.diff_snapshot(snapshot_dir)
+    print(output_diff.summarize(changelog))
+    output_diff.write_changelog(changelog, changelog_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="gerrygrade",
+        description="clean election results and run gerrymetrics on them",
+    )
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    clean_parser = commands.add_parser(
+        "clean", help="clean the MEDSL and PGP results to the gerrymetrics format"
+    )
+    clean_parser.add_argument(
+        "--chamber",
+        action="append",
+        dest="chambers",
+        help="only clean this chamber, can be repeated (see --list)",
+    )
+    clean_parser.add_argument(
+        "--list", action="store_true", help="list the chambers and exit"
+    )
+    clean_parser.add_argument(
+        "--workers", type=int, default=1, help="number of worker processes"
+    )
+
+    conform_parser = commands.add_parser(
+        "conform", help="conform a MEDSL csv to the gerrymetrics format"
+    )
+    conform_parser.add_argument("file_path", help="MEDSL csv")
+    conform_parser.add_argument(
+        "--name", required=True, help="name of the gerrymetrics format csv"
+    )
+    conform_parser.add_argument(
+        "--office",
+        action="append",
+        dest="offices",
+        required=True,
+        help="MEDSL office of the chamber, can be repeated",
+    )
+    conform_parser.add_argument(
+        "--state",
+        action="append",
+        dest="states",
+        help="only conform this state, can be repeated",
+    )
+
+    # the arguments of metrics and diff are parsed by run_gerrymetrics.main and
+    # output_diff.main
+    commands.add_parser(
+        "metrics",
+        add_help=False,
+        help="run gerrymetrics, see gerrygrade metrics --help",
+    )
+
+    build_parser = commands.add_parser(
+        "build", help="rebuild the outputs whose inputs changed"
+    )
+    build_parser.add_argument(
+        "--force", action="store_true", help="rebuild every output from scratch"
+    )
+    build_parser.add_argument(
+        "--changelog",
+        help="write the changes of the outputs to this .csv or .json (JSON lines)",
+    )
+
+    commands.add_parser(
+        "diff",
+        add_help=False,
+        help="report the changes between two versions of the outputs, see "
+        "gerrygrade diff --help",
+    )
+
+    all_parser = commands.add_parser("all", help="clean, then run gerrymetrics")
+    all_parser.add_argument(
+        "--workers", type=int, default=1, help="number of worker processes"
+    )
+
+    args, command_args = parser.parse_known_args(argv)
+    if command_args and args.command not in {"metrics", "diff"}:
+        parser.error("unrecognized arguments: {}".format(" ".join(command_args)))
+    if args.command == "clean":
+        if args.list:
+            print("\n".join(chamber_names()))
+            return
+        unknown = set(args.chambers or []).difference(chamber_names())
+        if unknown:
+            parser.error("unknown chambers {}, see --list".format(sorted(unknown)))
+        clean(args.chambers, args.workers)
+    elif args.command == "conform":
+        conform(args.file_path, args.name, args.offices, args.states)
+    elif args.command == "metrics":
+        import run_gerrymetrics
+
+        run_gerrymetrics.main(command_args)
+    elif args.command == "build":
+        rebuild(args.force, args.changelog)
+    elif args.command == "diff":
+        import output_diff
+
+        output_diff.main(command_args)
+    elif args.command == "all":
+        import run_gerrymetrics
+
+        clean(workers=args.workers)
+        run_gerrymetrics.main(["--workers", str(args.workers)])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+import cProfile
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Instrumentation for ccm.run.
+#
+# ccm.run reports what it does as events: dicts with an "event" key and values
+# that can be serialized to JSON. Every stage of a run (exclusion filtering,
+# fix_method, clean_df, remove_invalid_states, conform_to_gerrymetrics and the csv
+# write) reports a "stage" event with its wall time, the change of the peak resident
+# set size of the process and its input and output row counts, the other events
+# report what the run decided e.g. which states were excluded and why or which fix
+# rules matched no rows, and ccm.run_chambers reports a "chamber" event before the
+# run of every chamber.
+# Events are passed to a sink, any callable taking an event: print_event prints
+# them in human readable form (the default), json_lines_sink writes them to a file
+# and null_sink drops them, e.g. for batch runs.
+
+
+def peak_rss():
+    """
+    return the peak resident set size of the process in bytes, None where unknown
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_stage(stage, method, df, sink, profile_path=None, **fields):
+    """
+    return method(df), reporting a stage event with fields to sink
+
+    With profile_path the call is profiled with cProfile and the stats are dumped to
+    profile_path, which can be read with pstats. Only one stage can be profiled at a
+    time, so don't pass profile_path to stages running within a profiled stage.
+    """
+    rows_in = len(df)
+    rss_before = peak_rss()
+    start = time.perf_counter()
+    if profile_path is None:
+        df = method(df)
+    else:
+        profiler = cProfile.Profile()
+        df = profiler.runcall(method, df)
+        profiler.dump_stats(profile_path)
+    seconds = time.perf_counter() - start
+    rss_after = peak_rss()
+    sink(
+        dict(
+            event="stage",
+            stage=stage,
+            seconds=seconds,
+            peak_rss_delta=None if rss_before is None else rss_after - rss_before,
+            rows_in=rows_in,
+            rows_out=len(df),
+            profile=profile_path,
+            **fields,
+        )
+    )
+    return df
+
+
+def _states(states):
+    return "({}): {}".format(len(states), set(states))
+
+
+def print_event(event):
+    """
+    sink printing the events of ccm.run like ccm.run always printed them, stage
+    events are not printed
+    """
+    kind = event["event"]
+    if kind == "chamber":
+        print()
+        print(event["title"])
+    elif kind == "run":
+        print()
+        print("Name: ", event["name"])
+        print("Reasons for ommision: ")
+        print()
+    elif kind == "exclusion":
+        print("{} {}".format(event["reason"], _states(event["states"])))
+    elif kind == "missing_states":
+        print("Not in MEDSL Dataset {}".format(_states(event["states"])))
+    elif kind == "invalid_states":
+        print("Invalid/incomplete data {}".format(_states(event["states"])))
+    elif kind == "unmatched_fix_rules":
+        print("Fix rules matching no rows ({}):".format(len(event["rules"])))
+        print(event["table"])
+    elif kind == "empty_seats":
+        print("Seats without candidates {}".format(_states(event["seats"])))
+    elif kind == "third_party_wins":
+        print("Third party wins {}".format(_states(event["states"])))
+    elif kind == "result":
+        print()
+        print(event["head"])
+        print("States included {}".format(_states(event["states_included"])))
+        print()
+        print("States ommitted {}".format(_states(event["states_ommitted"])))
+        print("Saving df to : ", event["file_path"])
+
+
+def json_lines_sink(f):
+    """
+    return a sink writing every event to the file object f as one line of JSON
+    """
+
+    def sink(event):
+        f.write(json.dumps(event, default=str) + "\n")
+        f.flush()
+
+    return sink
+
+
+def null_sink(event):
+    """
+    sink dropping every event
+    """
+
+
+def tee(*sinks):
+    """
+    return a sink passing every event to each of sinks
+    """
+
+    def sink(event):
+        for s in sinks:
+            s(event)
+
+    return sink
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+# Columnar cache for MEDSL source csvs.
+#
+# The first time a csv is read it is parsed with pd.read_csv and saved as one .npy
+# file per column in cache_dir: string columns are stored as categorical codes with
+# their categories in columns.json, everything else as the column's own dtype.
+# Later reads load (or memory-map) the .npy files instead of parsing the csv. Entries
+# are keyed by the sha256 of the csv, the hash of each csv is remembered in
+# index.json together with its mtime and size so that the csv is only re-hashed
+# when it changes on disk.
+
+CACHE_DIR = ".medsl_cache"
+CATEGORICAL_COLUMNS = [
+    "state",
+    "state_po",
+    "office",
+    "district",
+    "stage",
+    "candidate",
+    "party",
+    "mode",
+]
+
+
+def file_hash(file_path):
+    """
+    return the sha256 hex digest of the file at file_path
+    """
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _read_index(cache_dir):
+    index_path = os.path.join(cache_dir, "index.json")
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def _write_index(cache_dir, index):
+    index_path = os.path.join(cache_dir, "index.json")
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    os.replace(index_path + ".tmp", index_path)
+
+
+def source_key(file_path, cache_dir=CACHE_DIR):
+    """
+    return the sha256 of the csv at file_path, only re-hashing the csv if its mtime
+    or size changed since it was last hashed
+    """
+    stat = os.stat(file_path)
+    index = _read_index(cache_dir)
+    entry = index.get(os.path.abspath(file_path))
+    if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+        return entry["sha256"]
+
+    sha256 = file_hash(file_path)
+    index[os.path.abspath(file_path)] = {
+        "mtime": stat.st_mtime,
+        "size": stat.st_size,
+        "sha256": sha256,
+    }
+    os.makedirs(cache_dir, exist_ok=True)
+    _write_index(cache_dir, index)
+    return sha256
+
+
+def write_columns(df, entry_dir):
+    """
+    save df to entry_dir, non-numeric columns as categorical codes
+    """
+    tmp_dir = entry_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    columns = []
+    for i, (name, col) in enumerate(df.items()):
+        column = {"name": name, "file": "{:03d}.npy".format(i)}
+        if not pd.api.types.is_numeric_dtype(col):
+            col = col.astype("category")
+            column["categories"] = col.cat.categories.tolist()
+            values = col.cat.codes.to_numpy()
+        else:
+            values = col.to_numpy()
+        column["dtype"] = str(values.dtype)
+        np.save(os.path.join(tmp_dir, column["file"]), values)
+        columns.append(column)
+    with open(os.path.join(tmp_dir, "columns.json"), "w") as f:
+        json.dump(columns, f)
+    shutil.rmtree(entry_dir, ignore_errors=True)
+    os.rename(tmp_dir, entry_dir)
+
+
+def read_columns(entry_dir, categorical=True, mmap=False):
+    """
+    load a df saved by write_columns
+
+    Columns in CATEGORICAL_COLUMNS are returned as categoricals when categorical is
+    True, every other string column is returned as object strings. With mmap the
+    numeric columns are read-only views of the memory-mapped column files, so
+    only use it for dfs that will not be modified in place.
+    """
+    with open(os.path.join(entry_dir, "columns.json")) as f:
+        columns = json.load(f)
+    data = {}
+    for column in columns:
+        values = np.load(
+            os.path.join(entry_dir, column["file"]), mmap_mode="r" if mmap else None
+        )
+        if "categories" in column:
+            values = pd.Categorical.from_codes(values, column["categories"])
+            if not (categorical and column["name"] in CATEGORICAL_COLUMNS):
+                values = np.asarray(values, dtype=object)
+        data[column["name"]] = values
+    return pd.DataFrame(data)
+
+
+def read_medsl(file_path, categorical=True, mmap=False, cache_dir=CACHE_DIR):
+    """
+    return the MEDSL csv at file_path as a df, parsing the csv only if it is not
+    already in the cache
+
+    The df has the columns and values pd.read_csv would return, with the
+    CATEGORICAL_COLUMNS as categoricals unless categorical is False.
+    See read_columns for mmap.
+    """
+    sha256 = source_key(file_path, cache_dir)
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    entry_dir = os.path.join(cache_dir, "{}-{}".format(stem, sha256[:16]))
+    if not os.path.exists(os.path.join(entry_dir, "columns.json")):
+        df = pd.read_csv(file_path, low_memory=False)
+        write_columns(df, entry_dir)
+    return read_columns(entry_dir, categorical=categorical, mmap=mmap)
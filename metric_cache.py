@@ -0,0 +1,301 @@
+import argparse
+import hashlib
+import json
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+import batch_metrics as bm
+import district_table
+
+# Persistent cache of the metrics of (Year, State) elections.
+#
+# The metrics of an election only depend on its districts' voteshares (not on their
+# order), the voteshares imputed with impute_val (see batch_metrics.impute), its
+# weighted voteshare and the other parameters and code they are computed with. The
+# key of an election is the sha256 of those: its voteshares and imputed voteshares
+# sorted, the bytes of its weighted voteshare and the parameters. impute_val itself
+# is not in the key, so changing it only recomputes the elections with uncontested
+# districts. Elections whose results didn't change between two runs, or which have
+# the same results as another election, are read from the cache instead of being
+# computed again. The bootstrap resamples (see
+# resampling.py) are seeded by (Year, State) and drawn by position, so with
+# by_election the Year, State and the voteshares in file order are in the key too.
+#
+# Entries are the metrics of one election as a JSON object, without its Year and
+# State, in the entries table of a SQLite database at CACHE_PATH. Looking an entry
+# up marks it as used, and storing entries evicts the least recently used ones
+# until the entries take at most max_bytes (keys and values). The counters table
+# keeps the number of hits, misses, stored and evicted entries across runs, see
+# cache_stats and python metric_cache.py --output.
+
+CACHE_PATH = ".metric_cache.sqlite"
+
+# bytes of keys and values kept in the cache
+MAX_BYTES = 64 << 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+COUNTERS = ["hits", "misses", "stored", "evicted"]
+
+# seconds a writer waits for another writer before failing
+BUSY_TIMEOUT = 60
+
+
+def connect(cache_path=CACHE_PATH):
+    """
+    return a connection to the cache at cache_path, creating it if needed
+    """
+    conn = sqlite3.connect(cache_path, timeout=BUSY_TIMEOUT)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _count(conn, counts):
+    conn.executemany(
+        "INSERT INTO counters VALUES (?, ?) "
+        "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+        [(name, count) for name, count in counts.items() if count],
+    )
+
+
+# Keys
+
+
+def parameters_hash(parameters):
+    """
+    return the sha256 hex digest of a JSON serializable dict of parameters
+    """
+    return hashlib.sha256(
+        json.dumps(parameters, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def election_keys(table, parameters, impute_val=1, by_election=False):
+    """
+    return the cache key of every (Year, State) election of a district table (or df
+    sorted like batch_metrics.read_results returns) computed with parameters and
+    impute_val, with the Year, State and order of the districts of every election
+    when by_election
+    """
+    elections_df, offsets, voteshares = bm.pack_voteshares(table)
+    imputed = bm.impute(voteshares, impute_val)
+    prefix = parameters_hash(parameters).encode()
+    weighted = elections_df["Weighted Voteshare"].to_numpy(np.float64)
+    keys = []
+    for i, (year, state) in enumerate(
+        elections_df[["Year", "State"]].itertuples(index=False)
+    ):
+        election_voteshares = voteshares[offsets[i] : offsets[i + 1]]
+        sha = hashlib.sha256(prefix)
+        sha.update(weighted[i : i + 1].tobytes())
+        sha.update(np.sort(election_voteshares).tobytes())
+        sha.update(np.sort(imputed[offsets[i] : offsets[i + 1]]).tobytes())
+        if by_election:
+            sha.update("{}\0{}\0".format(year, state).encode())
+            sha.update(election_voteshares.tobytes())
+        keys.append(sha.hexdigest())
+    return keys
+
+
+# Reading and writing entries
+
+
+def lookup(conn, keys):
+    """
+    return the cached metrics of keys as a dict of key -> dict of metrics, only for
+    the keys in the cache, marking them as used
+    """
+    unique_keys = list(dict.fromkeys(keys))
+    found = {}
+    with conn:
+        for start in range(0, len(unique_keys), 500):
+            batch = unique_keys[start : start + 500]
+            found.update(
+                conn.execute(
+                    "SELECT key, value FROM entries WHERE key IN ({})".format(
+                        ", ".join("?" * len(batch))
+                    ),
+                    batch,
+                )
+            )
+        conn.executemany(
+            "UPDATE entries SET last_used = ? WHERE key = ?",
+            [(time.time(), key) for key in found],
+        )
+        hits = sum(key in found for key in keys)
+        _count(conn, {"hits": hits, "misses": len(keys) - hits})
+    return {key: json.loads(value) for key, value in found.items()}
+
+
+def store(conn, entries, max_bytes=MAX_BYTES):
+    """
+    cache entries, a dict of key -> dict of metrics, then evict the least recently
+    used entries until the cache holds at most max_bytes
+    """
+    now = time.time()
+    rows = []
+    for key, metrics in entries.items():
+        value = json.dumps(metrics, default=lambda value: value.item())
+        rows.append((key, value, len(key) + len(value), now))
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", rows)
+        _count(conn, {"stored": len(rows)})
+        evict(conn, max_bytes)
+
+
+def evict(conn, max_bytes=MAX_BYTES):
+    """
+    delete the least recently used entries until the cache holds at most max_bytes,
+    return the number of entries deleted
+    """
+    (size,) = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+    evicted = []
+    if size > max_bytes:
+        for key, entry_size in conn.execute(
+            "SELECT key, size FROM entries ORDER BY last_used, rowid"
+        ):
+            if size <= max_bytes:
+                break
+            evicted.append((key,))
+            size -= entry_size
+    with conn:
+        conn.executemany("DELETE FROM entries WHERE key = ?", evicted)
+        _count(conn, {"evicted": len(evicted)})
+    return len(evicted)
+
+
+def cache_stats(conn):
+    """
+    return a dict of the counters of the cache (see COUNTERS), the hit rate, and the
+    number of entries and bytes it holds
+    """
+    stats = dict.fromkeys(COUNTERS, 0)
+    stats.update(conn.execute("SELECT name, value FROM counters"))
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else None
+    stats["entries"], stats["bytes"] = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+    ).fetchone()
+    return stats
+
+
+def clear(conn):
+    """
+    delete every entry and reset the counters
+    """
+    with conn:
+        conn.execute("DELETE FROM entries")
+        conn.execute("DELETE FROM counters")
+
+
+# Cached metrics
+
+
+def split_cached(conn, table, parameters, impute_val=1, by_election=False):
+    """
+    return (keys, hits, missed): the cache key of every election of a district table
+    (see election_keys), the cached metrics of the elections in the cache by election
+    index, and the indices of the other elections
+    """
+    keys = election_keys(table, parameters, impute_val, by_election)
+    found = lookup(conn, keys)
+    hits = {i: found[key] for i, key in enumerate(keys) if key in found}
+    missed = [i for i in range(len(keys)) if i not in hits]
+    return keys, hits, missed
+
+
+def merge_cached(
+    conn, table, keys, hits, missed, computed_df, columns, max_bytes=MAX_BYTES
+):
+    """
+    cache the metrics of the missed elections of table in computed_df, a df with
+    the columns (Year, State and metrics) of every missed election, and return them
+    together with the cached metrics of the hits in one df with columns, ordered by
+    State and Year
+    """
+    elections_df = bm.pack_voteshares(table)[0]
+    elections = list(
+        zip(elections_df["Year"].astype(int).tolist(), elections_df["State"].tolist())
+    )
+    records = computed_df.to_dict("records")
+    computed = {(int(record["Year"]), record["State"]): record for record in records}
+    entries = {}
+    for i in missed:
+        if elections[i] in computed:
+            entries[keys[i]] = {
+                col: value
+                for col, value in computed[elections[i]].items()
+                if col not in {"Year", "State"}
+            }
+    if entries:
+        store(conn, entries, max_bytes)
+    if not hits:
+        return computed_df
+
+    for i, metrics in hits.items():
+        year, state = elections[i]
+        records.append(dict(Year=year, State=state, **metrics))
+    df = pd.DataFrame.from_records(records, columns=columns)
+    return df.sort_values(["State", "Year"], kind="mergesort").reset_index(drop=True)
+
+
+def cached_metrics(
+    conn,
+    table,
+    parameters,
+    compute,
+    columns,
+    impute_val=1,
+    max_bytes=MAX_BYTES,
+    by_election=False,
+):
+    """
+    return compute(table), a df with the columns (Year, State and metrics) of every
+    election of a district table ordered by State and Year, computing only the
+    elections not in the cache (compute is called on a table of those, see
+    district_table.take_elections)
+    """
+    keys, hits, missed = split_cached(conn, table, parameters, impute_val, by_election)
+    computed_df = pd.DataFrame()
+    if missed:
+        computed_df = compute(district_table.take_elections(table, missed))
+    return merge_cached(
+        conn, table, keys, hits, missed, computed_df, columns, max_bytes
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="print the counters of the metric cache as JSON"
+    )
+    parser.add_argument("--cache", default=CACHE_PATH)
+    parser.add_argument("--output", help="write the counters to this .json file")
+    parser.add_argument(
+        "--clear", action="store_true", help="delete every entry and reset the counters"
+    )
+    args = parser.parse_args()
+    conn = connect(args.cache)
+    if args.clear:
+        clear(conn)
+    stats = json.dumps(cache_stats(conn), indent=2)
+    conn.close()
+    print(stats)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(stats + "\n")
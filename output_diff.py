@@ -0,0 +1,316 @@
+import argparse
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+# Keyed diff of two versions of the outputs of the pipeline.
+#
+# The rows of the old and new versions of a csv are matched on their key: State,
+# Year and District for results in the gerrymetrics format, State (and Year when
+# there is one) for exports. Matching is a hash join, so diffing even the post-1948
+# results takes time linear in the number of rows. Only keys repeated in either
+# version of a file are told apart by their occurrence: the n-th row of such a key in
+# the old version is matched with the n-th row of that key in the new version, so
+# removing a row only shifts the rows of its own key.
+#
+# A changelog is a df with one row per change and the CHANGELOG_COLUMNS:
+#
+#   file                the csv, relative to the compared directories
+#   change              added or removed (a row, column or file), or changed (a value)
+#   State, Year,        the key of the row, empty when not in the key of the file or
+#   District,           for a column or file, and the occurrence of a repeated key
+#   occurrence
+#   column              the column of a changed value or added or removed column
+#   old, new            the old and new values of a changed value
+#   delta               new - old for numeric values
+#
+# Numeric values only count as changed when they moved by more than the tolerance,
+# NaN and N/A are equal to themselves. Snapshot the outputs before rebuilding them
+# (snapshot_outputs) to get the changelog of a rebuild, see gerrygrade.py build
+# --changelog. Directories are compared with their subdirectories (exports/us_hor/).
+
+# the outputs of the pipeline, see gerrygrade.py
+OUTPUT_DIRS = ["election_data/gerrymetrics_format/", "exports/"]
+
+# candidate keys of the csvs, the first one whose columns are all in a csv is used
+KEY_COLUMNS = [["State", "Year", "District"], ["State", "Year"], ["State"]]
+
+# numeric values closer than this are equal
+tolerance = 1e-9
+
+CHANGELOG_COLUMNS = [
+    "file",
+    "change",
+    "State",
+    "Year",
+    "District",
+    "occurrence",
+    "column",
+    "old",
+    "new",
+    "delta",
+]
+
+
+def output_keys(columns):
+    """
+    return the first of KEY_COLUMNS whose columns are all in columns
+    """
+    for keys in KEY_COLUMNS:
+        if set(keys).issubset(columns):
+            return keys
+    raise ValueError("No key columns {} in {}".format(KEY_COLUMNS, list(columns)))
+
+
+def read_output(fp, keys=None):
+    """
+    return (df, keys): the csv at fp with its key columns (default: see output_keys)
+    read as strings, empty for missing keys
+    """
+    if keys is None:
+        keys = output_keys(pd.read_csv(fp, nrows=0).columns)
+    df = pd.read_csv(fp, dtype={key: str for key in keys})
+    df[keys] = df[keys].fillna("")
+    return df, keys
+
+
+def diff_values(old, new, tolerance=tolerance):
+    """
+    return (changed, delta): whether every value of the aligned series new changed
+    from old, and new - old when either is numeric (NaN otherwise)
+    """
+    if pd.api.types.is_numeric_dtype(old) or pd.api.types.is_numeric_dtype(new):
+        old_values = pd.to_numeric(old, errors="coerce").to_numpy(np.float64)
+        new_values = pd.to_numeric(new, errors="coerce").to_numpy(np.float64)
+        delta = new_values - old_values
+        with np.errstate(invalid="ignore"):
+            changed = np.abs(delta) > tolerance
+        changed |= np.isnan(old_values) != np.isnan(new_values)
+        # values which aren't numbers, compared as they are
+        changed |= np.isnan(old_values) & np.isnan(new_values) & old.ne(new).values
+        changed &= ~(old.isnull().values & new.isnull().values)
+        return changed, delta
+    changed = old.ne(new).values & ~(old.isnull().values & new.isnull().values)
+    return changed, np.full(len(old), np.nan)
+
+
+def key_occurrences(df, other_df, keys):
+    """
+    return the occurrence of the key of every row of df among the rows of df with that
+    key, -1 for the keys found at most once in df and in other_df
+    """
+    repeated = pd.concat(
+        [
+            df.loc[df.duplicated(keys, keep=False), keys],
+            other_df.loc[other_df.duplicated(keys, keep=False), keys],
+        ]
+    ).drop_duplicates()
+    is_repeated = (
+        df[keys].merge(repeated, on=keys, how="left", indicator=True)["_merge"]
+        == "both"
+    ).to_numpy()
+    occurrences = df.groupby(keys, sort=False).cumcount().to_numpy()
+    return np.where(is_repeated, occurrences, -1)
+
+
+def diff_frames(old_df, new_df, keys, tolerance=tolerance):
+    """
+    return the changelog of the rows of old_df and new_df matched on keys, without
+    the file column
+    """
+    join = keys + ["occurrence"]
+    old_df = old_df.assign(occurrence=key_occurrences(old_df, new_df, keys))
+    new_df = new_df.assign(occurrence=key_occurrences(new_df, old_df, keys))
+    merged = old_df.merge(
+        new_df, on=join, how="outer", suffixes=("_old", "_new"), indicator=True
+    )
+
+    changes = []
+    for column in new_df.columns.difference(old_df.columns, sort=False):
+        changes.append(pd.DataFrame({"change": ["added"], "column": [column]}))
+    for column in old_df.columns.difference(new_df.columns, sort=False):
+        changes.append(pd.DataFrame({"change": ["removed"], "column": [column]}))
+    for side, change in [("left_only", "removed"), ("right_only", "added")]:
+        rows = merged.loc[merged["_merge"] == side, join]
+        changes.append(rows.assign(change=change))
+
+    both = merged[merged["_merge"] == "both"]
+    for column in old_df.columns:
+        if column in join or column not in new_df.columns:
+            continue
+        old, new = both[column + "_old"], both[column + "_new"]
+        changed, delta = diff_values(old, new, tolerance)
+        if changed.any():
+            changes.append(
+                both.loc[changed, join].assign(
+                    change="changed",
+                    column=column,
+                    old=old.values[changed],
+                    new=new.values[changed],
+                    delta=delta[changed],
+                )
+            )
+    changelog = pd.concat(changes, ignore_index=True, sort=False)
+    changelog = changelog.reindex(columns=CHANGELOG_COLUMNS[1:])
+    changelog["occurrence"] = changelog["occurrence"].astype("Int64")
+    changelog.loc[changelog["occurrence"] < 0, "occurrence"] = pd.NA
+    return changelog
+
+
+def diff_files(old_fp, new_fp, file=None, tolerance=tolerance):
+    """
+    return the changelog of the csvs at old_fp and new_fp, under file (default: the
+    name of new_fp)
+
+    The csvs are matched on the key of the columns in both, see output_keys, so a
+    key column added to or removed from a csv is reported as such.
+    """
+    old_columns = pd.read_csv(old_fp, nrows=0).columns
+    keys = output_keys(old_columns.intersection(pd.read_csv(new_fp, nrows=0).columns))
+    old_df, _ = read_output(old_fp, keys)
+    new_df, _ = read_output(new_fp, keys)
+    changelog = diff_frames(old_df, new_df, keys, tolerance)
+    changelog.insert(0, "file", file or os.path.basename(new_fp))
+    return changelog
+
+
+def output_csvs(directory):
+    """
+    return the paths of the csvs in directory and its subdirectories, relative to
+    directory
+    """
+    names = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.endswith(".csv"):
+                names.append(
+                    os.path.relpath(os.path.join(root, name), directory).replace(
+                        os.sep, "/"
+                    )
+                )
+    return sorted(names)
+
+
+def diff_dirs(old_dir, new_dir, prefix="", tolerance=tolerance):
+    """
+    return the changelog of the csvs of old_dir and new_dir and their subdirectories,
+    matched by relative path, the paths prefixed with prefix in the file column
+    """
+    old_names = set(output_csvs(old_dir))
+    new_names = set(output_csvs(new_dir))
+    changelogs = []
+    for name in sorted(old_names.union(new_names)):
+        file = prefix + name
+        if name not in new_names or name not in old_names:
+            change = "removed" if name in old_names else "added"
+            changelogs.append(pd.DataFrame({"file": [file], "change": [change]}))
+            continue
+        changelogs.append(
+            diff_files(
+                os.path.join(old_dir, name),
+                os.path.join(new_dir, name),
+                file,
+                tolerance,
+            )
+        )
+    if not changelogs:
+        return pd.DataFrame(columns=CHANGELOG_COLUMNS)
+    changelog = pd.concat(changelogs, ignore_index=True, sort=False)
+    return changelog.reindex(columns=CHANGELOG_COLUMNS).astype({"occurrence": "Int64"})
+
+
+def diff_outputs(old, new, tolerance=tolerance):
+    """
+    return the changelog of two csvs, or of two directories of csvs
+    """
+    if os.path.isdir(old) and os.path.isdir(new):
+        return diff_dirs(old, new, tolerance=tolerance)
+    return diff_files(old, new, tolerance=tolerance)
+
+
+def summarize(changelog):
+    """
+    return a description of the number of changes of every file by kind of change
+    """
+    if changelog.empty:
+        return "No changes"
+    counts = changelog.groupby(["file", "change"]).size().unstack(fill_value=0)
+    return counts.to_string()
+
+
+def write_changelog(changelog, fp):
+    """
+    write changelog to fp, as JSON lines (one object per change) when fp ends with
+    .json or .jsonl and as a csv otherwise
+    """
+    if fp.endswith((".json", ".jsonl")):
+        changelog.to_json(fp, orient="records", lines=True)
+    else:
+        changelog.to_csv(fp, index=False)
+
+
+# Snapshots
+
+
+def snapshot_outputs(snapshot_dir, output_dirs=OUTPUT_DIRS):
+    """
+    copy the csvs of output_dirs and their subdirectories to snapshot_dir, under the
+    same relative paths
+    """
+    for output_dir in output_dirs:
+        os.makedirs(os.path.join(snapshot_dir, output_dir), exist_ok=True)
+        if not os.path.isdir(output_dir):
+            continue
+        for name in output_csvs(output_dir):
+            snapshot_fp = os.path.join(snapshot_dir, output_dir, name)
+            os.makedirs(os.path.dirname(snapshot_fp), exist_ok=True)
+            shutil.copy2(os.path.join(output_dir, name), snapshot_fp)
+
+
+def diff_snapshot(snapshot_dir, output_dirs=OUTPUT_DIRS, tolerance=tolerance):
+    """
+    return the changelog of output_dirs since snapshot_outputs(snapshot_dir), with
+    the paths of the csvs in the file column
+    """
+    changelogs = []
+    for output_dir in output_dirs:
+        os.makedirs(output_dir, exist_ok=True)
+        changelogs.append(
+            diff_dirs(
+                os.path.join(snapshot_dir, output_dir),
+                output_dir,
+                prefix=output_dir,
+                tolerance=tolerance,
+            )
+        )
+    return pd.concat(changelogs, ignore_index=True, sort=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="report the rows and values which changed between two versions "
+        "of the csvs of the pipeline"
+    )
+    parser.add_argument("old", help="old csv, or directory of csvs")
+    parser.add_argument("new", help="new csv, or directory of csvs")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=tolerance,
+        help="smallest change of a numeric value reported (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output", help="write the changelog to this .csv or .json (JSON lines)"
+    )
+    args = parser.parse_args(argv)
+
+    changelog = diff_outputs(args.old, args.new, args.tolerance)
+    print(summarize(changelog))
+    if args.output:
+        write_changelog(changelog, args.output)
+
+
+if __name__ == "__main__":
+    main()
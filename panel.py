@@ -0,0 +1,161 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+import batch_metrics as bm
+import cleanUSHORpost1948
+import run_gerrymetrics as rg
+
+# Full-history panel of a multi-year results file.
+#
+# The metrics of every (State, Year) election from min_year on are computed in one
+# batched pass over the file (see run_gerrymetrics.compute_gerry_data), and every
+# metric of PANEL_METRICS gets statistics over the state's history:
+#
+#   {metric}_cycle_mean       mean over the state's elections in the same
+#                             redistricting cycle (e.g. 1972 to 1980)
+#   {metric}_rolling_mean     mean over the state's last `window` elections
+#   {metric}_cumulative_mean  mean over the state's elections since min_year
+#
+# NaNs (e.g. the t-test of a single district state) are left out of the means.
+# cycle_summary() gives one row per (State, cycle) instead, so a decade by decade
+# study is one call rather than a run per year.
+
+OUTPUT_DIR = "exports/panel/"
+
+# only consider races from this year on
+min_year = 1948
+
+# number of elections of the rolling means, 5 is a decade of House elections
+window = 5
+
+PANEL_METRICS = [
+    "voteshare_d",
+    "seats_d",
+    "mean_median_diff",
+    "efficiency_gap",
+    "partisan_bias",
+]
+
+
+def redistricting_cycle(years):
+    """
+    return the first year of the redistricting cycle of every year: districts drawn
+    after the census of a year ending in 0 are first used in the election of the
+    year ending in 2, e.g. 1972 for the years 1972 to 1980
+    """
+    return (np.asarray(years) - 2) // 10 * 10 + 2
+
+
+def panel_gerry_data(districts_df, window=window, impute_val=1, n_resamples=0):
+    """
+    return a df indexed by (State, Year) with the columns of
+    run_gerrymetrics.compute_gerry_data, the column cycle (see redistricting_cycle)
+    and the cycle, rolling and cumulative means of every metric of PANEL_METRICS
+
+    Expects districts_df to be sorted like batch_metrics.read_results returns.
+    """
+    df = rg.compute_gerry_data(districts_df, impute_val, "batch", n_resamples)
+    df = df.set_index(["State", "Year"])
+    df.insert(0, "cycle", redistricting_cycle(df.index.get_level_values("Year")))
+
+    # running sums and counts of the non NaN values of every state, the rolling
+    # and cycle means are differences of them
+    values = df[PANEL_METRICS].astype(np.float64)
+    states = values.index.get_level_values("State")
+    sums = values.fillna(0).groupby(states).cumsum()
+    counts = values.notnull().astype(np.int64).groupby(states).cumsum()
+
+    by_cycle = [states, df["cycle"].values]
+    cycle_sums = values.groupby(by_cycle).transform("sum")
+    cycle_counts = values.notnull().astype(np.int64).groupby(by_cycle).transform("sum")
+    rolling_sums = sums - sums.groupby(states).shift(window, fill_value=0)
+    rolling_counts = counts - counts.groupby(states).shift(window, fill_value=0)
+
+    with np.errstate(all="ignore"):
+        for metric in PANEL_METRICS:
+            df[metric + "_cycle_mean"] = (
+                cycle_sums[metric].values / cycle_counts[metric].values
+            )
+            df[metric + "_rolling_mean"] = (
+                rolling_sums[metric].values / rolling_counts[metric].values
+            )
+            df[metric + "_cumulative_mean"] = (
+                sums[metric].values / counts[metric].values
+            )
+    return df
+
+
+def cycle_summary(panel_df):
+    """
+    return a df indexed by (State, cycle) with the number of elections of the state
+    in the cycle (n_elections) and the mean, min and max of every metric of
+    PANEL_METRICS over them, from a df from panel_gerry_data
+    """
+    grouped = panel_df.groupby(
+        [panel_df.index.get_level_values("State"), panel_df["cycle"]]
+    )
+    summary_df = grouped[PANEL_METRICS].agg(["mean", "min", "max"])
+    summary_df.columns = [
+        "{}_{}".format(metric, stat) for metric, stat in summary_df.columns
+    ]
+    summary_df.insert(0, "n_elections", grouped.size())
+    return summary_df
+
+
+def export_panel(elections_df_fp, min_year=min_year, window=window, impute_val=1):
+    """
+    write the panel_gerry_data and cycle_summary of the elections of
+    elections_df_fp from min_year on to OUTPUT_DIR, under the file name of
+    elections_df_fp and with _cycles appended
+    """
+    panel_df = panel_gerry_data(
+        bm.read_results(elections_df_fp, start_year=min_year), window, impute_val
+    )
+    name, ext = os.path.splitext(os.path.basename(elections_df_fp))
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    panel_df.to_csv(OUTPUT_DIR + name + ext)
+    cycle_summary(panel_df).to_csv(OUTPUT_DIR + name + "_cycles" + ext)
+    return panel_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="compute the metrics of every state and year of a multi-year "
+        "results file in the gerrymetrics format, with their means over "
+        "redistricting cycles, rolling windows and the whole history"
+    )
+    parser.add_argument(
+        "elections_df_fps",
+        nargs="*",
+        help="files to run (default: {})".format(cleanUSHORpost1948.PGP_FILE_PATH),
+    )
+    parser.add_argument(
+        "--min-year",
+        type=int,
+        default=min_year,
+        help="first year of the panel (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=window,
+        help="number of elections of the rolling means (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--impute-val",
+        type=float,
+        default=1,
+        help="voteshare of uncontested races (default: 1, don't impute)",
+    )
+    args = parser.parse_args()
+
+    for elections_df_fp in args.elections_df_fps or [cleanUSHORpost1948.PGP_FILE_PATH]:
+        print(os.path.basename(elections_df_fp))
+        print(
+            export_panel(
+                elections_df_fp, args.min_year, args.window, args.impute_val
+            ).head()
+        )
@@ -0,0 +1,145 @@
+import numpy as np
+import pandas as pd
+
+import batch_metrics as bm
+
+# Bootstrap confidence intervals and empirical p-values for the batched metrics.
+#
+# Every (Year, State) election is resampled by drawing its districts with
+# replacement. The resample indices of a chunk of resamples are one NumPy array
+# covering every election, laid out as a ragged array with one segment per
+# (resample, election), so one call of a batched metric evaluates the metric on
+# every resample of every election of the chunk. The districts of every election are
+# sorted by voteshare first and the resamples are built from the number of times
+# each district was drawn, so every segment comes out sorted and medians need no
+# sort (the metrics don't depend on the order of the districts).
+#
+# Memory is bounded by max_elements: elections are processed in blocks holding at
+# most max_elements replicates per metric, and resamples in chunks of at most
+# max_elements resampled districts.
+#
+# Every election draws from its own generator seeded with (seed, Year, State), so
+# the intervals of an election do not depend on which other elections are in the
+# file, how the file is sharded or chunked, or whether it is built incrementally.
+
+MAX_ELEMENTS = 1 << 22
+
+
+def election_generators(elections_df, seed=0):
+    """
+    return a numpy Generator for every row of elections_df (with the columns Year
+    and State), seeded with seed, the Year and the State
+    """
+    return [
+        np.random.default_rng([seed, int(year)] + list(state.encode()))
+        for year, state in elections_df[["Year", "State"]].itertuples(index=False)
+    ]
+
+
+def resample_indices(offsets, generators, n_resamples):
+    """
+    return n_resamples * offsets[-1] positions in the ragged array of offsets:
+    resample r is at [r * offsets[-1], (r + 1) * offsets[-1]) and holds a resample
+    with replacement of the districts of every election, at the positions of the
+    election's own districts and in ascending order within every election
+    """
+    n_districts = offsets[-1]
+    counts = np.diff(offsets)
+    uniforms = np.concatenate(
+        [
+            generator.random((n_resamples, count))
+            for generator, count in zip(generators, counts)
+        ],
+        axis=1,
+    )
+    ids = bm.group_ids(offsets)
+    draws = offsets[:-1][ids] + (uniforms * counts[ids]).astype(np.int64)
+    draws += n_districts * np.arange(n_resamples)[:, None]
+    times_drawn = np.bincount(draws.ravel(), minlength=n_resamples * n_districts)
+    return np.repeat(np.tile(np.arange(n_districts), n_resamples), times_drawn)
+
+
+def bootstrap(voteshares, offsets, generators, metrics, n_resamples, max_elements):
+    """
+    return a dict of metric name to an (n_resamples, n_elections) array of the
+    metric on every bootstrap resample of every election in offsets
+
+    metrics maps names to batched or gerrymetrics metrics, see batch_metrics.batched.
+    Expects the voteshares of every election to be sorted.
+    """
+    n_districts = offsets[-1]
+    n_elections = len(offsets) - 1
+    chunk_size = max(1, max_elements // max(n_districts, 1))
+    replicates = {name: np.empty((n_resamples, n_elections)) for name in metrics}
+    for start in range(0, n_resamples, chunk_size):
+        size = min(chunk_size, n_resamples - start)
+        values = voteshares[resample_indices(offsets, generators, size)]
+        chunk_offsets = bm.tile_offsets(offsets, size)
+        with np.errstate(all="ignore"):
+            for name, metric in metrics.items():
+                replicates[name][start : start + size] = bm.batched(metric)(
+                    values, chunk_offsets
+                ).reshape(size, n_elections)
+    return replicates
+
+
+def confidence_intervals(
+    df,
+    metrics,
+    n_resamples=10000,
+    level=0.95,
+    impute_val=1,
+    seed=0,
+    max_elements=MAX_ELEMENTS,
+):
+    """
+    return a df indexed by (Year, State) with the columns {name}_ci_low,
+    {name}_ci_high and {name}_p for every metric name in metrics
+
+    The interval is the percentile bootstrap interval at level of n_resamples
+    resamples. The p-value is the two-sided bootstrap p-value of the metric being
+    zero: twice the share of resamples on the far side of zero, capped at 1, and NaN
+    when every resample gives the same value (e.g. single-district elections), which
+    says nothing about the metric's variability. Voteshares are imputed like batch_metrics.run_all_tests does. Expects df to be
+    sorted like batch_metrics.read_results returns.
+    """
+    elections_df, offsets, voteshares = bm.pack_voteshares(df)
+    if impute_val != 1:
+        voteshares = bm.impute(voteshares, impute_val)
+    generators = election_generators(elections_df, seed)
+    voteshares = voteshares[np.lexsort((voteshares, bm.group_ids(offsets)))]
+    n_elections = len(elections_df)
+    alpha = (1 - level) / 2
+
+    columns = {
+        "{}_{}".format(name, stat): np.empty(n_elections)
+        for name in metrics
+        for stat in ["ci_low", "ci_high", "p"]
+    }
+    block_size = max(1, max_elements // n_resamples)
+    for start in range(0, n_elections, block_size):
+        stop = min(start + block_size, n_elections)
+        block_offsets = offsets[start : stop + 1]
+        replicates = bootstrap(
+            voteshares[block_offsets[0] : block_offsets[-1]],
+            block_offsets - block_offsets[0],
+            generators[start:stop],
+            metrics,
+            n_resamples,
+            max_elements,
+        )
+        for name, values in replicates.items():
+            low, high = np.quantile(values, [alpha, 1 - alpha], axis=0)
+            below = (values <= 0).mean(axis=0)
+            above = (values >= 0).mean(axis=0)
+            columns[name + "_ci_low"][start:stop] = low
+            columns[name + "_ci_high"][start:stop] = high
+            columns[name + "_p"][start:stop] = np.where(
+                np.ptp(values, axis=0) == 0,
+                np.nan,
+                np.minimum(1, 2 * np.minimum(below, above)),
+            )
+
+    return pd.DataFrame(
+        columns, index=pd.MultiIndex.from_frame(elections_df[["Year", "State"]])
+    )
@@ -0,0 +1,330 @@
+import argparse
+import functools
+import json
+import os
+import sqlite3
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+# Indexed SQLite store of the pipeline's results.
+#
+# run_gerrymetrics.py (and build.py) write the metrics of every (Year, State)
+# election and the district results they were computed from to STORE_PATH, next to
+# the exported csvs. Every input file is a chamber, named after the file. The
+# metrics and districts tables are indexed on (chamber, year, state), so the query
+# methods below only read the rows they return. The chambers table records the
+# version (the sha256 of the exported csv) every chamber was written from.
+#
+# The store is in WAL mode and a chamber is replaced in a single transaction, so
+# readers never wait for a rebuild and see either the old or the new rows of a
+# chamber, never a mix.
+#
+# serve() answers the query methods over HTTP (GET /chambers, /metrics and
+# /districts with the parameters chamber, year_min, year_max and state, which can
+# be repeated) with JSON, from an LRU cache of responses keyed by the request and
+# the versions of the chambers, so rebuilt chambers are never served from the cache.
+
+STORE_PATH = "exports/results.sqlite"
+
+# columns of the metrics table besides chamber, year and state, every other column
+# of the written metrics (e.g. the bootstrap columns of run_gerrymetrics) is added
+# when it is first written
+METRICS_COLUMNS = [
+    ("n_seats", "REAL"),
+    ("seats_d", "REAL"),
+    ("avg_win_d", "REAL"),
+    ("n_uncontested_d", "INTEGER"),
+    ("seats_r", "REAL"),
+    ("avg_win_r", "REAL"),
+    ("n_uncontested_r", "INTEGER"),
+    ("voteshare_d", "REAL"),
+    ("weighted_voteshare", "REAL"),
+    ("t_test_p", "REAL"),
+    ("non_parametric_p", "REAL"),
+    ("mean_median_diff", "REAL"),
+    ("efficiency_gap", "REAL"),
+    ("partisan_bias", "REAL"),
+]
+
+# gerrymetrics format column -> districts table column
+DISTRICTS_COLUMNS = {
+    "District": ("district", "TEXT"),
+    "Dem Votes": ("dem_votes", "REAL"),
+    "GOP Votes": ("gop_votes", "REAL"),
+    "D Voteshare": ("d_voteshare", "REAL"),
+    "Incumbent": ("incumbent", "TEXT"),
+    "Party": ("party", "TEXT"),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chambers (
+    chamber TEXT PRIMARY KEY,
+    version TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    chamber TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    {metrics_columns},
+    PRIMARY KEY (chamber, year, state)
+);
+CREATE TABLE IF NOT EXISTS districts (
+    chamber TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    {districts_columns}
+);
+CREATE INDEX IF NOT EXISTS districts_chamber_year_state
+    ON districts (chamber, year, state);
+""".format(
+    metrics_columns=",\n    ".join(
+        "{} {}".format(name, type_) for name, type_ in METRICS_COLUMNS
+    ),
+    districts_columns=",\n    ".join(
+        "{} {}".format(name, type_) for name, type_ in DISTRICTS_COLUMNS.values()
+    ),
+)
+
+# seconds a writer waits for another writer before failing
+BUSY_TIMEOUT = 60
+
+# number of responses serve() caches
+CACHE_SIZE = 256
+
+
+# Writing methods
+
+
+def connect(store_path=STORE_PATH):
+    """
+    return a connection to the store at store_path for writing, creating the store
+    if needed
+    """
+    conn = sqlite3.connect(store_path, timeout=BUSY_TIMEOUT)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def chamber_name(elections_df_fp):
+    """
+    return the name of the chamber of an input file: its file name without .csv
+    """
+    return os.path.splitext(os.path.basename(elections_df_fp))[0]
+
+
+def _insert(conn, table, df):
+    conn.executemany(
+        "INSERT INTO {} ({}) VALUES ({})".format(
+            table, ", ".join(df.columns), ", ".join("?" * len(df.columns))
+        ),
+        df.astype(object).where(df.notnull(), None).itertuples(index=False),
+    )
+
+
+def write_chamber(conn, chamber, metrics_df, districts_df, version):
+    """
+    replace the rows of chamber with metrics_df, a df from
+    run_gerrymetrics.compute_gerry_data, and districts_df, the gerrymetrics format
+    df it was computed from, in one transaction
+    """
+    metrics_df = metrics_df.rename(columns={"Year": "year", "State": "state"})
+    for col in ["avg_win_d", "avg_win_r"]:
+        metrics_df[col] = pd.to_numeric(metrics_df[col], errors="coerce")
+    metrics_df.insert(0, "chamber", chamber)
+
+    districts_df = districts_df[
+        ["Year", "State"] + [col for col in DISTRICTS_COLUMNS if col in districts_df]
+    ].rename(
+        columns=dict(
+            Year="year",
+            State="state",
+            **{col: name for col, (name, _) in DISTRICTS_COLUMNS.items()}
+        )
+    )
+    districts_df.insert(0, "chamber", chamber)
+    districts_df["district"] = districts_df["district"].astype(str)
+
+    with conn:
+        known = {row[1] for row in conn.execute("PRAGMA table_info(metrics)")}
+        for col in metrics_df.columns:
+            if col not in known:
+                conn.execute("ALTER TABLE metrics ADD COLUMN {} REAL".format(col))
+        conn.execute("DELETE FROM metrics WHERE chamber = ?", (chamber,))
+        conn.execute("DELETE FROM districts WHERE chamber = ?", (chamber,))
+        _insert(conn, "metrics", metrics_df)
+        _insert(conn, "districts", districts_df)
+        conn.execute(
+            "INSERT OR REPLACE INTO chambers VALUES (?, ?, ?)",
+            (chamber, version, time.time()),
+        )
+
+
+def chamber_version(conn, chamber):
+    """
+    return the version chamber was written with, None if it is not in the store
+    """
+    row = conn.execute(
+        "SELECT version FROM chambers WHERE chamber = ?", (chamber,)
+    ).fetchone()
+    return None if row is None else row[0]
+
+
+# Query methods
+
+
+def connect_readonly(store_path=STORE_PATH):
+    """
+    return a read-only connection to the store at store_path
+    """
+    uri = "file:{}?mode=ro".format(os.path.abspath(store_path))
+    return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+
+def _where(chamber=None, year_min=None, year_max=None, states=None):
+    """
+    return the WHERE clause and parameters of a query of the rows of chamber (or
+    chambers) from year_min to year_max (inclusive) in states
+    """
+    clauses, params = [], []
+    if chamber is not None:
+        chambers = [chamber] if isinstance(chamber, str) else list(chamber)
+        clauses.append("chamber IN ({})".format(", ".join("?" * len(chambers))))
+        params += chambers
+    if year_min is not None:
+        clauses.append("year >= ?")
+        params.append(int(year_min))
+    if year_max is not None:
+        clauses.append("year <= ?")
+        params.append(int(year_max))
+    if states is not None:
+        states = [states] if isinstance(states, str) else list(states)
+        clauses.append("state IN ({})".format(", ".join("?" * len(states))))
+        params += states
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+def query_metrics(conn, chamber=None, year_min=None, year_max=None, states=None):
+    """
+    return a df of the metrics of the elections of chamber (a name or a list of
+    names, every chamber if None) from year_min to year_max in states, ordered by
+    chamber, year and state
+    """
+    where, params = _where(chamber, year_min, year_max, states)
+    return pd.read_sql_query(
+        "SELECT * FROM metrics" + where + " ORDER BY chamber, year, state",
+        conn,
+        params=params,
+    )
+
+
+def query_districts(conn, chamber=None, year_min=None, year_max=None, states=None):
+    """
+    return a df of the district results of the elections of chamber from year_min
+    to year_max in states, see query_metrics, in the order they were written
+    """
+    where, params = _where(chamber, year_min, year_max, states)
+    return pd.read_sql_query(
+        "SELECT * FROM districts" + where + " ORDER BY chamber, year, state, rowid",
+        conn,
+        params=params,
+    )
+
+
+def query_chambers(conn):
+    """
+    return a df of the chambers in the store with their version and update time
+    """
+    return pd.read_sql_query("SELECT * FROM chambers ORDER BY chamber", conn)
+
+
+# HTTP endpoint
+
+QUERIES = {
+    "/metrics": query_metrics,
+    "/districts": query_districts,
+}
+
+
+def _records(df):
+    return df.astype(object).where(df.notnull(), None).to_dict(orient="records")
+
+
+def make_handler(store_path=STORE_PATH, cache_size=CACHE_SIZE):
+    """
+    return a BaseHTTPRequestHandler class answering queries of the store at
+    store_path, see serve
+    """
+
+    @functools.lru_cache(maxsize=cache_size)
+    def respond(path, query, versions):
+        conn = connect_readonly(store_path)
+        try:
+            if path == "/chambers":
+                return json.dumps(_records(query_chambers(conn)))
+            params = parse_qs(query)
+            df = QUERIES[path](
+                conn,
+                chamber=params.get("chamber"),
+                year_min=params.get("year_min", [None])[0],
+                year_max=params.get("year_max", [None])[0],
+                states=params.get("state"),
+            )
+            return json.dumps(_records(df))
+        finally:
+            conn.close()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != "/chambers" and url.path not in QUERIES:
+                self.send_error(404)
+                return
+            try:
+                conn = connect_readonly(store_path)
+                try:
+                    versions = tuple(conn.execute("SELECT * FROM chambers"))
+                finally:
+                    conn.close()
+                body = respond(url.path, url.query, versions).encode()
+            except (ValueError, sqlite3.Error) as e:
+                self.send_error(400, str(e))
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    Handler.cache_info = respond.cache_info
+    return Handler
+
+
+def serve(store_path=STORE_PATH, host="127.0.0.1", port=8000, cache_size=CACHE_SIZE):
+    """
+    answer read-only queries of the store at store_path over HTTP until interrupted
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(store_path, cache_size))
+    print("Serving {} on http://{}:{}/".format(store_path, host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="serve the results store read-only over HTTP"
+    )
+    parser.add_argument("--store", default=STORE_PATH)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE)
+    args = parser.parse_args()
+    serve(args.store, args.host, args.port, args.cache_size)
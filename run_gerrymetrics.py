@@ -1,12 +1,17 @@
 # %%
-import gerrymetrics as g
 import pandas as pd
-from os import listdir
-import IPython.display as ipd
+from os import listdir, path
 
-from collections import defaultdict
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
 
-pd.__version__
+import batch_metrics as bm
+import district_table
+import medsl_cache
+import metric_cache
+import resampling as rs
+import results_store
 
 # impute uncontested races at a voteshare of 0 or 1; in other words, don't impute them
 impute_val = 1
@@ -20,19 +25,211 @@ competitiveness_threshold = 1
 
 # only examine races in states with at least 7 districts
 min_districts = 0
+
+# the batch_metrics equivalents of gerrymetrics.t_test_p, mean_median, EG,
+# partisan_bias and mann_whitney_u_p
 metric_dict = {
-    "t_test_p": g.t_test_p,
-    "mean_median_diff": g.mean_median,
-    "efficiency_gap": g.EG,
-    "partisan_bias": g.partisan_bias,
-    "non_parametric_p": g.mann_whitney_u_p,
+    "t_test_p": bm.t_test_p,
+    "mean_median_diff": bm.mean_median,
+    "efficiency_gap": bm.efficiency_gap,
+    "partisan_bias": bm.partisan_bias,
+    "non_parametric_p": bm.mann_whitney_u_p,
+}
+
+# compute metric_dict for every state (and year) at once with batch_metrics,
+# set to "gerrymetrics" to call gerrymetrics.run_all_tests instead (gerrymetrics is
+# only imported then, importing it takes seconds)
+engine = "batch"
+
+# add bootstrap confidence intervals and p-values of resampled_metrics to the exports
+# when n_resamples > 0 (e.g. 10000), see resampling.py
+n_resamples = 0
+ci_level = 0.95
+resampling_seed = 0
+resampled_metrics = {
+    "mean_median_diff": bm.mean_median,
+    "efficiency_gap": bm.efficiency_gap,
+}
+
+
+# columns of the exported csvs, ordered like the spread sheet, with the Year of
+# every election after its State
+export_columns = [
+    "State",
+    "Year",
+    "n_seats",
+    "seats_d",
+    "avg_win_d",
+    "n_uncontested_d",
+    "seats_r",
+    "avg_win_r",
+    "n_uncontested_r",
+    "voteshare_d",
+    "weighted_voteshare",
+    "t_test_p",
+    "non_parametric_p",
+    "mean_median_diff",
+    "efficiency_gap",
+    "partisan_bias",
+]
+
+# parameters of --sweep, every combination is evaluated on every file: the metrics
+# are computed with every impute_val and ranked like gerrymetrics.generate_percentiles
+# among the elections passing every combination of the other filters
+sweep_grid = {
+    "impute_val": [1, 0.9, 0.8, 0.75],
+    "competitiveness_threshold": [1, 0.6, 0.55],
+    "min_districts": [0, 7],
+    "min_year": [min_year],
 }
+sweep_output_path = "exports/parameter_sweep.csv"
+
+# code the exported metrics are computed with, in the key of the metric cache
+metrics_code = ["batch_metrics.py", "resampling.py", "run_gerrymetrics.py"]
+
+# multi-year files are split into shards of at most this many (Year, State)
+# elections, so one large file can be spread across workers
+shard_size = 250
+
+
+def gerry_data_columns(n_resamples=0):
+    """
+    return the columns of the exported csvs: export_columns, followed by the
+    ci_low, ci_high and p columns of every resampled metric when n_resamples > 0
+    """
+    if not n_resamples:
+        return export_columns
+    return export_columns + [
+        "{}_{}".format(name, stat)
+        for name in resampled_metrics
+        for stat in ["ci_low", "ci_high", "p"]
+    ]
+
+
+def compute_gerry_data(districts_df, impute_val, engine, n_resamples=0):
+    """
+    return a df with the gerry_data_columns(n_resamples) for every (Year, State) in
+    districts_df, ordered by State and Year
+
+    Expects districts_df to be sorted like batch_metrics.read_results returns.
+    """
+    if engine == "batch":
+        tests_df = bm.run_all_tests(
+            districts_df, impute_val=impute_val, metrics=metric_dict
+        )
+    else:
+        import gerrymetrics as g
+
+        tests_df = g.tests_df(
+            g.run_all_tests(
+                bm.group_results(districts_df),
+                impute_val=impute_val,
+                metrics={
+                    name: bm.unbatched(metric) for name, metric in metric_dict.items()
+                },
+            )
+        )
+
+    # add the new columns, for every state in every year of the file
+    win_df = bm.win_stats(districts_df).reset_index()
+    df = win_df.merge(tests_df, on=["Year", "State"])
+    if n_resamples:
+        ci_df = rs.confidence_intervals(
+            districts_df,
+            resampled_metrics,
+            n_resamples=n_resamples,
+            level=ci_level,
+            impute_val=impute_val,
+            seed=resampling_seed,
+        )
+        df = df.merge(ci_df.reset_index(), on=["Year", "State"])
+    df = df.sort_values(["State", "Year"], kind="mergesort")
+
+    # rename columns to match the spreadsheet
+    df = df.rename(
+        columns={"voteshare": "voteshare_d", "ndists": "n_seats", "dseats": "seats_d"}
+    )
+    df["seats_r"] = df["n_seats"] - df["seats_d"]
+    return df[gerry_data_columns(n_resamples)]
+
+
+def compute_table(table, impute_val, engine, n_resamples=0):
+    """
+    return compute_gerry_data of a district table, see district_table.py
+    """
+    if engine != "batch":
+        table = district_table.to_df(table)
+    return compute_gerry_data(table, impute_val, engine, n_resamples)
+
+
+def metric_names(metrics):
+    """
+    return the (column, module.function) pairs of a dict of metrics
+    """
+    return sorted(
+        (name, "{}.{}".format(metric.__module__, metric.__qualname__))
+        for name, metric in metrics.items()
+    )
+
+
+def cache_parameters(engine, n_resamples=0):
+    """
+    return the parameters, columns and hashes of the metrics_code the
+    compute_gerry_data of an election depends on, see metric_cache.py (impute_val
+    is in the keys through the imputed voteshares)
+    """
+    return {
+        "engine": engine,
+        "metrics": metric_names(metric_dict),
+        "columns": gerry_data_columns(n_resamples),
+        "n_resamples": n_resamples,
+        "ci_level": ci_level,
+        "resampling_seed": resampling_seed,
+        "resampled_metrics": metric_names(resampled_metrics) if n_resamples else [],
+        "code": [medsl_cache.file_hash(file_path) for file_path in metrics_code],
+    }
+
+
+def cached_gerry_data(
+    table,
+    impute_val,
+    engine,
+    n_resamples=0,
+    conn=None,
+    max_bytes=metric_cache.MAX_BYTES,
+):
+    """
+    return compute_gerry_data of a district table, reading the elections whose
+    results and parameters are in the metric cache at conn from it and caching the
+    others (see metric_cache.py), computing every election when conn is None
+    """
+    if conn is None:
+        return compute_table(table, impute_val, engine, n_resamples)
+    return metric_cache.cached_metrics(
+        conn,
+        table,
+        cache_parameters(engine, n_resamples),
+        lambda missed: compute_table(missed, impute_val, engine, n_resamples),
+        gerry_data_columns(n_resamples),
+        impute_val,
+        max_bytes,
+        by_election=n_resamples > 0,
+    )
+
+
+def export_gerry_data(df, elections_df_fp):
+    """
+    write df from compute_gerry_data to exports/ under the file name of elections_df_fp
+    """
+    df = df.sort_values(["State", "Year"], kind="mergesort")
+    print(df.head())
+    df.to_csv("exports/" + path.basename(elections_df_fp), index=False)
 
 
-def get_gerry_data(elections_df_fp):
+def get_gerry_data(elections_df_fp, cache_path=metric_cache.CACHE_PATH):
     """
     Outputs .csv with the following columns:
-    State	n_seats	seats_d	avg_win_d	n_uncontested_d	p_uncontested_d	seats_r	avg_win_r	n_uncontested_r	p_uncontested_r	voteshare_d	weighted_voteshare	t_test_p	non_parametric_p	mean_median_diff	efficiency_gap	partisan_bias
+    State	Year	n_seats	seats_d	avg_win_d	n_uncontested_d	p_uncontested_d	seats_r	avg_win_r	n_uncontested_r	p_uncontested_r	voteshare_d	weighted_voteshare	t_test_p	non_parametric_p	mean_median_diff	efficiency_gap	partisan_bias
 
     Given a filepath to a csv with the following columns:
     'State,Year,District,Dem Votes,GOP Votes,D Voteshare,Incumbent,Party'
@@ -40,84 +237,310 @@ def get_gerry_data(elections_df_fp):
     Incumbent needs to be present, but is not used in this script, so it can be filled with an arbitrary integer
     Expects elections_df_fp to be the relative file path from the working directory
     Legislative Chambers with any third party winners should be excluded.
+    The metrics of elections whose results didn't change are read from the metric
+    cache at cache_path (None to compute every election), see metric_cache.py.
     """
+    table = district_table.read_table(elections_df_fp)
+    conn = None if cache_path is None else metric_cache.connect(cache_path)
+    try:
+        df = cached_gerry_data(table, impute_val, engine, n_resamples, conn)
+    finally:
+        if conn is not None:
+            conn.close()
+    export_gerry_data(df, elections_df_fp)
 
-    elections_df = g.parse_results(elections_df_fp)
-    tests_df = g.tests_df(
-        g.run_all_tests(elections_df, impute_val=impute_val, metrics=metric_dict)
-    )
 
-    # add the new columns
-    def get_win_stats(state, d_voteshare_series):
-        d_voteshare_lst = list(d_voteshare_series)[0]
-        d_wins = d_sum = n_uncontested_d = r_wins = r_sum = n_uncontested_r = 0
-        for d_voteshare in d_voteshare_lst:
-            if d_voteshare > 0.5:
-                d_wins += 1
-                d_sum += d_voteshare
-                if d_voteshare == 1:
-                    n_uncontested_d += 1
-            else:
-                r_wins += 1
-                r_voteshare = 1 - d_voteshare
-                r_sum += r_voteshare
-                if r_voteshare == 1:
-                    n_uncontested_r += 1
-        avg_win_d = d_sum / d_wins if d_wins != 0 else "N/A"
-        avg_win_r = r_sum / r_wins if r_wins != 0 else "N/A"
-        return [state, avg_win_d, n_uncontested_d, avg_win_r, n_uncontested_r]
-
-    data = []
-    sdf = elections_df.reset_index()
-    for state, group in sdf.groupby("State")["D Voteshare"]:
-        data.append(get_win_stats(state, group))
-    win_df = pd.DataFrame(
-        data,
-        columns=[
-            "State",
-            "avg_win_d",
-            "n_uncontested_d",
-            "avg_win_r",
-            "n_uncontested_r",
-        ],
-    )
+def shard_bounds(table):
+    """
+    return the (start, stop) elections of the shards of at most shard_size
+    (Year, State) elections of a district table, see district_table.py
+    """
+    n = district_table.n_elections(table)
+    return [(start, min(start + shard_size, n)) for start in range(0, n, shard_size)]
 
-    df = win_df.merge(tests_df, on="State")
 
-    # rename columns to match the spreadsheet
-    df = df.rename(
-        columns={"voteshare": "voteshare_d", "ndists": "n_seats", "dseats": "seats_d"}
+# shared memory blocks and district tables attached by a worker of run_gerry_data,
+# by block name
+_attached_tables = {}
+
+
+def _compute_shard(job):
+    descriptor, start, stop, impute_val, engine, n_resamples = job
+    if descriptor["name"] not in _attached_tables:
+        _attached_tables[descriptor["name"]] = district_table.attach_table(descriptor)
+    _, table = _attached_tables[descriptor["name"]]
+    return compute_shard(table, start, stop, impute_val, engine, n_resamples)
+
+
+def compute_shard(table, start, stop, impute_val, engine, n_resamples=0):
+    """
+    return compute_gerry_data of the elections start to stop of a district table
+    """
+    shard = district_table.slice_elections(table, start, stop)
+    return compute_table(shard, impute_val, engine, n_resamples)
+
+
+def run_gerry_data(
+    elections_df_fps,
+    workers=1,
+    n_resamples=0,
+    store_path=results_store.STORE_PATH,
+    cache_path=metric_cache.CACHE_PATH,
+    cache_size=metric_cache.MAX_BYTES,
+):
+    """
+    run get_gerry_data on every file in elections_df_fps, spreading the files and the
+    shards of multi-year files across a pool of worker processes
+
+    Every file is read once, into a district table (see district_table.py). With
+    workers > 1 the tables are published in shared memory and the workers attach
+    to them, so they neither read the files again nor unpickle their districts.
+    Outputs the same csvs as get_gerry_data, in the same row order, whatever the
+    number of workers. See n_resamples for the bootstrap columns. Unless store_path
+    is None, the metrics and district results of every file are also written to the
+    results store at store_path, see results_store.py. Unless cache_path is None,
+    only the elections which aren't in the metric cache at cache_path (of at most
+    cache_size bytes) are computed, see metric_cache.py.
+    """
+    districts_dfs = {
+        elections_df_fp: bm.read_results(elections_df_fp)
+        for elections_df_fp in elections_df_fps
+    }
+    tables = {
+        elections_df_fp: district_table.from_results(districts_df)
+        for elections_df_fp, districts_df in districts_dfs.items()
+    }
+    full_tables = tables
+    cache_conn = None if cache_path is None else metric_cache.connect(cache_path)
+    if cache_conn is not None:
+        # only the elections which aren't cached are sharded and computed
+        cached = {
+            elections_df_fp: metric_cache.split_cached(
+                cache_conn,
+                table,
+                cache_parameters(engine, n_resamples),
+                impute_val,
+                by_election=n_resamples > 0,
+            )
+            for elections_df_fp, table in tables.items()
+        }
+        tables = {
+            elections_df_fp: district_table.take_elections(
+                tables[elections_df_fp], missed
+            )
+            for elections_df_fp, (_, _, missed) in cached.items()
+        }
+    shards = {
+        elections_df_fp: shard_bounds(table)
+        for elections_df_fp, table in tables.items()
+    }
+    if workers > 1:
+        blocks = {}
+        try:
+            for elections_df_fp, table in tables.items():
+                blocks[elections_df_fp] = district_table.share_table(table)
+            jobs = [
+                (
+                    blocks[elections_df_fp][1],
+                    start,
+                    stop,
+                    impute_val,
+                    engine,
+                    n_resamples,
+                )
+                for elections_df_fp in elections_df_fps
+                for start, stop in shards[elections_df_fp]
+            ]
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = iter(list(executor.map(_compute_shard, jobs)))
+        finally:
+            for block, _ in blocks.values():
+                block.close()
+                block.unlink()
+    else:
+        results = (
+            compute_shard(
+                tables[elections_df_fp], start, stop, impute_val, engine, n_resamples
+            )
+            for elections_df_fp in elections_df_fps
+            for start, stop in shards[elections_df_fp]
+        )
+
+    conn = None if store_path is None else results_store.connect(store_path)
+    for elections_df_fp in elections_df_fps:
+        print(path.basename(elections_df_fp))
+        shard_dfs = [next(results) for _ in shards[elections_df_fp]]
+        df = pd.concat(shard_dfs) if shard_dfs else pd.DataFrame()
+        if cache_conn is not None:
+            keys, hits, missed = cached[elections_df_fp]
+            print("metric cache: {} cached, {} computed".format(len(hits), len(missed)))
+            df = metric_cache.merge_cached(
+                cache_conn,
+                full_tables[elections_df_fp],
+                keys,
+                hits,
+                missed,
+                df,
+                gerry_data_columns(n_resamples),
+                cache_size,
+            )
+        export_gerry_data(df, elections_df_fp)
+        if conn is not None:
+            results_store.write_chamber(
+                conn,
+                results_store.chamber_name(elections_df_fp),
+                df,
+                districts_dfs[elections_df_fp],
+                medsl_cache.file_hash("exports/" + path.basename(elections_df_fp)),
+            )
+    if conn is not None:
+        conn.close()
+    if cache_conn is not None:
+        cache_conn.close()
+
+
+def sweep_gerry_data(districts_df, grid):
+    """
+    return a long df with the columns impute_val, competitiveness_threshold,
+    min_districts, min_year, Year, State, metric, value and percentile: one row per
+    metric of metric_dict for every (Year, State) in districts_df passing the filters
+    of every combination of the parameters in grid (see sweep_grid)
+
+    The metrics are computed once for all the impute_vals, see
+    batch_metrics.run_all_tests_grid, and filtered and ranked for every combination of
+    the other parameters, see batch_metrics.generate_percentiles.
+    """
+    tests_df = bm.run_all_tests_grid(districts_df, grid["impute_val"], metric_dict)
+    metric_cols = list(metric_dict)
+    filters = list(
+        itertools.product(
+            grid["competitiveness_threshold"], grid["min_districts"], grid["min_year"]
+        )
     )
-    df["seats_r"] = df["n_seats"] - df["seats_d"]
-    # order the columns like the spread sheet
-    df = df[
-        [
-            "State",
-            "n_seats",
-            "seats_d",
-            "avg_win_d",
-            "n_uncontested_d",
-            "seats_r",
-            "avg_win_r",
-            "n_uncontested_r",
-            "voteshare_d",
-            "weighted_voteshare",
-            "t_test_p",
-            "non_parametric_p",
-            "mean_median_diff",
-            "efficiency_gap",
-            "partisan_bias",
-        ]
-    ]
+    sweep_dfs = []
+    for impute_val in grid["impute_val"]:
+        imputed_df = tests_df.xs(impute_val, level="impute_val")
+        for threshold, min_dists, min_yr in filters:
+            pctile_df = bm.generate_percentiles(
+                imputed_df, metric_cols, threshold, min_dists, min_yr
+            )
+            value_df = imputed_df.loc[pctile_df.index, metric_cols].reset_index()
+            sweep_df = value_df.melt(
+                id_vars=["Year", "State"], var_name="metric", value_name="value"
+            )
+            sweep_df["percentile"] = pctile_df[metric_cols].values.ravel(order="F")
+            sweep_df.insert(0, "impute_val", impute_val)
+            sweep_df.insert(1, "competitiveness_threshold", threshold)
+            sweep_df.insert(2, "min_districts", min_dists)
+            sweep_df.insert(3, "min_year", min_yr)
+            sweep_dfs.append(sweep_df)
+    return pd.concat(sweep_dfs, ignore_index=True)
+
 
-    start = "election_data/gerrymetrics_format/"
-    file_id = elections_df_fp[len(start):]
+def run_sweep(elections_df_fps, grid, output_path=sweep_output_path):
+    """
+    write sweep_gerry_data of every file in elections_df_fps to one csv at
+    output_path, with the file name of every row in the column file
+    """
+    sweep_dfs = []
+    for elections_df_fp in elections_df_fps:
+        print(path.basename(elections_df_fp))
+        sweep_df = sweep_gerry_data(bm.read_results(elections_df_fp), grid)
+        sweep_df.insert(0, "file", path.basename(elections_df_fp))
+        sweep_dfs.append(sweep_df)
+    df = pd.concat(sweep_dfs, ignore_index=True)
     print(df.head())
-    df.to_csv("exports/" + file_id, index=False)
+    df.to_csv(output_path, index=False)
+
+
+def main(argv=None):
+    """
+    run the command line interface on argv (default: sys.argv[1:])
+    """
+    parser = argparse.ArgumentParser(
+        description="run gerrymetrics on election results in the gerrymetrics format"
+    )
+    parser.add_argument(
+        "elections_df_fps",
+        nargs="*",
+        help="files to run (default: every file in election_data/gerrymetrics_format/)",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--resamples",
+        type=int,
+        default=n_resamples,
+        help="number of bootstrap resamples for the confidence interval columns "
+        "(default: n_resamples, 0 for none)",
+    )
+    parser.add_argument(
+        "--sweep",
+        action="store_true",
+        help="evaluate every combination of the parameters in sweep_grid (or given "
+        "below) and write them to sweep_output_path instead of the exports",
+    )
+    parser.add_argument(
+        "--store",
+        default=results_store.STORE_PATH,
+        help="results store to write the metrics and district results to "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-store", action="store_true", help="don't write the results store"
+    )
+    parser.add_argument(
+        "--cache",
+        default=metric_cache.CACHE_PATH,
+        help="metric cache to read and write the metrics of every election "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="compute every election again"
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=metric_cache.MAX_BYTES >> 20,
+        help="MB the metric cache keeps, evicting the least recently used elections "
+        "(default: %(default)s)",
+    )
+    for flag, parameter, type_ in [
+        ("--impute-vals", "impute_val", float),
+        ("--competitiveness-thresholds", "competitiveness_threshold", float),
+        ("--min-districts", "min_districts", int),
+        ("--min-years", "min_year", int),
+    ]:
+        parser.add_argument(
+            flag,
+            dest=parameter,
+            type=type_,
+            nargs="+",
+            default=sweep_grid[parameter],
+            help="values of {} to sweep".format(parameter),
+        )
+    args = parser.parse_args(argv)
+
+    elections_df_fps = args.elections_df_fps or [
+        "election_data/gerrymetrics_format/" + file_name
+        for file_name in sorted(listdir("election_data/gerrymetrics_format/"))
+    ]
+    if args.sweep:
+        run_sweep(
+            elections_df_fps,
+            {parameter: getattr(args, parameter) for parameter in sweep_grid},
+        )
+    else:
+        run_gerry_data(
+            elections_df_fps,
+            workers=args.workers,
+            n_resamples=args.resamples,
+            store_path=None if args.no_store else args.store,
+            cache_path=None if args.no_cache else args.cache,
+            cache_size=args.cache_size << 20,
+        )
 
 
-file_path_lst = listdir("election_data/gerrymetrics_format/")
-for elections_df_fp in file_path_lst:
-    print(elections_df_fp)
-    elections_df_fp = "election_data/gerrymetrics_format/" + elections_df_fp
-    get_gerry_data(elections_df_fp)
+if __name__ == "__main__":
+    main()
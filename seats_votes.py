@@ -0,0 +1,188 @@
+import argparse
+import os
+from os import listdir
+
+import numpy as np
+import pandas as pd
+
+import batch_metrics as bm
+
+# Seats-votes curves under uniform swing.
+#
+# The curve of a (Year, State) election gives the number of seats Democrats would
+# win at every statewide voteshare if every district swung by the same amount: at
+# statewide voteshare v, district i has the voteshare d_i - mean(d) + v, where the
+# statewide voteshare is the mean district voteshare as in gerrymetrics. District i
+# is won by Democrats above its breakpoint, the statewide voteshare
+# 0.5 - (d_i - mean(d)), so the curve is a step function which is stored as its
+# breakpoints: one row per distinct breakpoint of every election with the seats
+# Democrats win above it (seats_votes_curves). That is one row per district at
+# most, instead of one per election and point of a grid.
+#
+# evaluate_curves gives the seats at every point of any grid from the breakpoints,
+# for every election at once: the breakpoints and the grid are ranked together
+# (np.unique), so an (election, rank) pair is one exact int64 key, and the seats
+# of every election at every point are one np.searchsorted over the keys of the
+# breakpoints, sorted by election and breakpoint. The queries are built in chunks of
+# grid points holding at most MAX_ELEMENTS keys.
+#
+# partisan_bias of run_gerrymetrics is one point of this curve: 0.5 minus the
+# seat share at a statewide voteshare of 0.5.
+
+MAX_ELEMENTS = 1 << 24
+
+# default number of statewide voteshares between 0 and 1 (inclusive) of
+# evaluate_curves
+N_POINTS = 1001
+
+OUTPUT_DIR = "exports/seats_votes/"
+
+CURVE_COLUMNS = ["Year", "State", "voteshare", "seats_d", "n_seats"]
+
+
+def voteshare_grid(n_points=N_POINTS):
+    """
+    return n_points (at least 2) evenly spaced statewide voteshares from 0 to 1
+    """
+    if n_points < 2:
+        raise ValueError(
+            "A voteshare grid needs at least 2 points, got {}".format(n_points)
+        )
+    return np.arange(n_points) / (n_points - 1)
+
+
+def swing_breakpoints(voteshares, offsets):
+    """
+    return the statewide voteshare above which Democrats win every district of the
+    ragged array after a uniform swing, sorted within every election
+    """
+    ids = bm.group_ids(offsets)
+    breakpoints = 0.5 - (voteshares - bm.group_mean(voteshares, offsets)[ids])
+    return breakpoints[np.lexsort((breakpoints, ids))]
+
+
+def seats_votes_curves(df, impute_val=1):
+    """
+    return the uniform swing seats-votes curves of every (Year, State) election of
+    df as a df with the CURVE_COLUMNS: one row per distinct breakpoint (voteshare) of
+    every election, with the number of districts Democrats win above it (seats_d)
+    and the number of districts of the election (n_seats), ordered by Year, State
+    and voteshare
+
+    Democrats win no district below the first breakpoint of an election. Voteshares
+    are imputed like batch_metrics.run_all_tests does. Expects df to be sorted like
+    batch_metrics.read_results returns.
+    """
+    elections_df, offsets, voteshares = bm.pack_voteshares(df)
+    if impute_val != 1:
+        voteshares = bm.impute(voteshares, impute_val)
+    breakpoints = swing_breakpoints(voteshares, offsets)
+    ids = bm.group_ids(offsets)
+    # keep the last of equal breakpoints, above which all of them are won
+    last = np.r_[(breakpoints[1:] != breakpoints[:-1]) | (ids[1:] != ids[:-1]), True]
+    n_seats = np.diff(offsets)
+    return pd.DataFrame(
+        {
+            "Year": elections_df["Year"].values[ids[last]],
+            "State": elections_df["State"].values[ids[last]],
+            "voteshare": breakpoints[last],
+            "seats_d": (np.arange(len(breakpoints)) - offsets[ids] + 1)[last],
+            "n_seats": n_seats[ids[last]],
+        }
+    )
+
+
+def evaluate_curves(curves_df, grid=None, max_elements=MAX_ELEMENTS):
+    """
+    return a df with one row per (Year, State) election of curves_df (from
+    seats_votes_curves) and statewide voteshare of grid (default: voteshare_grid()),
+    with the columns Year, State, voteshare, seats_d (the number of districts won by
+    Democrats after a uniform swing to voteshare) and seat_share_d
+    """
+    if grid is None:
+        grid = voteshare_grid()
+    grid = np.asarray(grid, dtype=np.float64)
+    starts = np.flatnonzero(
+        np.r_[
+            True,
+            (curves_df["Year"].values[1:] != curves_df["Year"].values[:-1])
+            | (curves_df["State"].values[1:] != curves_df["State"].values[:-1]),
+        ]
+    )
+    offsets = np.r_[starts, len(curves_df)]
+    ids = bm.group_ids(offsets)
+    breakpoints = curves_df["voteshare"].to_numpy(np.float64)
+    values, ranks = np.unique(np.r_[breakpoints, grid], return_inverse=True)
+    ranks = ranks.ravel()
+    keys = ids * len(values) + ranks[: len(breakpoints)]
+    grid_ranks = ranks[len(breakpoints) :]
+    seats_at = np.r_[0, curves_df["seats_d"].to_numpy(np.int64)]
+
+    n_elections = len(starts)
+    seats = np.empty((n_elections, len(grid)), dtype=np.int64)
+    chunk_size = max(1, max_elements // max(n_elections, 1))
+    for start in range(0, len(grid), chunk_size):
+        stop = min(start + chunk_size, len(grid))
+        queries = np.arange(n_elections)[:, None] * len(values) + grid_ranks[start:stop]
+        # number of breakpoints below every point, the seats are those of the last
+        below = np.searchsorted(keys, queries, side="left")
+        seats[:, start:stop] = np.where(below > starts[:, None], seats_at[below], 0)
+    n_seats = curves_df["n_seats"].to_numpy(np.int64)[starts]
+    return pd.DataFrame(
+        {
+            "Year": np.repeat(curves_df["Year"].values[starts], len(grid)),
+            "State": np.repeat(curves_df["State"].values[starts], len(grid)),
+            "voteshare": np.tile(grid, n_elections),
+            "seats_d": seats.ravel(),
+            "seat_share_d": (seats / n_seats[:, None]).ravel(),
+        }
+    )
+
+
+def export_seats_votes_curves(elections_df_fp, impute_val=1, n_points=None):
+    """
+    write the seats_votes_curves of the elections in elections_df_fp to OUTPUT_DIR
+    under the file name of elections_df_fp, ordered by State and Year, or the curves
+    evaluated on voteshare_grid(n_points) when n_points is given
+    """
+    df = seats_votes_curves(bm.read_results(elections_df_fp), impute_val)
+    if n_points is not None:
+        df = evaluate_curves(df, voteshare_grid(n_points))
+    df = df.sort_values(["State", "Year"], kind="mergesort")
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    df.to_csv(OUTPUT_DIR + os.path.basename(elections_df_fp), index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="compute the uniform swing seats-votes curves of election "
+        "results in the gerrymetrics format"
+    )
+    parser.add_argument(
+        "elections_df_fps",
+        nargs="*",
+        help="files to run (default: every file in election_data/gerrymetrics_format/)",
+    )
+    parser.add_argument(
+        "--points",
+        type=int,
+        help="write the curves evaluated at this many statewide voteshares from 0 "
+        "to 1 instead of their breakpoints",
+    )
+    parser.add_argument(
+        "--impute-val",
+        type=float,
+        default=1,
+        help="voteshare of uncontested races (default: 1, don't impute)",
+    )
+    args = parser.parse_args()
+    if args.points is not None and args.points < 2:
+        parser.error("--points needs at least 2 points")
+
+    elections_df_fps = args.elections_df_fps or [
+        "election_data/gerrymetrics_format/" + file_name
+        for file_name in sorted(listdir("election_data/gerrymetrics_format/"))
+    ]
+    for elections_df_fp in elections_df_fps:
+        print(os.path.basename(elections_df_fp))
+        export_seats_votes_curves(elections_df_fp, args.impute_val, args.points)
@@ -0,0 +1,111 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import batch_metrics as bm
+
+
+def ragged(elections):
+    """
+    return (voteshares, offsets) of a list of the voteshares of every election
+    """
+    offsets = np.r_[0, np.cumsum([len(election) for election in elections])]
+    return np.concatenate(elections).astype(np.float64), offsets
+
+
+def test_group_mean_matches_np_mean():
+    rng = np.random.default_rng(0)
+    elections = [rng.random(n) for n in [1, 3, 8, 8, 9, 130, 300, 3]]
+    elections += [np.full(8, 0.8), np.full(3, 0.1)]
+    voteshares, offsets = ragged(elections)
+    means = bm.group_mean(voteshares, offsets)
+    assert means.tolist() == [np.mean(election) for election in elections]
+
+
+def test_partisan_bias_of_equal_voteshares():
+    voteshares, offsets = ragged([np.full(8, 0.8), np.full(5, 0.3)])
+    assert bm.partisan_bias(voteshares, offsets).tolist() == [0.5, 0.5]
+
+
+def test_partisan_bias_of_equal_voteshares_matches_gerrymetrics():
+    g = pytest.importorskip("gerrymetrics")
+    elections = [np.full(n, value) for n in [1, 2, 7, 8, 9, 33] for value in [0.8, 0.1]]
+    voteshares, offsets = ragged(elections)
+    assert bm.partisan_bias(voteshares, offsets).tolist() == [
+        g.partisan_bias(election) for election in elections
+    ]
+
+
+# elections with the edge cases of the metrics: equal voteshares, one district,
+# uncontested districts and districts all won by one party
+PARITY_ELECTIONS = [
+    np.full(8, 0.8),
+    np.full(5, 0.3),
+    np.full(3, 0.1),
+    np.array([0.4]),
+    np.array([0.7]),
+    np.array([1, 1, 0.6, 0.3, 0]),
+    np.array([0, 0, 0.2, 0.45, 1]),
+    np.array([1, 1, 1, 0, 0]),
+    np.array([0.6, 0.7, 0.8, 0.55]),
+    np.array([0.2, 0.3, 0.45, 0.3]),
+    np.array([0.3, 0.35, 0.6, 0.7, 0.75, 0.52, 0.4, 0.65, 0.35]),
+]
+
+
+def legacy_mannwhitneyu(x, y, use_continuity=True):
+    """
+    scipy.stats.mannwhitneyu with the default alternative=None of the scipy releases
+    gerrymetrics was written against: the one-sided p-value of the larger U
+    """
+    from scipy import stats
+
+    n1, n2 = len(x), len(y)
+    ranked = stats.rankdata(np.concatenate((x, y)))
+    u1 = n1 * n2 + (n1 * (n1 + 1)) / 2.0 - np.sum(ranked[:n1])
+    u2 = n1 * n2 - u1
+    tie_correction = stats.tiecorrect(ranked)
+    if tie_correction == 0:
+        raise ValueError("All numbers are identical in mannwhitneyu")
+    sd = np.sqrt(tie_correction * n1 * n2 * (n1 + n2 + 1) / 12.0)
+    z = (max(u1, u2) - (n1 * n2 / 2.0 + 0.5 * use_continuity)) / sd
+    return u2, stats.norm.sf(abs(z))
+
+
+def legacy_ttest_ind(a, b, equal_var=True):
+    """
+    scipy.stats.ttest_ind of the scipy releases gerrymetrics was written against,
+    NaN when either sample has fewer than 2 values
+    """
+    from scipy import stats
+
+    n1, n2 = np.float64(len(a)), np.float64(len(b))
+    with np.errstate(all="ignore"):
+        v1 = np.var(a, ddof=1) if n1 > 1 else np.nan
+        v2 = np.var(b, ddof=1) if n2 > 1 else np.nan
+        df = n1 + n2 - 2.0
+        pooled_var = ((n1 - 1) * v1 + (n2 - 1) * v2) / df
+        t = (np.mean(a) - np.mean(b)) / np.sqrt(pooled_var * (1.0 / n1 + 1.0 / n2))
+    return t, stats.t.sf(np.abs(t), df) * 2
+
+
+@pytest.mark.parametrize("name", sorted(bm.BATCHED_METRICS))
+@pytest.mark.parametrize("impute_val", [1, 0.8])
+def test_batched_metrics_match_gerrymetrics(name, impute_val, monkeypatch):
+    g = pytest.importorskip("gerrymetrics")
+    # the tests of newer scipy releases return other p-values for one-district
+    # samples and have no alternative=None
+    monkeypatch.setattr(
+        g.metrics,
+        "sps",
+        SimpleNamespace(ttest_ind=legacy_ttest_ind, mannwhitneyu=legacy_mannwhitneyu),
+    )
+    elections = [bm.impute(election, impute_val) for election in PARITY_ELECTIONS]
+    voteshares, offsets = ragged(elections)
+    np.testing.assert_allclose(
+        bm.BATCHED_METRICS[name](voteshares, offsets),
+        [getattr(g, name)(election) for election in elections],
+        rtol=1e-12,
+        atol=1e-15,
+    )
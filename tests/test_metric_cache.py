@@ -0,0 +1,105 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import batch_metrics as bm
+import district_table
+import metric_cache
+import run_gerrymetrics as rg
+
+RESULTS = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "election_data",
+    "gerrymetrics_format",
+    "us-house-of-representatives-2016.csv",
+)
+
+
+def cached_run(conn, table, impute_val):
+    """
+    return (df, computed): the metrics of table read from or stored in the cache,
+    and the number of elections computed
+    """
+    computed = []
+
+    def compute(missed):
+        computed.append(district_table.n_elections(missed))
+        return rg.compute_table(missed, impute_val, "batch")
+
+    df = metric_cache.cached_metrics(
+        conn,
+        table,
+        rg.cache_parameters("batch"),
+        compute,
+        rg.gerry_data_columns(),
+        impute_val,
+    )
+    return df, sum(computed)
+
+
+def uncontested_elections(table):
+    offsets = table["offsets"]
+    uncontested = np.isin(table["voteshare"], [0, 1])
+    return int((np.add.reduceat(uncontested, offsets[:-1]) > 0).sum())
+
+
+def test_impute_val_only_recomputes_uncontested_elections(tmp_path):
+    table = district_table.read_table(RESULTS)
+    n_uncontested = uncontested_elections(table)
+    assert 0 < n_uncontested < district_table.n_elections(table)
+    conn = metric_cache.connect(str(tmp_path / "cache.sqlite"))
+
+    _, computed = cached_run(conn, table, 1)
+    assert computed == district_table.n_elections(table)
+    df, computed = cached_run(conn, table, 1)
+    assert computed == 0
+    pd.testing.assert_frame_equal(df, rg.compute_table(table, 1, "batch"))
+
+    df, computed = cached_run(conn, table, 0.9)
+    assert computed == n_uncontested
+    pd.testing.assert_frame_equal(df, rg.compute_table(table, 0.9, "batch"))
+    conn.close()
+
+
+def test_changed_election_is_recomputed(tmp_path):
+    table = district_table.read_table(RESULTS)
+    conn = metric_cache.connect(str(tmp_path / "cache.sqlite"))
+    cached_run(conn, table, 1)
+
+    changed = {name: np.array(values) for name, values in table.items()}
+    changed["voteshare"][0] = 0.5 * (changed["voteshare"][0] + 0.5)
+    df, computed = cached_run(conn, changed, 1)
+    assert computed == 1
+    pd.testing.assert_frame_equal(df, rg.compute_table(changed, 1, "batch"))
+    conn.close()
+
+
+def test_changed_columns_are_recomputed(tmp_path, monkeypatch):
+    table = district_table.read_table(RESULTS)
+    conn = metric_cache.connect(str(tmp_path / "cache.sqlite"))
+    cached_run(conn, table, 1)
+
+    monkeypatch.setattr(
+        rg, "export_columns", [col for col in rg.export_columns if col != "seats_r"]
+    )
+    df, computed = cached_run(conn, table, 1)
+    assert computed == district_table.n_elections(table)
+    assert list(df.columns) == rg.export_columns
+    conn.close()
+
+
+def test_changed_metric_function_is_recomputed(tmp_path, monkeypatch):
+    table = district_table.read_table(RESULTS)
+    conn = metric_cache.connect(str(tmp_path / "cache.sqlite"))
+    cached_run(conn, table, 1)
+
+    def partisan_bias(voteshares, offsets):
+        return -bm.partisan_bias(voteshares, offsets)
+
+    monkeypatch.setitem(rg.metric_dict, "partisan_bias", partisan_bias)
+    df, computed = cached_run(conn, table, 1)
+    assert computed == district_table.n_elections(table)
+    pd.testing.assert_frame_equal(df, rg.compute_table(table, 1, "batch"))
+    conn.close()
@@ -0,0 +1,21 @@
+import numpy as np
+import pandas as pd
+
+import batch_metrics as bm
+import resampling as rs
+
+
+def test_p_value_is_nan_without_variability():
+    df = pd.DataFrame(
+        {
+            "Year": [2016] * 6,
+            "State": ["AK", "CO", "CO", "CO", "CO", "CO"],
+            "D Voteshare": [0.4, 0.3, 0.35, 0.6, 0.7, 0.75],
+        }
+    )
+    ci_df = rs.confidence_intervals(
+        df, {"efficiency_gap": bm.efficiency_gap}, n_resamples=200
+    )
+    p = ci_df["efficiency_gap_p"]
+    assert np.isnan(p.loc[(2016, "AK")])
+    assert 0 <= p.loc[(2016, "CO")] <= 1